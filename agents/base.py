@@ -8,6 +8,7 @@ import shutil
 import os
 import utils
 import torch.distributed as dist
+import loralib as lora
 
 
 #这里面是lora的各种setting和utils
@@ -39,6 +40,9 @@ class Base:
         self.train_distill_type = None  # for LoRa
         self.model_task_id = 1e7  # for LoRa
 
+        # named adapter selections ('current', 'ema', 'task<k>') over the agent state above
+        self.adapters = lora.AdapterRegistry(self)
+
 
         #首先根据该ema参数来设置lora的num，第二个为ema_lora,第一个为task-specific lora
         #其次控制lora的更新方式task-specific lora正常更新(要注意这个时候只看这单个lora！不需要ema_lora的输出)
@@ -75,6 +79,9 @@ class Base:
             self.model_ckpt_history = {}
             self.model_ckpt_list = []
         self.model_ckpt_load = copy.deepcopy(self.model_ckpt_list)
+
+        # rank-compacted copies of task ckpts, only used for evaluation
+        self.model_ckpt_compact = {}
         
         # other dirs
         self.task_dir_dict = {}
@@ -124,11 +131,18 @@ class Base:
         # save task config
         self.task_config_dict[task_str] = task_config
 
+    def get_eval_ckpt_list(self):
+        # the compacted ckpt of the latest task replaces its full-rank one
+        ckpt_list = copy.deepcopy(self.model_ckpt_list)
+        if len(self.tasks) > 0 and self.tasks[-1] in self.model_ckpt_compact:
+            ckpt_list[-1] = self.model_ckpt_compact[self.tasks[-1]]
+        return ckpt_list
+
     def finish_task (self):
         self.task_id += 1
 
     def regularize(self, state_dict):
-        return torch.zeros((1,), requires_grad=True).cuda()
+        return torch.zeros((1,), requires_grad=True, device=self.args.device)
 
     def update_model(self, model):
         pass
@@ -138,4 +152,4 @@ class Naive(Base):
         super(Naive, self).__init__(agent_config)
 
     def regularize(self, state_dict):
-        return torch.zeros((1,), requires_grad=True).cuda()
\ No newline at end of file
+        return torch.zeros((1,), requires_grad=True, device=self.args.device)
\ No newline at end of file
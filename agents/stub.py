@@ -0,0 +1,37 @@
+import argparse
+
+import loralib as lora
+
+
+class AgentStub:
+    """
+    The agent fields BLIP_NLVR.forward and the LoRA layers read (see base.Base and lora), without the checkpoint copies
+    and process group the training agents need. Used by the inference tools and the benchmarks.
+    n_adapters is what get_num_tasks() reports: 2 (3 for ema_type 'mix') for EMA agents, the number of task adapters
+    for multi-lora ones. Further keyword arguments become agent.args fields (e.g. loss_alpha of the distillation).
+    """
+    def __init__(self, n_adapters=1, ema=False, multi=False, r=16, lora_layers=True, ema_type='epoch', task_id=0,
+                 train_distill_type=None, random=False, freeze_text_emb=False, **args):
+        self.n_adapters = n_adapters
+        self.lora = lora_layers
+        self.r = r
+        self.ema = ema
+        self.multi = multi
+        self.type = ema_type
+        self.ada_weights = False
+        self.fuse_type = 'last' if multi else 'max'
+        self.model_task_id = 1e7
+        self.task_id = task_id
+        self.train_distill_type = train_distill_type
+        self.random = random
+        self.args = argparse.Namespace(freeze_text_emb=freeze_text_emb, **args)
+        self.adapters = lora.AdapterRegistry(self)
+
+    def get_num_tasks(self):
+        return self.n_adapters
+
+    def prep_model4task(self, task_num=-1, force=False):
+        if (task_num < 0) and (not force):
+            self.model_task_id = 1e7
+        else:
+            self.model_task_id = task_num
@@ -0,0 +1,91 @@
+"""
+Gradient communication cost of LoRA training under the --grad_compress / --grad_sync_every / --bucket_cap_mb settings,
+measured with lora.LoRADataParallel on CPU processes over gloo:
+
+    python benchmarks/comm_compression.py --world_size 4 --steps 200
+
+The model is a stack of LoRA linear layers with the adapter shapes of the BLIP ViT-B/BERT encoders; only the
+all-reduce time is reported, per setting and relative to the float32 every-step baseline. The bf16 setting needs a
+torch build whose gloo backend reduces bfloat16.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import loralib as lora
+
+
+SETTINGS = [
+    ('fp32', None, 1),
+    ('fp16', torch.float16, 1),
+    ('bf16', torch.bfloat16, 1),
+    ('fp32 sync/4', None, 4),
+    ('fp16 sync/4', torch.float16, 4),
+]
+
+
+def build_model(args):
+    layers = [lora.Linear(args.width, args.width, r=args.r) for _ in range(args.layers)]
+    model = nn.Sequential(*layers)
+    lora.mark_only_lora_as_trainable(model)
+    return model
+
+
+def worker(rank, args, init_file, results):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=args.world_size)
+    torch.manual_seed(rank)
+    for name, compress_dtype, sync_every in SETTINGS:
+        model = build_model(args)
+        params = [p for p in model.parameters() if p.requires_grad]
+        flat_buffers = lora.flatten_parameters(params)
+        model = lora.LoRADataParallel(model, flat_buffers=flat_buffers, bucket_cap_mb=args.bucket_cap_mb,
+                                      compress_dtype=compress_dtype, sync_every=sync_every)
+        optimizer = torch.optim.AdamW([flat_data for flat_data, _ in flat_buffers], lr=1e-4)
+        x = torch.randn(args.batch_size, args.width)
+        for step in range(args.steps):
+            if model.synced:
+                optimizer.zero_grad(set_to_none=False)
+            model(x).pow(2).mean().backward()
+            if model.synced:
+                optimizer.step()
+            if step == args.warmup - 1:
+                model.comm_stats.reset()
+        if rank == 0:
+            results[name] = dict(model.comm_stats.summary(), steps=args.steps - args.warmup)
+        dist.barrier()
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world_size', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--layers', type=int, default=72, help='LoRA layers, 12 blocks x 6 adapted linears')
+    parser.add_argument('--width', type=int, default=768)
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--bucket_cap_mb', type=float, default=25)
+    args = parser.parse_args()
+
+    init_file = os.path.join(tempfile.mkdtemp(), 'init')
+    results = mp.Manager().dict()
+    mp.spawn(worker, args=(args, init_file, results), nprocs=args.world_size, join=True)
+
+    base = float(results['fp32']['comm_time'])
+    print(f"{'setting':<14}{'comm s':>10}{'MB':>10}{'calls':>8}{'ms/step':>10}{'vs fp32':>10}")
+    for name, _, _ in SETTINGS:
+        r = results[name]
+        t = float(r['comm_time'])
+        print(f"{name:<14}{t:>10.3f}{r['comm_mb']:>10}{r['comm_calls']:>8}{1000 * t / r['steps']:>10.2f}{t / base:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
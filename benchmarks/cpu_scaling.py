@@ -0,0 +1,108 @@
+"""
+Throughput of LoRA fine-tuning and evaluation on CPU from 1 to N processes over gloo, each process with its own
+intra-op thread budget and core set (the --device cpu --cpu_threads --pin_cores path of run_me):
+
+    python benchmarks/cpu_scaling.py --max_procs 8 --cpu_threads 4 --pin_cores
+
+The model is a ViT-B sized stack of LoRA-adapted transformer MLPs, so absolute numbers are a lower bound of the
+BLIP_NLVR step time; the scaling across process counts is what the table is for. The global batch grows with the
+number of processes (weak scaling), as with torchrun.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import loralib as lora
+import utils
+
+
+class Block(nn.Module):
+    def __init__(self, width, r):
+        super().__init__()
+        self.norm = nn.LayerNorm(width)
+        self.fc1 = lora.Linear(width, 4 * width, r=r)
+        self.fc2 = lora.Linear(4 * width, width, r=r)
+
+    def forward(self, x):
+        return x + self.fc2(nn.functional.gelu(self.fc1(self.norm(x))))
+
+
+def worker(rank, n_procs, args, init_file, results):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=n_procs)
+    utils.init_cpu_threads(argparse.Namespace(cpu_threads=args.cpu_threads, pin_cores=args.pin_cores,
+                                              distributed=True, gpu=rank))
+    torch.manual_seed(rank)
+    model = nn.Sequential(*[Block(args.width, args.r) for _ in range(args.layers)])
+    lora.mark_only_lora_as_trainable(model)
+    params = [p for p in model.parameters() if p.requires_grad]
+    flat_buffers = lora.flatten_parameters(params)
+    train_model = lora.LoRADataParallel(model, flat_buffers=flat_buffers)
+    optimizer = utils.create_optimizer([flat_data for flat_data, _ in flat_buffers], lr=1e-4, weight_decay=0.05)
+    x = torch.randn(args.batch_size, args.tokens, args.width)
+
+    def timed(step_fn, steps):
+        for _ in range(args.warmup):
+            step_fn()
+        dist.barrier()
+        start = time.time()
+        for _ in range(steps):
+            step_fn()
+        dist.barrier()
+        return time.time() - start
+
+    def train_step():
+        optimizer.zero_grad(set_to_none=False)
+        train_model(x).pow(2).mean().backward()
+        optimizer.step()
+
+    @torch.no_grad()
+    def eval_step():
+        model(x)
+
+    train_time = timed(train_step, args.steps)
+    eval_time = timed(eval_step, args.steps)
+    if rank == 0:
+        samples = args.steps * args.batch_size * n_procs
+        results[n_procs] = {'train': samples / train_time, 'eval': samples / eval_time}
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_procs', type=int, default=4)
+    parser.add_argument('--cpu_threads', type=int, default=1, help='intra-op threads per process')
+    parser.add_argument('--pin_cores', default=False, action='store_true')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--layers', type=int, default=12)
+    parser.add_argument('--width', type=int, default=768)
+    parser.add_argument('--tokens', type=int, default=197, help='ViT-B/16 tokens at 224px')
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=2, help='per process')
+    args = parser.parse_args()
+
+    results = mp.Manager().dict()
+    n_procs = 1
+    while n_procs <= args.max_procs:
+        init_file = os.path.join(tempfile.mkdtemp(), 'init')
+        mp.spawn(worker, args=(n_procs, args, init_file, results), nprocs=n_procs, join=True)
+        n_procs *= 2
+
+    base = results[1]
+    print(f"{'procs':>6}{'threads':>9}{'train samples/s':>17}{'speedup':>9}{'eval samples/s':>16}{'speedup':>9}")
+    for n in sorted(results.keys()):
+        r = results[n]
+        print(f"{n:>6}{n * args.cpu_threads:>9}{r['train']:>17.2f}{r['train'] / base['train']:>9.2f}"
+              f"{r['eval']:>16.2f}{r['eval'] / base['eval']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""
+CPU microbenchmarks of the hot paths on synthetic inputs and tiny configs, with machine-readable results and a
+regression check against a stored baseline:
+
+    python benchmarks/microbench.py --out bench.json                     # run all cases
+    python benchmarks/microbench.py --only lora_linear                   # cases whose name contains the pattern
+    python benchmarks/microbench.py --save_baseline benchmarks/baseline.json
+    python benchmarks/microbench.py --baseline benchmarks/baseline.json --tolerance 0.15
+
+With --baseline the exit code is 1 when a case got slower than baseline * (1 + tolerance). Baselines are only
+comparable on the same machine and thread count (recorded under "meta"). Cases whose inputs cannot be built here
+(e.g. no bert-base-uncased tokenizer in the HF cache and no network) are reported as skipped.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import loralib as lora
+from agents.stub import AgentStub
+
+
+CASES = {}
+
+
+def case(name, number):
+    # a case builds its inputs and returns the callable that is timed, `number` calls per measurement
+    def register(fn):
+        CASES[name] = (fn, number)
+        return fn
+    return register
+
+
+def lora_stack(agent, layers=4, width=768, r=8):
+    model = nn.Sequential(*[lora.Linear(width, width, r=r, agent=agent) for _ in range(layers)])
+    lora.mark_only_lora_as_trainable(model)
+    return model
+
+
+def fwd_bwd(model, x):
+    def run():
+        model.zero_grad(set_to_none=True)
+        model(x).sum().backward()
+    return run
+
+
+@case('lora_linear_single', number=20)
+def bench_lora_linear_single():
+    return fwd_bwd(lora_stack(None), torch.randn(8, 197, 768))
+
+
+@case('lora_linear_ema', number=20)
+def bench_lora_linear_ema():
+    return fwd_bwd(lora_stack(AgentStub(n_adapters=2, ema=True)), torch.randn(8, 197, 768))
+
+
+@case('lora_linear_multi_T5', number=20)
+def bench_lora_linear_multi():
+    return fwd_bwd(lora_stack(AgentStub(n_adapters=5, multi=True)), torch.randn(8, 197, 768))
+
+
+@case('update_ema_epoch_lora', number=20)
+def bench_update_ema_epoch_lora():
+    # adapters of 12 blocks x 6 adapted linears
+    model = lora_stack(AgentStub(n_adapters=2, ema=True), layers=72)
+    return lambda: lora.update_ema_epoch_lora(model, 0.85, 1, True)
+
+
+@case('load_checkpoint_remap', number=5)
+def bench_load_checkpoint_remap():
+    from models.blip_nlvr import remap_crossattention_keys
+    # key layout of the BLIP text encoder cross-attention, tiny tensors: only the remapping is timed
+    keys = []
+    for layer in range(12):
+        prefix = f'text_encoder.encoder.layer.{layer}.'
+        keys += [prefix + f'crossattention.self.{n}.{p}' for n in ['query', 'key', 'value'] for p in ['weight', 'bias']]
+        keys += [prefix + f'crossattention.output.dense.{p}' for p in ['weight', 'bias']]
+        keys += [prefix + f'attention.self.{n}.weight' for n in ['query', 'key', 'value']]
+        keys += [prefix + f'{m}.dense.weight' for m in ['intermediate', 'output']]
+    keys += [f'visual_encoder.blocks.{b}.{m}.weight' for b in range(12) for m in ['attn.qkv', 'attn.proj', 'mlp.fc1', 'mlp.fc2']]
+    state_dict = {k: torch.zeros(1) for k in keys}
+    return lambda: remap_crossattention_keys(dict(state_dict), False)
+
+
+def synthetic_vl_checklist(root, n_images=8, image_size=480):
+    from PIL import Image
+    names = []
+    for i in range(n_images):
+        name = f'VG_{i}.jpg'
+        Image.fromarray(np.random.randint(0, 255, (image_size, image_size, 3), dtype=np.uint8)).save(os.path.join(root, name))
+        names.append(name)
+    ann = [[name, {'POS': ['a red car parked next to a tree'] * 4, 'NEG': ['a blue car parked next to a tree'] * 4}]
+           for name in names]
+    json_file = os.path.join(root, 'ann.json')
+    with open(json_file, 'w') as f:
+        json.dump(ann, f)
+    config = {'vg_root': root, 'haik_root': root, 'swig_root': root}
+    return json_file, {name: 0 for name in names}, config
+
+
+@case('vl_checklist_getitem', number=16)
+def bench_vl_checklist_getitem():
+    from data import build_train_transform
+    from data.vl_checklist import vl_checklist_dataset
+    root = tempfile.mkdtemp()
+    json_file, split_dict, config = synthetic_vl_checklist(root)
+    dataset = vl_checklist_dataset(build_train_transform(384), json_file, split_dict, {}, split='train', config=config)
+    index = iter(range(10 ** 9))
+    return lambda: dataset[next(index) % len(dataset)]
+
+
+@case('random_augment', number=16)
+def bench_random_augment():
+    from PIL import Image
+    from transform.randaugment import RandomAugment
+    augment = RandomAugment(2, 5, isPIL=True, augs=['Identity', 'AutoContrast', 'Brightness', 'Sharpness', 'Equalize',
+                                                    'ShearX', 'ShearY', 'TranslateX', 'TranslateY', 'Rotate'])
+    img = Image.fromarray(np.random.randint(0, 255, (384, 384, 3), dtype=np.uint8))
+    return lambda: augment(img)
+
+
+@case('tokenizer_batch', number=10)
+def bench_tokenizer_batch():
+    from models.blip import init_tokenizer
+    tokenizer = init_tokenizer()
+    # the pos + neg caption batch BLIP_NLVR.forward tokenizes for batch_size_train 16
+    text = ['a red car parked next to a tree'] * 16 + ['a blue car parked next to a large tree'] * 16
+    return lambda: tokenizer(text, padding='longest', return_tensors="pt")
+
+
+class AdapterLoopModel(nn.Module):
+    # stand-in for BLIP_NLVR in the evaluation loop: LoRA layers on pooled image features, two-way head
+    def __init__(self, agent):
+        super().__init__()
+        self.encoder = lora_stack(agent, layers=2)
+        self.cls_head = nn.Linear(768, 2)
+
+    def forward(self, image, text, targets, train=True, agent=None):
+        return self.cls_head(self.encoder(image.mean(dim=(2, 3)).repeat(1, 256)))
+
+
+@case('multi_task_evaluate_T5', number=3)
+def bench_multi_task_evaluate():
+    from task_trainers.train_nlvr import multi_task_evaluate
+    agent = AgentStub(n_adapters=5, multi=True)
+    model = AdapterLoopModel(agent)
+    batches = [(torch.randn(8, 3, 32, 32), ['pos caption'] * 8, ['neg caption'] * 8, torch.arange(8)) for _ in range(4)]
+    return lambda: multi_task_evaluate(model, batches, torch.device('cpu'), {}, agent, sync=False)
+
+
+def measure(fn, number, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number * 1000)
+    return {'median_ms': statistics.median(times), 'min_ms': min(times), 'number': number, 'repeat': repeat}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'case':<28}{'ms':>10}{'baseline':>10}{'ratio':>8}")
+    for name, r in results.items():
+        if 'median_ms' not in r:
+            print(f"{name:<28}{'skipped':>10}")
+            continue
+        b = baseline.get(name, {}).get('median_ms')
+        if b is None:
+            print(f"{name:<28}{r['median_ms']:>10.3f}{'-':>10}")
+            continue
+        ratio = r['median_ms'] / b
+        flag = '  REGRESSION' if ratio > 1 + tolerance else ''
+        print(f"{name:<28}{r['median_ms']:>10.3f}{b:>10.3f}{ratio:>8.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', type=str, default=None, help='run the cases whose name contains this pattern')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads, fixed for comparable numbers')
+    parser.add_argument('--out', type=str, default=None, help='write the results as json')
+    parser.add_argument('--baseline', type=str, default=None, help='compare against this results json')
+    parser.add_argument('--save_baseline', type=str, default=None, help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown over the baseline')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    results = {}
+    for name, (build, number) in CASES.items():
+        if args.only is not None and args.only not in name:
+            continue
+        try:
+            fn = build()
+        except (ImportError, OSError) as e:
+            results[name] = {'skipped': f'{type(e).__name__}: {e}'}
+            continue
+        results[name] = measure(fn, number, args.repeat, args.warmup)
+        print(f"{name:<28}{results[name]['median_ms']:>10.3f} ms")
+
+    report = {'meta': {'torch': torch.__version__, 'threads': args.threads, 'machine': platform.machine(),
+                       'processor': platform.processor(), 'python': platform.python_version()},
+              'results': results}
+    for path in [args.out, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('threads') != args.threads:
+            print(f"Baseline was measured with {baseline['meta'].get('threads')} threads, this run with {args.threads}")
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+End-to-end run of the continual loop of run_me (training, epoch EMA, zero-shot antidote, cl_matrix evaluation) on
+synthetic data and a tiny model, on CPU, without the BLIP checkpoints, the Visual Genome images or a tokenizer
+download:
+
+    python benchmarks/synthetic_e2e.py --work_dir /tmp/synthetic_e2e --tasks 3 --nproc 2
+    python benchmarks/synthetic_e2e.py --work_dir /tmp/synthetic_e2e -- --lora_ddp --grad_compress fp16
+
+Arguments after -- go to run_me unchanged. Generated under --work_dir: random images, one vl_checklist-style POS/NEG
+json per task, a wild-data json, a word-level vocab, a randomly initialized tiny BLIP_NLVR checkpoint (vit 'tiny',
+configs/med_config_tiny.json) and the sequence, task and zero-shot yamls. run_me runs under torchrun with --device cpu
+and the wall clock per stage is read back from its telemetry.jsonl, so the report doubles as an end-to-end benchmark
+(--out writes it as json). Accuracies of the synthetic tasks carry no meaning.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import telemetry
+
+
+# one concept family per task, as in the VG attribute / relation tasks
+CONCEPTS = [
+    ('state', ['open', 'closed', 'empty', 'full', 'wet', 'dry']),
+    ('action', ['standing', 'sitting', 'walking', 'running', 'eating', 'sleeping']),
+    ('size', ['small', 'large', 'tiny', 'huge', 'tall', 'short']),
+    ('spatial', ['left', 'right', 'above', 'below', 'behind', 'front']),
+    ('material', ['wooden', 'metal', 'plastic', 'glass', 'stone', 'paper']),
+    ('relation_action', ['holding', 'riding', 'pulling', 'pushing', 'carrying', 'watching']),
+    ('color', ['red', 'blue', 'green', 'yellow', 'white', 'black']),
+]
+OBJECTS = ['car', 'dog', 'tree', 'man', 'woman', 'table', 'bag', 'horse', 'boat', 'chair', 'cat', 'bench']
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+
+
+def write_images(root, names, image_size, rng):
+    os.makedirs(root, exist_ok=True)
+    from PIL import Image
+    for name in names:
+        pixels = rng.randint(0, 255, (image_size, image_size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(root, name), quality=90)
+
+
+def caption_pairs(words, rng, pairs):
+    # POS and NEG differ in the concept word only
+    pos, neg = [], []
+    for _ in range(pairs):
+        obj = OBJECTS[rng.randint(len(OBJECTS))]
+        a, b = rng.choice(len(words), 2, replace=False)
+        pos.append(f'{words[a]} {obj}')
+        neg.append(f'{words[b]} {obj}')
+    return {'POS': pos, 'NEG': neg}
+
+
+def generate(args):
+    """ Data, vocab, checkpoint and configs under args.work_dir; returns the sequence and zero-shot config paths. """
+    rng = np.random.RandomState(args.seed)
+    work_dir = os.path.abspath(args.work_dir)
+    image_root = os.path.join(work_dir, 'images')
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+
+    # image names start with VG so vl_checklist_dataset resolves them under vg_root
+    task_list = []
+    for t in range(args.tasks):
+        concept, words = CONCEPTS[t % len(CONCEPTS)]
+        names = [f'VG_synth/{t:02d}_{i:05d}.jpg' for i in range(args.images_per_task)]
+        write_images(os.path.join(image_root, 'VG_synth'), [os.path.basename(n) for n in names], args.image_size, rng)
+        ann = [[name, caption_pairs(words, rng, args.pairs_per_image)] for name in names]
+        json_file = os.path.join(data_dir, f'{t:02d}_{concept}.json')
+        with open(json_file, 'w') as f:
+            json.dump(ann, f)
+        task_list.append({'name': f'synthetic_{concept}', 'config': os.path.join(work_dir, 'task.yaml'),
+                          'trainer': 'train_nlvr', 'json_files': [json_file]})
+
+    # wild data of the zero-shot antidote: unrelated images and captions over all concept families
+    names = [f'VG_synth/wild_{i:05d}.jpg' for i in range(args.wild_images)]
+    write_images(os.path.join(image_root, 'VG_synth'), [os.path.basename(n) for n in names], args.image_size, rng)
+    wild_words = [w for _, words in CONCEPTS for w in words]
+    wild_file = os.path.join(data_dir, 'wild.json')
+    with open(wild_file, 'w') as f:
+        json.dump([[name, caption_pairs(wild_words, rng, 1)] for name in names], f)
+
+    # word-level vocab, every caption word is a single token
+    vocab_dir = os.path.join(work_dir, 'vocab')
+    os.makedirs(vocab_dir, exist_ok=True)
+    vocab = SPECIAL_TOKENS + sorted(set(wild_words + OBJECTS))
+    with open(os.path.join(vocab_dir, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+    med_config = os.path.join(REPO, 'configs', 'med_config_tiny.json')
+    with open(med_config, 'r') as f:
+        # + [DEC] and [ENC] added by init_tokenizer
+        assert len(vocab) + 2 <= json.load(f)['vocab_size'], 'vocab does not fit the tiny text encoder'
+
+    task_config = yaml.safe_load(open(os.path.join(REPO, 'configs', 'task', 'nlvr_vl_checklist.yaml'), 'r'))
+    pretrained = os.path.join(work_dir, 'tiny_pretrained.pth')
+    task_config.update({
+        'vit': 'tiny', 'image_size': args.image_size, 'med_config': med_config, 'tokenizer': vocab_dir,
+        'batch_size_train': [args.batch_size] * args.tasks, 'batch_size_test': args.batch_size * 2,
+        'max_epoch': args.epochs, 'pretrained': pretrained,
+        'vg_root': image_root, 'haik_root': image_root, 'swig_root': image_root,
+        'split_file': os.path.join(data_dir, 'split_file.pickle'),
+    })
+    with open(os.path.join(work_dir, 'task.yaml'), 'w') as f:
+        yaml.dump(task_config, f)
+    save_pretrained(task_config, pretrained, args.seed)
+
+    sequence_file = os.path.join(work_dir, 'sequence.yaml')
+    with open(sequence_file, 'w') as f:
+        yaml.dump({'vl_checklist_path': data_dir, 'task_list': task_list, 'order': 'fixed', 'pretrained': pretrained}, f)
+    zsl_file = os.path.join(work_dir, 'zero_shot.yaml')
+    with open(zsl_file, 'w') as f:
+        yaml.dump({'vl_checklist_path': data_dir,
+                   'task_list': [{'name': 'synthetic_zsl', 'config': os.path.join(work_dir, 'task.yaml'),
+                                  'trainer': 'train_nlvr', 'json_files': [wild_file]}]}, f)
+    return sequence_file, zsl_file
+
+
+def save_pretrained(config, path, seed):
+    # stands in for model_base_nlvr.pth: the plain model without adapters, with its classification head
+    import torch
+    from models.blip_nlvr import BLIP_NLVR
+    from task_trainers.train_nlvr import model_kwargs
+    torch.manual_seed(seed)
+    model = BLIP_NLVR(**model_kwargs(config))
+    torch.save({'model': model.state_dict()}, path)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def stage_report(events, launch_time, end_time, generate_s):
+    summary = telemetry.summarize(events)
+    total = lambda column: sum(values.get(column, 0.0) for values in summary.values())
+    # timed events are written when they end
+    first = min(e['time'] - e.get('seconds', 0.0) for e in events) if events else end_time
+    return {
+        'generate_s': generate_s,
+        # interpreter and imports, process group and agent, until the first dataset is built
+        'startup_s': first - launch_time,
+        'task_setup_s': total('task_setup_s'),
+        'model_load_s': total('model_load_s'),
+        'train_s': total('train_s'),
+        'train_eval_s': total('eval_s'),
+        'save_s': total('save_s'),
+        'eval_round_s': total('eval_round_s'),
+        'total_s': end_time - launch_time + generate_s,
+    }, summary
+
+
+def main():
+    argv = sys.argv[1:]
+    run_me_args = []
+    if '--' in argv:
+        run_me_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=str, default='output/synthetic_e2e')
+    parser.add_argument('--tasks', type=int, default=3)
+    parser.add_argument('--images_per_task', type=int, default=64)
+    parser.add_argument('--pairs_per_image', type=int, default=2)
+    parser.add_argument('--wild_images', type=int, default=32)
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=8, help='per process')
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--nproc', type=int, default=1, help='torchrun processes')
+    parser.add_argument('--cpu_threads', type=int, default=1)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--agent_name', type=str, default='ZAF')
+    parser.add_argument('--mu', type=float, default=4, help='LoRA rank of the lora agents')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep_data', default=False, action='store_true',
+                        help='reuse the data, vocab and checkpoint of an earlier run in --work_dir')
+    parser.add_argument('--out', type=str, default=None, help='write the stage report as json')
+    args = parser.parse_args(argv)
+
+    work_dir = os.path.abspath(args.work_dir)
+    start = time.time()
+    sequence_file, zsl_file = os.path.join(work_dir, 'sequence.yaml'), os.path.join(work_dir, 'zero_shot.yaml')
+    if not (args.keep_data and os.path.exists(sequence_file)):
+        sequence_file, zsl_file = generate(args)
+    generate_s = time.time() - start
+
+    output_dir = os.path.join(work_dir, 'run')
+    # run_me resumes from a populated output dir, every benchmark run starts from scratch
+    shutil.rmtree(output_dir, ignore_errors=True)
+    cmd = [sys.executable, '-m', 'torch.distributed.run', '--nproc_per_node', str(args.nproc),
+           '--master_port', str(free_port()), 'run_me.py',
+           '--config', sequence_file, '--zsl_config', zsl_file, '--output_dir', output_dir,
+           '--device', 'cpu', '--cpu_threads', str(args.cpu_threads), '--num_workers', str(args.num_workers),
+           '--agent_type', 'lora', '--agent_name', args.agent_name, '--mu', str(args.mu), '--external_lr', '0.00125',
+           '--ema', 'epoch', '--ema_lora', 'ema', '--ema_alpha', '0.85', '--save_frequency', 'every',
+           '--freeze_text_emb', '--eval_every', '1', '--telemetry_every', '1'] + run_me_args
+    print(' '.join(cmd))
+    launch_time = time.time()
+    returncode = subprocess.call(cmd, cwd=REPO)
+    end_time = time.time()
+
+    telemetry_file = os.path.join(output_dir, 'telemetry.jsonl')
+    events = telemetry.load_events(telemetry_file) if os.path.exists(telemetry_file) else []
+    stages, summary = stage_report(events, launch_time, end_time, generate_s)
+
+    print()
+    telemetry.print_table(telemetry_file, summary)
+    print()
+    print(f"{'stage':<16}{'seconds':>10}")
+    for name, seconds in stages.items():
+        print(f'{name[:-2]:<16}{seconds:>10.2f}')
+    cl_matrix_file = os.path.join(output_dir, 'final_results', 'cl_matrix.yaml')
+    if os.path.exists(cl_matrix_file):
+        print('cl_matrix:', yaml.safe_load(open(cl_matrix_file, 'r')))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'args': vars(args), 'run_me_args': run_me_args, 'returncode': returncode, 'stages': stages,
+                       'tasks': summary}, f, indent=2)
+    if returncode != 0:
+        print(f'run_me failed with exit code {returncode}')
+        sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,15 +5,15 @@ import torch
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
-from transform.randaugment import RandomAugment
 import data.vl_checklist as vl_checklist
 
 
-def create_dataset(dataset, config, dataset_pass_dict=None, min_scale=0.5):
+def build_train_transform(image_size, min_scale=0.5):
+    # RandomAugment pulls in cv2, imported when a train split is actually built
+    from transform.randaugment import RandomAugment
     normalize = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-
-    transform_train = transforms.Compose([
-        transforms.RandomResizedCrop(config['image_size'], scale=(min_scale, 1.0),
+    return transforms.Compose([
+        transforms.RandomResizedCrop(image_size, scale=(min_scale, 1.0),
                                      interpolation=InterpolationMode.BICUBIC),
         transforms.RandomHorizontalFlip(),
         RandomAugment(2, 5, isPIL=True, augs=['Identity', 'AutoContrast', 'Brightness', 'Sharpness', 'Equalize',
@@ -21,12 +21,22 @@ def create_dataset(dataset, config, dataset_pass_dict=None, min_scale=0.5):
         transforms.ToTensor(),
         normalize,
     ])
-    transform_test = transforms.Compose([
-        transforms.Resize((config['image_size'], config['image_size']), interpolation=InterpolationMode.BICUBIC),
+
+
+def build_eval_transform(image_size):
+    normalize = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
+    return transforms.Compose([
+        transforms.Resize((image_size, image_size), interpolation=InterpolationMode.BICUBIC),
         transforms.ToTensor(),
         normalize,
     ])
 
+
+def create_dataset(dataset, config, dataset_pass_dict=None, min_scale=0.5, splits=('train', 'val', 'test')):
+    # splits not listed in `splits` are not built and come back as None
+    transform_train = build_train_transform(config['image_size'], min_scale) if 'train' in splits else None
+    transform_test = build_eval_transform(config['image_size'])
+
     if dataset == 'vl-checklist':
         json_files = []
         split_file = config['split_file']
@@ -63,35 +73,27 @@ def create_dataset(dataset, config, dataset_pass_dict=None, min_scale=0.5):
                         split_dict = pickle.load(fp)
 
 
-            train_datasets.append(
-                vl_checklist.vl_checklist_dataset(transform_train, json_file, split_dict['image_splits'],
-                                                  split='train', config=config,
-                                                  dataset_pass_dict=dataset_pass_dict))
-            val_datasets.append(
-                vl_checklist.vl_checklist_dataset(transform_test, json_file, split_dict['image_splits'], split='val',
-                                                  config=config,
-                                                  dataset_pass_dict=dataset_pass_dict))
-
-            test_datasets.append(
-                vl_checklist.vl_checklist_dataset(transform_test, json_file, split_dict['image_splits'], split='test',
-                                                  config=config,
-                                                  dataset_pass_dict=dataset_pass_dict))
-
-        return torch.utils.data.ConcatDataset(train_datasets), torch.utils.data.ConcatDataset(val_datasets), \
-               torch.utils.data.ConcatDataset(test_datasets)
+            if 'train' in splits:
+                train_datasets.append(
+                    vl_checklist.vl_checklist_dataset(transform_train, json_file, split_dict['image_splits'],
+                                                      split='train', config=config,
+                                                      dataset_pass_dict=dataset_pass_dict))
+            if 'val' in splits:
+                val_datasets.append(
+                    vl_checklist.vl_checklist_dataset(transform_test, json_file, split_dict['image_splits'], split='val',
+                                                      config=config,
+                                                      dataset_pass_dict=dataset_pass_dict))
+            if 'test' in splits:
+                test_datasets.append(
+                    vl_checklist.vl_checklist_dataset(transform_test, json_file, split_dict['image_splits'], split='test',
+                                                      config=config,
+                                                      dataset_pass_dict=dataset_pass_dict))
+
+        return tuple(torch.utils.data.ConcatDataset(d) if split in splits else None
+                     for split, d in zip(['train', 'val', 'test'], [train_datasets, val_datasets, test_datasets]))
 
 def create_zsl_dataset(dataset, config, dataset_pass_dict=None, min_scale=0.5):
-    normalize = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-
-    transform_train = transforms.Compose([
-        transforms.RandomResizedCrop(config['image_size'], scale=(min_scale, 1.0),
-                                     interpolation=InterpolationMode.BICUBIC),
-        transforms.RandomHorizontalFlip(),
-        RandomAugment(2, 5, isPIL=True, augs=['Identity', 'AutoContrast', 'Brightness', 'Sharpness', 'Equalize',
-                                              'ShearX', 'ShearY', 'TranslateX', 'TranslateY', 'Rotate']),
-        transforms.ToTensor(),
-        normalize,
-    ])
+    transform_train = build_train_transform(config['image_size'], min_scale)
 
     if dataset == 'vl-checklist':
         json_files = []
@@ -114,11 +116,31 @@ def create_zsl_dataset(dataset, config, dataset_pass_dict=None, min_scale=0.5):
 
         return torch.utils.data.ConcatDataset(train_datasets),torch.utils.data.ConcatDataset(train_datasets),torch.utils.data.ConcatDataset(train_datasets)
 
+class ResumableDistributedSampler(torch.utils.data.DistributedSampler):
+    """
+    DistributedSampler that can start an epoch part way: the first start_index indices of this replica are skipped,
+    the order of the rest is unchanged. set_epoch() starts the next epoch from the beginning again.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start_index, 0)
+
+
 def create_sampler(datasets, shuffles, num_tasks, global_rank):
     samplers = []
     for dataset, shuffle in zip(datasets, shuffles):
-        sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=num_tasks, rank=global_rank,
-                                                      shuffle=shuffle)
+        sampler = ResumableDistributedSampler(dataset, num_replicas=num_tasks, rank=global_rank, shuffle=shuffle)
         samplers.append(sampler)
     return samplers
 
@@ -137,7 +159,7 @@ def create_loader(datasets, samplers, batch_size, num_workers, is_trains, collat
             dataset,
             batch_size=bs,
             num_workers=n_worker,
-            pin_memory=True,
+            pin_memory=torch.cuda.is_available(),
             sampler=sampler,
             shuffle=shuffle,
             collate_fn=collate_fn,
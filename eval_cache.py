@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import torch.distributed as dist
+
+import utils
+from data import build_eval_transform
+
+
+def atomic_write_json(path, obj):
+    # write to a temp file in the same directory, then rename over the target: readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def dataset_hash(dataset):
+    # hash of the annotations that make up the split, independent of where the json files live
+    h = hashlib.sha256()
+    for d in getattr(dataset, 'datasets', [dataset]):
+        h.update(json.dumps(d.annotation).encode())
+    return h.hexdigest()
+
+
+class EvalCache:
+    """
+    Evaluation results shared across runs, keyed by content rather than by output directory:
+        - sha256 of every checkpoint in the composed chain, in load order
+        - adapter selection and the agent fields that shape the LoRA forward
+        - hash of the test split annotations, and whether it is sharded (padded) over how many ranks
+        - image_size, vit and the eval transform
+    File hashes are memoized in a sidecar index keyed by (path, size, mtime) so large checkpoints are hashed once.
+    All writes are atomic renames, concurrent runs can share one cache directory.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, 'file_hashes.json')
+
+    def _load_json(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        index = self._load_json(self.index_file) or {}
+        entry = index.get(path)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry['sha256']
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+        # re-read right before writing so entries added meanwhile by other runs are kept
+        index = self._load_json(self.index_file) or {}
+        index[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': h.hexdigest()}
+        atomic_write_json(self.index_file, index)
+        return h.hexdigest()
+
+    def key(self, args, config, test_dataset, adapter, task_parallel=False):
+        agent = args['agent']
+        # a sharded evaluation pads the split to a multiple of the world size, its accuracy depends on that size; a
+        # single process and the task-parallel engine both read the whole unpadded split
+        sharded = args.get('distributed', False) and not task_parallel and utils.get_world_size() > 1
+        ckpts = args['pretrained'] if isinstance(args['pretrained'], list) else [args['pretrained']]
+        fields = {
+            'checkpoints': [self.file_hash(c) for c in ckpts if c is not None and c != 'None'],
+            # only what changes the forward, so agents sharing checkpoints (e.g. zero-shot evaluations of the
+            # pretrained model by UB and LB runs) share entries; the LoRA rank is part of the checkpoint hashes
+            'adapter': {
+                'selection': adapter,
+                'num_adapters': agent.get_num_tasks(),
+                'multi': agent.multi,
+                'int8_backbone': args.get('int8_backbone', False),
+            },
+            'split': dataset_hash(test_dataset),
+            'sharding': {'mode': 'sharded' if sharded else 'full',
+                         'world_size': utils.get_world_size() if sharded else 1},
+            'image_size': config['image_size'],
+            'vit': config['vit'],
+            'transform': repr(build_eval_transform(config['image_size'])),
+        }
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def _result_file(self, key):
+        return os.path.join(self.cache_dir, 'results', key[:2], key + '.json')
+
+    def get(self, args, config, test_dataset, adapter, task_parallel=False):
+        """
+        Returns (key, stats), stats is None on a miss. Rank 0 hashes and reads, the others receive its answer so all
+        ranks take the same branch.
+        """
+        key, stats = None, None
+        if utils.is_main_process():
+            key = self.key(args, config, test_dataset, adapter, task_parallel)
+            entry = self._load_json(self._result_file(key))
+            stats = entry['stats'] if entry is not None else None
+        if utils.is_dist_avail_and_initialized() and dist.get_world_size() > 1:
+            obj = [key, stats]
+            dist.broadcast_object_list(obj, src=0)
+            key, stats = obj
+        return key, stats
+
+    def put(self, key, stats):
+        if utils.is_main_process():
+            atomic_write_json(self._result_file(key), {'stats': stats})
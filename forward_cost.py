@@ -0,0 +1,372 @@
+"""
+FLOP and activation memory accounting of BLIP_NLVR.forward per training mode and task index.
+
+ForwardCost counts, for the forwards run inside `with cost.measure():`,
+    - forward FLOPs (2 per multiply-add) of every Linear / Conv2d, of the attention score and context matmuls, and of
+      the LoRA branches separately from the frozen weights they adapt, using the adapter selection the agent makes at
+      call time (one adapter for EMA agents, all adapters up to model_task_id for multi-lora)
+    - activation memory: bytes of the tensors saved for backward, tracked while alive, so the peak is the largest
+      graph held at any point of the step; attributed to the innermost module running when a tensor was saved
+    - encoder passes: calls of the visual and text encoders
+grouped as vit.attn / vit.mlp / vit.other, text.self_attn / text.cross_attn / text.ffn / text.other, lora.vit /
+lora.text and cls_head. Backward passes are not counted (the adversarial inner steps of adv_text call autograd.grad
+inside the forward; their graphs show in the activation peak only).
+
+The CLI runs one training step per mode at every task index on a randomly initialized model of a task config:
+    student    single adapter, cross entropy only
+    zaf        EMA agent (ZAF): student on the task batch, then student + EMA teacher on the wild batch from task 1 on
+    zsl_cons   multi-lora: student, then the wild batch through the student and one teacher per previous task
+    adv_text   multi-lora: student plus num_adv_iters adversarial passes and one current pass per previous task
+    eval       inference with a single adapter
+
+    python forward_cost.py --config configs/task/nlvr_vl_checklist.yaml --tasks 7 --batch_size 4
+    python forward_cost.py --tasks 3 --modes zaf,adv_text --by_module 15 --out cost.json
+"""
+import argparse
+import json
+import math
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+import yaml
+
+import loralib as lora
+from agents.stub import AgentStub
+from models.vit import Attention as VitAttention
+from models.med import BertSelfAttention as MedSelfAttention
+from models.nlvr_encoder import BertSelfAttention as NlvrSelfAttention
+
+
+def module_group(name):
+    if name.startswith('visual_encoder.'):
+        if '.attn' in name:
+            return 'vit.attn'
+        if '.mlp' in name:
+            return 'vit.mlp'
+        return 'vit.other'
+    if name.startswith('text_encoder.'):
+        if 'crossattention' in name:
+            return 'text.cross_attn'
+        if '.attention.' in name or name.endswith('.attention'):
+            return 'text.self_attn'
+        if '.intermediate' in name or '.output' in name:
+            return 'text.ffn'
+        return 'text.other'
+    if name.startswith('cls_head'):
+        return 'cls_head'
+    return 'other'
+
+
+def lora_group(name):
+    return 'lora.vit' if name.startswith('visual_encoder.') else 'lora.text'
+
+
+def executed_adapters(layer):
+    # number of LoRA branches lora.Linear / lora.Embedding.forward runs with the current agent state
+    if layer.r == 0 or layer.merged:
+        return 0
+    if isinstance(layer.lora_A, nn.ParameterList):
+        if layer.agent.ema:
+            return 1
+        return sum(1 for i in range(len(layer.lora_A)) if layer.should_exec(i))
+    return int(layer.should_exec(0))
+
+
+class _Saved:
+    # handle of a tensor saved for backward, released when autograd drops it
+    def __init__(self, cost, tensor, key):
+        self.cost, self.tensor, self.key = cost, tensor, key
+
+    def __del__(self):
+        self.cost._release(self.key)
+
+
+class ForwardCost:
+    def __init__(self, model):
+        self.model = model
+        self.names = {m: n for n, m in model.named_modules()}
+        self.reset()
+
+    def reset(self):
+        self.flops = defaultdict(float)        # module name (LoRA branches as '<layer>.lora') -> FLOPs
+        self.groups = {}                       # module name -> group
+        self.passes = defaultdict(int)
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.live_by_group = defaultdict(int)
+        self.peak_by_group = {}
+        self._storages = {}                    # storage ptr -> [refs, bytes, group]
+
+    def _add_flops(self, name, group, flops):
+        self.flops[name] += flops
+        self.groups[name] = group
+
+    def _flop_hook(self, module, inputs, output):
+        name = self.names[module]
+        if isinstance(module, nn.Linear):
+            x = inputs[0]
+            n = x.numel() // x.shape[-1]
+            self._add_flops(name, module_group(name), 2 * n * module.in_features * module.out_features)
+            if isinstance(module, lora.Linear):
+                k = executed_adapters(module)
+                if k > 0:
+                    self._add_flops(name + '.lora', lora_group(name),
+                                    k * 2 * n * module.r * (module.in_features + module.out_features))
+        elif isinstance(module, lora.Embedding):
+            k = executed_adapters(module)
+            if k > 0:
+                self._add_flops(name + '.lora', lora_group(name), k * 2 * inputs[0].numel() * module.r * module.embedding_dim)
+        elif isinstance(module, nn.Conv2d):
+            kh, kw = module.kernel_size
+            self._add_flops(name, module_group(name),
+                            2 * output.numel() * module.in_channels // module.groups * kh * kw)
+        elif isinstance(module, VitAttention):
+            b, l, c = inputs[0].shape
+            # q @ k^T and attn @ v
+            self._add_flops(name + '.scores', module_group(name), 4 * b * l * l * c)
+        elif isinstance(module, (MedSelfAttention, NlvrSelfAttention)):
+            b, lq, _ = inputs[0].shape
+            encoder_states = inputs[3] if len(inputs) > 3 else None
+            lk = encoder_states.shape[1] if encoder_states is not None else lq
+            self._add_flops(name + '.scores', module_group(name), 4 * b * lq * lk * module.all_head_size)
+
+    def _pass_hook(self, module, inputs, output):
+        self.passes[self.names[module]] += 1
+
+    def _push(self, module, inputs):
+        self._stack.append(module)
+
+    def _pop(self, module, inputs, output):
+        self._stack.pop()
+
+    def _pack(self, tensor):
+        storage = tensor.untyped_storage()
+        key = storage.data_ptr()
+        if key in self._param_storages:
+            return tensor
+        if key not in self._storages:
+            module = self._stack[-1] if self._stack else self.model
+            name = self.names.get(module, '')
+            group = module_group(name)
+            if isinstance(module, (lora.Linear, lora.Embedding)) and tensor.dim() > 0 and tensor.shape[-1] == module.r:
+                # the rank-r intermediate of the LoRA branch
+                group = lora_group(name)
+            self._storages[key] = [0, storage.nbytes(), group]
+            self.live_bytes += storage.nbytes()
+            self.live_by_group[group] += storage.nbytes()
+            if self.live_bytes > self.peak_bytes:
+                self.peak_bytes = self.live_bytes
+                self.peak_by_group = dict(self.live_by_group)
+        self._storages[key][0] += 1
+        return _Saved(self, tensor, key)
+
+    def _release(self, key):
+        entry = self._storages.get(key)
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self._storages[key]
+            self.live_bytes -= entry[1]
+            self.live_by_group[entry[2]] -= entry[1]
+
+    @staticmethod
+    def _unpack(saved):
+        return saved.tensor if isinstance(saved, _Saved) else saved
+
+    @contextmanager
+    def measure(self):
+        self.reset()
+        self._stack = []
+        self._param_storages = {p.untyped_storage().data_ptr() for p in self.model.parameters()}
+        handles = []
+        for module in self.model.modules():
+            handles.append(module.register_forward_pre_hook(self._push))
+            handles.append(module.register_forward_hook(self._pop))
+            if isinstance(module, (nn.Linear, nn.Conv2d, lora.Embedding, VitAttention, MedSelfAttention,
+                                   NlvrSelfAttention)):
+                handles.append(module.register_forward_hook(self._flop_hook))
+        for encoder in [self.model.visual_encoder, self.model.text_encoder]:
+            handles.append(encoder.register_forward_hook(self._pass_hook))
+        try:
+            with torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack):
+                yield self
+        finally:
+            for h in handles:
+                h.remove()
+
+    def summary(self):
+        groups = defaultdict(float)
+        for name, flops in self.flops.items():
+            groups[self.groups[name]] += flops
+        return {
+            'gflops': sum(self.flops.values()) / 1e9,
+            'gflops_by_group': {g: v / 1e9 for g, v in sorted(groups.items())},
+            'act_peak_mb': self.peak_bytes / 2 ** 20,
+            'act_peak_mb_by_group': {g: v / 2 ** 20 for g, v in sorted(self.peak_by_group.items()) if v > 0},
+            'passes': {'vit': self.passes.get('visual_encoder', 0), 'text': self.passes.get('text_encoder', 0)},
+        }
+
+    def top_modules(self, k):
+        return sorted(((v / 1e9, n) for n, v in self.flops.items()), reverse=True)[:k]
+
+
+def cost_agent(task_id, n_adapters=1, ema=False, multi=False, train_distill_type=None, r=16, num_adv_iters=11):
+    # the distillation settings of the training defaults
+    return AgentStub(n_adapters=n_adapters, ema=ema, multi=multi, r=r, task_id=task_id,
+                     train_distill_type=train_distill_type, random=train_distill_type == 'ema-zsl-single',
+                     freeze_text_emb=True, loss_alpha=1.0, auto_scale_alpha=False, adv_last_only=False, adv_num_last=1,
+                     adv_step_sz=0.1, num_adv_iters=num_adv_iters, adv_pos=False)
+
+
+MODES = {
+    # name: agent of task t, whether the wild batch goes through the zero-shot forward
+    'student': lambda t, a: cost_agent(t, r=a.r),
+    'zaf': lambda t, a: cost_agent(t, n_adapters=2, ema=True, train_distill_type='ema-zsl-single', r=a.r),
+    'zsl_cons': lambda t, a: cost_agent(t, n_adapters=t + 1, multi=True, train_distill_type='zsl-cons', r=a.r),
+    'adv_text': lambda t, a: cost_agent(t, n_adapters=t + 1, multi=True, train_distill_type='adv_text', r=a.r,
+                                       num_adv_iters=a.num_adv_iters),
+    'eval': lambda t, a: cost_agent(t, r=a.r),
+}
+
+
+def captions(n):
+    # wild-data captions shipped with the repo, realistic token counts
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs', 'continual', 'zero_shot.json'), 'r') as f:
+        ann = json.load(f)
+    pos = [ann[i % len(ann)][1]['POS'][0] for i in range(n)]
+    neg = [ann[i % len(ann)][1]['NEG'][0] for i in range(n)]
+    return pos, neg
+
+
+def build(config, agent, device):
+    from models.blip_nlvr import BLIP_NLVR
+    from task_trainers.train_nlvr import model_kwargs
+    model = BLIP_NLVR(agent=agent, **model_kwargs(config))
+    lora.mark_only_lora_as_trainable(model.text_encoder)
+    lora.mark_only_lora_as_trainable(model.visual_encoder)
+    for p in model.cls_head.parameters():
+        p.requires_grad = False
+    return model.to(device)
+
+
+def run_step(mode, model, agent, batch, device):
+    # the forwards of one train / train_zsl step (task_trainers.train_nlvr), or of one evaluation batch
+    from task_trainers.train_nlvr import task_batch, zsl_batch
+    images, text, targets = task_batch(batch, device)
+    if mode == 'eval':
+        model.eval()
+        with torch.no_grad():
+            model(images, text, targets=targets, train=False, agent=agent)
+        return
+    model.train()
+    loss = model(images, text, targets=targets, train=True, agent=agent)
+    if agent.task_id != 0 and agent.train_distill_type in ['ema-zsl-single', 'zsl-cons']:
+        images, text, targets = zsl_batch(batch, agent, device)
+        loss2, _ = model(images, text, targets=targets, train=True, agent=agent, train_zsl=True)
+        loss = loss + loss2
+    return loss
+
+
+def account(config, modes, tasks, args, device):
+    results = {}
+    image_size = config['image_size']
+    pos, neg = captions(args.batch_size)
+    batch = (torch.randn(args.batch_size, 3, image_size, image_size), pos, neg, torch.arange(args.batch_size))
+    for mode in modes:
+        results[mode] = {}
+        models = {}
+        for t in range(tasks):
+            agent = MODES[mode](t, args)
+            # one build per adapter layout, the single and EMA layouts do not change with t
+            layout = (agent.n_adapters, agent.ema, agent.multi)
+            if layout not in models:
+                models = {layout: build(config, agent, device)}
+            model = models[layout]
+            for m in model.modules():
+                if isinstance(m, lora.LoRALayer):
+                    m.agent = agent
+            cost = ForwardCost(model)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+            with cost.measure():
+                loss = run_step(mode, model, agent, batch, device)
+                summary = cost.summary()
+            del loss
+            if device.type == 'cuda':
+                summary['cuda_peak_mb'] = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+            summary['top_modules'] = cost.top_modules(args.by_module)
+            results[mode][t] = summary
+            print(f"{mode} task {t}: {summary['gflops']:.2f} GFLOPs, {summary['act_peak_mb']:.1f} MB activations, "
+                  f"passes {summary['passes']}")
+    return results
+
+
+def growth(per_task):
+    # least-squares GFLOPs added per task index
+    ts = sorted(per_task)
+    if len(ts) < 2:
+        return 0.0
+    mean_t = sum(ts) / len(ts)
+    mean_f = sum(per_task[t]['gflops'] for t in ts) / len(ts)
+    return sum((t - mean_t) * (per_task[t]['gflops'] - mean_f) for t in ts) / sum((t - mean_t) ** 2 for t in ts)
+
+
+def print_report(results, by_module):
+    groups = sorted({g for per_task in results.values() for s in per_task.values() for g in s['gflops_by_group']})
+    for mode, per_task in results.items():
+        print()
+        print(f'{mode}: {growth(per_task):+.2f} GFLOPs per additional task')
+        print(f"{'task':>5}{'GFLOPs':>10}{'x task0':>9}{'act MB':>10}{'vit':>5}{'text':>5}" + ''.join(f'{g:>16}' for g in groups))
+        base = per_task[min(per_task)]['gflops']
+        for t, s in sorted(per_task.items()):
+            print(f"{t:>5}{s['gflops']:>10.2f}{s['gflops'] / base if base else math.nan:>9.2f}{s['act_peak_mb']:>10.1f}"
+                  f"{s['passes']['vit']:>5}{s['passes']['text']:>5}"
+                  + ''.join(f"{s['gflops_by_group'].get(g, 0.0):>16.3f}" for g in groups))
+        last = per_task[max(per_task)]
+        print('activation peak by group (MB, last task): '
+              + ', '.join(f'{g} {v:.1f}' for g, v in last['act_peak_mb_by_group'].items()))
+        if by_module > 0:
+            print(f'top {by_module} modules by GFLOPs (last task):')
+            for gflops, name in last['top_modules']:
+                print(f'    {gflops:10.3f}  {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FLOPs and activation memory of BLIP_NLVR.forward per mode and task index')
+    parser.add_argument('--config', type=str, default='configs/task/nlvr_vl_checklist.yaml', help='task config of the architecture')
+    parser.add_argument('--tasks', type=int, default=7)
+    parser.add_argument('--modes', type=str, default=','.join(MODES))
+    parser.add_argument('--batch_size', type=int, default=2, help='images per batch, every image comes with a pos and a neg caption')
+    parser.add_argument('--image_size', type=int, default=None, help='overrides the config')
+    parser.add_argument('--tokenizer', type=str, default=None, help='overrides the config, e.g. a local vocab directory')
+    parser.add_argument('--r', type=int, default=16, help='LoRA rank (--mu of run_me)')
+    parser.add_argument('--num_adv_iters', type=int, default=11)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--by_module', type=int, default=0, help='also list the k most expensive modules')
+    parser.add_argument('--out', type=str, default=None, help='write the results as json')
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config, 'r'))
+    if args.image_size is not None:
+        config['image_size'] = args.image_size
+    if args.tokenizer is not None:
+        config['tokenizer'] = args.tokenizer
+    modes = args.modes.split(',')
+    for mode in modes:
+        assert mode in MODES, f'Unknown mode {mode}, choose from {list(MODES)}'
+
+    torch.manual_seed(0)
+    results = account(config, modes, args.tasks, args, torch.device(args.device))
+    print_report(results, args.by_module)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 name = "lora"
 
 from .layers import *
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .registry import AdapterRegistry
+from .parallel import LoRADataParallel, CommStats, allreduce_hook
\ No newline at end of file
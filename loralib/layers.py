@@ -10,6 +10,48 @@ import torch.nn.functional as F
 import math
 from typing import Optional, List
 
+# output channels dequantized at a time by the int8 fallback path
+INT8_CHUNK_ROWS = 256
+
+
+def _int8_matmul(x, weight_int8, weight_scale):
+    # x @ (W_int8 * scale)^T without a full float copy of W
+    if x.device.type == 'cpu' and hasattr(torch, '_weight_int8pack_mm'):
+        try:
+            x2d = x.reshape(-1, x.shape[-1]).contiguous()
+            out = torch._weight_int8pack_mm(x2d, weight_int8, weight_scale.to(x.dtype))
+            return out.reshape(*x.shape[:-1], weight_int8.shape[0])
+        except RuntimeError:
+            # dtype or shape the kernel does not support
+            pass
+    out = x.new_empty(*x.shape[:-1], weight_int8.shape[0])
+    for start in range(0, weight_int8.shape[0], INT8_CHUNK_ROWS):
+        rows = slice(start, start + INT8_CHUNK_ROWS)
+        out[..., rows] = F.linear(x, weight_int8[rows].to(x.dtype)) * weight_scale[rows].to(x.dtype)
+    return out
+
+
+class Int8Linear(torch.autograd.Function):
+    """
+    F.linear with a frozen int8 weight and per-output-channel scales. The weight is dequantized a chunk of output
+    channels at a time in both passes, and nothing but the int8 weight is kept for the backward.
+    """
+    @staticmethod
+    def forward(ctx, x, weight_int8, weight_scale):
+        ctx.save_for_backward(weight_int8, weight_scale)
+        return _int8_matmul(x, weight_int8, weight_scale)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        weight_int8, weight_scale = ctx.saved_tensors
+        grad_x = None
+        for start in range(0, weight_int8.shape[0], INT8_CHUNK_ROWS):
+            rows = slice(start, start + INT8_CHUNK_ROWS)
+            g = (grad_out[..., rows] * weight_scale[rows].to(grad_out.dtype)) @ weight_int8[rows].to(grad_out.dtype)
+            grad_x = g if grad_x is None else grad_x + g
+        return grad_x, None, None
+
+
 class LoRALayer():
     def __init__(
         self, 
@@ -75,6 +117,23 @@ class LoRALayer():
                     if self.ada_weights_enabled():
                         self.lora_ada_weights[i].requires_grad = False
 
+    def quantize_weight_(self):
+        """
+        Stores the frozen base weight as symmetric int8 with one float scale per row (output channel
+        for Linear, embedding vector for Embedding). The LoRA parameters stay in float and weight
+        merging is disabled. Linear runs through Int8Linear (an int8 kernel on CPU, chunks of
+        dequantized rows otherwise), Embedding dequantizes only the looked-up rows.
+        """
+        if hasattr(self, 'weight_int8'):
+            return
+        assert not getattr(self, 'fan_in_fan_out', False), 'int8 base weights need the (fan_out, fan_in) layout'
+        w = self.weight.data
+        scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.
+        self.register_buffer('weight_int8', torch.round(w / scale[:, None]).to(torch.int8))
+        self.register_buffer('weight_scale', scale)
+        del self.weight
+        self.merge_weights = False
+
     def should_exec(self, ix):
         numA = self.get_num_adapters()
         if (numA == 1) and ((self.agent is None) or (ix <= self.agent.model_task_id)):
@@ -150,10 +209,15 @@ class Embedding(nn.Embedding, LoRALayer):
                 self.weight.data += (self.lora_B @ self.lora_A) * self.scaling
             self.merged = True
 
+    def base_forward(self, x: torch.Tensor):
+        if hasattr(self, 'weight_int8'):
+            return self.weight_int8[x].to(self.weight_scale.dtype) * self.weight_scale[x].unsqueeze(-1)
+        return nn.Embedding.forward(self, x)
+
     #改forward,和EMA适配
     def forward(self, x: torch.Tensor):
         if self.r > 0 and not self.merged:
-            result = nn.Embedding.forward(self, x)
+            result = self.base_forward(x)
             if self.r > 0:
                 if isinstance(self.lora_A, nn.ParameterList):
                     # 再加一个判断，在测试EMA状态的时候（self.fuse_type = 'ema'），则看第二个lora即ema_lora的输出
@@ -194,7 +258,7 @@ class Embedding(nn.Embedding, LoRALayer):
                         result += (after_A @ self.lora_B.T) * self.scaling
             return result
         else:
-            return nn.Embedding.forward(self, x)
+            return self.base_forward(x)
             
 
 class Linear(nn.Linear, LoRALayer):
@@ -273,11 +337,20 @@ class Linear(nn.Linear, LoRALayer):
                 self.weight.data += T(self.lora_B @ self.lora_A) * self.scaling
             self.merged = True
 
+    def base_forward(self, x: torch.Tensor):
+        def T(w):
+            return w.T if self.fan_in_fan_out else w
+        if hasattr(self, 'weight_int8'):
+            # int8 kernel on CPU, chunked dequantization otherwise
+            result = Int8Linear.apply(x, self.weight_int8, self.weight_scale)
+            return result + self.bias if self.bias is not None else result
+        return F.linear(x, T(self.weight), bias=self.bias)
+
     def forward(self, x: torch.Tensor):
         def T(w):
             return w.T if self.fan_in_fan_out else w
         if self.r > 0 and not self.merged:
-            result = F.linear(x, T(self.weight), bias=self.bias)
+            result = self.base_forward(x)
             if self.r > 0:
                 if isinstance(self.lora_A, nn.ParameterList):
                     # 再加一个判断，在测试EMA状态的时候（self.fuse_type = 'ema'），则看第二个lora即ema_lora的输出
@@ -301,7 +374,7 @@ class Linear(nn.Linear, LoRALayer):
                         result += (self.lora_dropout(x) @ self.lora_A.T @ self.lora_B.T) * self.scaling
             return result
         else:
-            return F.linear(x, T(self.weight), bias=self.bias)
+            return self.base_forward(x)
 
 #no usage
 class MergedLinear(nn.Linear, LoRALayer):
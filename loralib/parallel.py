@@ -0,0 +1,189 @@
+#  ------------------------------------------------------------------------------------------
+#  Data parallel training of the trainable (adapter) tensors only
+#  ------------------------------------------------------------------------------------------
+import time
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+class CommStats:
+    """
+    Gradient communication time and volume, accumulated until reset(). CUDA reduces are timed with events that are
+    only read in summary(), so recording never blocks the host.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = 0.0
+        self.bytes = 0
+        self.calls = 0
+        self.pending = []
+
+    def add(self, seconds, nbytes):
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.calls += 1
+
+    def add_events(self, start_event, end_event, nbytes):
+        self.pending.append((start_event, end_event))
+        self.add(0.0, nbytes)
+
+    def summary(self):
+        for start_event, end_event in self.pending:
+            end_event.synchronize()
+            self.seconds += start_event.elapsed_time(end_event) / 1e3
+        self.pending = []
+        return {'comm_time': '{:.3f}'.format(self.seconds), 'comm_mb': '{:.1f}'.format(self.bytes / 2 ** 20),
+                'comm_calls': self.calls}
+
+
+def allreduce_hook(compress_dtype=None, stats=None):
+    """
+    DDP communication hook (register_comm_hook(state=None, hook=...)): averages the bucket in compress_dtype
+    (torch.float16 / torch.bfloat16, None keeps the gradient dtype) and records time and volume in stats. CUDA buckets
+    are timed with events like LoRADataParallel, the callback runs with the current stream waiting on the reduce.
+    """
+    def hook(process_group, bucket):
+        group = process_group if process_group is not None else dist.group.WORLD
+        buffer = bucket.buffer()
+        # divide before the cast and the reduce so fp16 values and sums stay in range
+        buffer.div_(group.size())
+        compressed = buffer.to(compress_dtype) if compress_dtype is not None else buffer
+        timed_on_cuda = stats is not None and buffer.is_cuda
+        if timed_on_cuda:
+            start_event, end_event = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.time()
+        fut = dist.all_reduce(compressed, group=group, async_op=True).get_future()
+
+        def decompress(fut):
+            if compressed is not buffer:
+                buffer.copy_(fut.value()[0])
+            if stats is not None:
+                nbytes = compressed.numel() * compressed.element_size()
+                if timed_on_cuda:
+                    end_event.record()
+                    stats.add_events(start_event, end_event, nbytes)
+                else:
+                    stats.add(time.time() - start, nbytes)
+            return buffer
+        return fut.then(decompress)
+    return hook
+
+
+class LoRADataParallel(nn.Module):
+    """
+    Replacement for DistributedDataParallel when only the LoRA tensors (and possibly a head) train:
+        - only parameters with requires_grad are registered; wrap after mark_only_lora_as_trainable
+        - no broadcast of the frozen weights at construction, every rank loads them from the same checkpoint;
+          the trainable tensors are broadcast from rank 0 since their init is rank-seeded
+        - static buckets fixed at construction and reduced once at the end of every backward, whichever parameters
+          that step used, so no autograd traversal for unused parameters and any number of forwards per backward
+
+    flat_buffers are the (flat_data, flat_grad) pairs of flatten_parameters(); their gradients are reduced in place in
+    slices of at most bucket_cap_mb. Other trainable tensors are packed into buckets of the same cap.
+
+    Communication options:
+        compress_dtype  reduce in torch.float16 / torch.bfloat16 instead of the gradient dtype
+        sync_every      reduce every k-th backward only, gradients accumulate locally in between and are averaged over
+                        the k steps; the optimizer must only step when `synced` (see train_nlvr.optimizer_step)
+    """
+    def __init__(self, module: nn.Module, flat_buffers=None, process_group=None, bucket_cap_mb: float = 25,
+                 compress_dtype=None, sync_every: int = 1):
+        super().__init__()
+        self.module = module
+        self.process_group = process_group
+        self.world_size = dist.get_world_size(process_group)
+        self.params = [p for p in module.parameters() if p.requires_grad]
+        self.compress_dtype = compress_dtype
+        self.sync_every = sync_every
+        self.backward_count = 0
+        self.synced = True
+        self.comm_stats = CommStats()
+
+        cap = bucket_cap_mb * 1024 * 1024
+        flat_buffers = flat_buffers or []
+        self.flat_grads = []
+        for _, flat_grad in flat_buffers:
+            self.flat_grads += list(flat_grad.split(max(1, int(cap // flat_grad.element_size()))))
+        flat_storages = {flat_grad.data_ptr() for _, flat_grad in flat_buffers}
+        in_flat = lambda p: p.grad is not None and p.grad.untyped_storage().data_ptr() in flat_storages
+
+        self.buckets = []
+        bucket, size = [], 0
+        for p in self.params:
+            if in_flat(p):
+                continue
+            if len(bucket) > 0 and (size + p.numel() * p.element_size() > cap or bucket[-1].dtype != p.dtype):
+                self.buckets.append(bucket)
+                bucket, size = [], 0
+            bucket.append(p)
+            size += p.numel() * p.element_size()
+        if len(bucket) > 0:
+            self.buckets.append(bucket)
+
+        with torch.no_grad():
+            for flat_data, _ in flat_buffers:
+                dist.broadcast(flat_data, src=0, group=process_group)
+            for bucket in self.buckets:
+                for p in bucket:
+                    dist.broadcast(p.data, src=0, group=process_group)
+
+        self._reduce_queued = False
+        for p in self.params:
+            p.register_hook(self._grad_hook)
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+    def _grad_hook(self, grad):
+        # first gradient of a backward pass, reduce once the engine has accumulated all of them
+        if not self._reduce_queued:
+            self._reduce_queued = True
+            torch.autograd.Variable._execution_engine.queue_callback(self._reduce_gradients)
+        return grad
+
+    def _all_reduce_(self, tensor):
+        # in-place average over ranks and accumulated steps, through a compressed copy if configured
+        buf = tensor.to(self.compress_dtype) if self.compress_dtype is not None else tensor
+        buf.div_(self.world_size * self.sync_every)
+        dist.all_reduce(buf, group=self.process_group)
+        if buf is not tensor:
+            tensor.copy_(buf)
+        return buf.numel() * buf.element_size()
+
+    @torch.no_grad()
+    def _reduce_gradients(self):
+        self._reduce_queued = False
+        self.backward_count += 1
+        self.synced = self.backward_count % self.sync_every == 0
+        if not self.synced:
+            return
+
+        # CUDA: events on the current stream, a host sync here would serialize the reduce with the next compute
+        on_cuda = len(self.params) > 0 and self.params[0].is_cuda
+        if on_cuda:
+            start_event, end_event = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.time()
+        nbytes = 0
+        for flat_grad in self.flat_grads:
+            nbytes += self._all_reduce_(flat_grad)
+        for bucket in self.buckets:
+            for p in bucket:
+                if p.grad is None:
+                    p.grad = torch.zeros_like(p)
+            grads = [p.grad for p in bucket]
+            coalesced = _flatten_dense_tensors(grads)
+            nbytes += self._all_reduce_(coalesced)
+            for g, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
+                g.copy_(synced)
+        if on_cuda:
+            end_event.record()
+            self.comm_stats.add_events(start_event, end_event, nbytes)
+        else:
+            self.comm_stats.add(time.time() - start, nbytes)
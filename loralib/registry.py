@@ -0,0 +1,49 @@
+#  ------------------------------------------------------------------------------------------
+#  Named adapter selections for a resident LoRA backbone
+#  ------------------------------------------------------------------------------------------
+from contextlib import contextmanager
+from typing import Dict
+
+
+class AdapterRegistry:
+    """
+    Maps adapter names to the agent state the LoRA layers read in their forward (fuse_type, model_task_id),
+    so one built model serves every adapter set and switching is an attribute swap instead of a rebuild.
+
+    Built-in names:
+        'current'  the adapter(s) being trained, all task adapters for multi-lora
+        'ema'      the EMA adapter (lora index 1) of EMA agents
+        'task<k>'  task adapters 0..k for multi-lora, e.g. 'task2'
+    Other selections can be added with register(name, **state).
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.selections: Dict[str, dict] = {
+            'current': {'model_task_id': 1e7},
+            'ema': {'fuse_type': 'ema', 'model_task_id': 1e7},
+        }
+
+    def register(self, name: str, **state):
+        self.selections[name] = state
+
+    def resolve(self, name: str) -> dict:
+        if name in self.selections:
+            return self.selections[name]
+        if name.startswith('task') and name[4:].isdigit():
+            return {'model_task_id': int(name[4:])}
+        raise KeyError(f'Unknown adapter selection: {name}')
+
+    def names(self):
+        return list(self.selections.keys()) + ['task%d' % t for t in range(self.agent.get_num_tasks())]
+
+    @contextmanager
+    def activate(self, name: str):
+        state = self.resolve(name)
+        saved = {k: getattr(self.agent, k) for k in state}
+        for k, v in state.items():
+            setattr(self.agent, k, v)
+        try:
+            yield self.agent
+        finally:
+            for k, v in saved.items():
+                setattr(self.agent, k, v)
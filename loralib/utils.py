@@ -8,10 +8,34 @@ import torch.nn as nn
 
 from typing import Dict
 
-from .layers import LoRALayer
+from .layers import LoRALayer, Linear, Embedding
 
 import torch.nn.init as init
 import math
+from functools import wraps
+
+
+# generation of the model weights: bumped by the in-place weight updates below and by checkpoint loads, so caches of
+# model outputs (models.embed_cache) compare one integer instead of walking the parameters on every forward
+_weights_generation = [0]
+
+
+def mark_weights_updated() -> None:
+    _weights_generation[0] += 1
+
+
+def weights_generation() -> int:
+    return _weights_generation[0]
+
+
+def updates_weights(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            mark_weights_updated()
+    return wrapper
 
 
 def mark_only_lora_as_trainable(model: nn.Module, bias: str = 'none') -> None:
@@ -38,6 +62,35 @@ def mark_only_lora_as_trainable(model: nn.Module, bias: str = 'none') -> None:
         raise NotImplementedError
 
 
+def flatten_parameters(params) -> list:
+    """
+    Packs the given parameters into one contiguous buffer per (device, dtype) and turns every
+    parameter and its gradient into a view of it. Returns (flat_data, flat_grad) pairs with
+    flat_data.grad = flat_grad: build the optimizer on the flat_data tensors, so its step and
+    zero_grad(set_to_none=False) run over a few flat tensors instead of one small tensor per LoRA
+    layer. Updates of the parameters must stay in place (param.data.copy_) to keep the views.
+    """
+    groups = {}
+    for p in params:
+        groups.setdefault((p.device, p.dtype), []).append(p)
+    flat_buffers = []
+    for (device, dtype), group in groups.items():
+        numel = sum(p.numel() for p in group)
+        flat_data = torch.empty(numel, device=device, dtype=dtype)
+        flat_grad = torch.zeros(numel, device=device, dtype=dtype)
+        offset = 0
+        for p in group:
+            n = p.numel()
+            flat_data[offset:offset + n].copy_(p.data.reshape(-1))
+            p.data = flat_data[offset:offset + n].view_as(p)
+            p.grad = flat_grad[offset:offset + n].view_as(p)
+            offset += n
+        flat_data.grad = flat_grad
+        flat_buffers.append((flat_data, flat_grad))
+    return flat_buffers
+
+
+@updates_weights
 def update_ema_task_lora(model: nn.Module,task_id, bias: str = 'none') -> None:
     lora0_params = {}
     # 第一遍遍历：收集lora0的参数
@@ -54,10 +107,11 @@ def update_ema_task_lora(model: nn.Module,task_id, bias: str = 'none') -> None:
         if name in lora0_params:
             # 将lora0的参数直接复制给lora1
             if task_id == 0:
-                param.data = lora0_params[name].data
+                param.data.copy_(lora0_params[name].data)
             else:
-                param.data = 1/(task_id+1) * lora0_params[name].data + (task_id)/ (task_id+1) * param.data
+                param.data.copy_(1/(task_id+1) * lora0_params[name].data + (task_id)/ (task_id+1) * param.data)
 
+@updates_weights
 def update_ema_epoch_lora(model: nn.Module,alpha,task_id,update_both, bias: str = 'none') -> None:
     lora0_params = {}
     # 第一遍遍历：收集lora0的参数
@@ -82,12 +136,13 @@ def update_ema_epoch_lora(model: nn.Module,alpha,task_id,update_both, bias: str
         if name in lora0_params:
             # 将lora0的参数直接复制给lora1
             if task_id == 0:
-                param.data = lora0_params[name].data
+                param.data.copy_(lora0_params[name].data)
             else:
-                param.data = (1-alpha) * lora0_params[name].data + alpha * param.data
+                param.data.copy_((1-alpha) * lora0_params[name].data + alpha * param.data)
 
 
 
+@updates_weights
 def update_ema_epoch_lora_B_merge(model: nn.Module,alpha,task_id,update_both, bias: str = 'none') -> None:
     lora0_params = {}
     # 第一遍遍历：收集lora0的参数
@@ -112,16 +167,17 @@ def update_ema_epoch_lora_B_merge(model: nn.Module,alpha,task_id,update_both, bi
         if name in lora0_params:
             # 将lora0的参数直接复制给lora1
             if task_id == 0:
-                param.data = lora0_params[name].data
+                param.data.copy_(lora0_params[name].data)
             else:
                 if 'lora_B.1' in name and update_both:
-                    param.data = (1 - alpha) * lora0_params[name].data + alpha * param.data
+                    param.data.copy_((1 - alpha) * lora0_params[name].data + alpha * param.data)
                 elif 'lora_B.1' in name and not update_both:
-                    param.data = lora0_params[name].data + param.data
+                    param.data.copy_(lora0_params[name].data + param.data)
                 else:
-                    param.data = (1-alpha) * lora0_params[name].data + alpha * param.data
+                    param.data.copy_((1-alpha) * lora0_params[name].data + alpha * param.data)
 
 
+@updates_weights
 def update_ema_epoch_mix_lora(model: nn.Module,alpha,task_id, bias: str = 'none') -> None:
     lora0_params = {}
     # 第一遍遍历：收集lora0的参数
@@ -138,10 +194,11 @@ def update_ema_epoch_mix_lora(model: nn.Module,alpha,task_id, bias: str = 'none'
         if name in lora0_params:
             # 将lora0的参数直接复制给lora1
             if task_id == 0:
-                param.data = lora0_params[name].data
+                param.data.copy_(lora0_params[name].data)
             else:
-                param.data = (1-alpha) * lora0_params[name].data + alpha * param.data
+                param.data.copy_((1-alpha) * lora0_params[name].data + alpha * param.data)
 
+@updates_weights
 def update_ema_task_mix_lora(model: nn.Module,task_id, bias: str = 'none') -> None:
     lora2_params = {}
     # 第一遍遍历：收集lora2的参数
@@ -158,10 +215,11 @@ def update_ema_task_mix_lora(model: nn.Module,task_id, bias: str = 'none') -> No
         if name in lora2_params:
             # 将lora0的参数直接复制给lora1
             if task_id == 0:
-                param.data = lora2_params[name].data
+                param.data.copy_(lora2_params[name].data)
             else:
-                param.data = 1/(task_id+1) * lora2_params[name].data + (task_id)/ (task_id+1) * param.data
+                param.data.copy_(1/(task_id+1) * lora2_params[name].data + (task_id)/ (task_id+1) * param.data)
 
+@updates_weights
 def lora_initial(model: nn.Module, bias: str = 'none') -> None:
     # 遍历模型的所有参数
     for name, param in model.named_parameters():
@@ -172,6 +230,7 @@ def lora_initial(model: nn.Module, bias: str = 'none') -> None:
             # 为lora_B.0初始化为零
             init.zeros_(param)
 
+@updates_weights
 def lora_initial_ema(model: nn.Module, bias: str = 'none') -> None:
     lora1_params = {}
     # 第一遍遍历：收集lora1的参数
@@ -187,7 +246,7 @@ def lora_initial_ema(model: nn.Module, bias: str = 'none') -> None:
     for name, param in model.named_parameters():
         if name in lora1_params:
             # 将lora0的参数直接复制给lora1
-            param.data = lora1_params[name].data
+            param.data.copy_(lora1_params[name].data)
 
 
 
@@ -209,3 +268,125 @@ def lora_state_dict(model: nn.Module, bias: str = 'none') -> Dict[str, torch.Ten
         return to_return
     else:
         raise NotImplementedError
+
+
+def select_lora_rank(S: torch.Tensor, threshold: float, criterion: str = 'energy') -> int:
+    # smallest rank keeping `threshold` of the spectral energy, or with relative Frobenius error <= `threshold`
+    energy = S.pow(2)
+    total = energy.sum()
+    if total <= 0:
+        return 1
+    kept = torch.cumsum(energy, dim=0) / total
+    if criterion == 'energy':
+        ok = kept >= threshold
+    elif criterion == 'error':
+        ok = (1.0 - kept).clamp(min=0).sqrt() <= threshold
+    else:
+        raise NotImplementedError(f'Unsupported compaction criterion: {criterion}')
+    ok[-1] = True
+    return int(torch.nonzero(ok)[0].item()) + 1
+
+
+@torch.no_grad()
+def compact_lora_factors(A: torch.Tensor, B: torch.Tensor, threshold: float, criterion: str = 'energy'):
+    """
+    Truncated SVD of the adapter delta B @ A without forming it: B and A^T are QR-factorized and only
+    the r x r core is decomposed. Returns the new (A, B) with the smallest rank meeting the threshold.
+    """
+    dtype = A.dtype
+    A, B = A.float(), B.float()
+    Q_B, R_B = torch.linalg.qr(B)
+    Q_A, R_A = torch.linalg.qr(A.T)
+    U, S, Vh = torch.linalg.svd(R_B @ R_A.T)
+    k = select_lora_rank(S, threshold, criterion)
+    sqrt_s = S[:k].sqrt()
+    new_B = (Q_B @ U[:, :k]) * sqrt_s
+    new_A = sqrt_s[:, None] * (Vh[:k] @ Q_A.T)
+    return new_A.to(dtype).contiguous(), new_B.to(dtype).contiguous()
+
+
+def compact_lora_state_dict(state_dict: Dict[str, torch.Tensor], threshold: float, criterion: str = 'energy'):
+    # returns the compacted state dict and the per-layer ranks keyed by the lora_A entry
+    lora_ranks = {}
+    for key in list(state_dict.keys()):
+        if 'lora_A' not in key:
+            continue
+        key_B = key.replace('lora_A', 'lora_B')
+        if key_B not in state_dict:
+            continue
+        state_dict[key], state_dict[key_B] = compact_lora_factors(state_dict[key], state_dict[key_B], threshold, criterion)
+        lora_ranks[key] = state_dict[key].shape[0]
+    return state_dict, lora_ranks
+
+
+@torch.no_grad()
+def time_lora_factors(factors, n_tokens: int = 256, repeats: int = 5) -> float:
+    # wall time of the unmerged adapter path x @ A.T @ B.T summed over all layers
+    import time
+    total = 0.0
+    for A, B in factors:
+        x = torch.randn(n_tokens, A.shape[1])
+        x @ A.float().T @ B.float().T
+        start = time.perf_counter()
+        for _ in range(repeats):
+            x @ A.float().T @ B.float().T
+        total += (time.perf_counter() - start) / repeats
+    return total
+
+
+def compact_lora_checkpoint(src: str, dst: str, threshold: float, criterion: str = 'energy') -> Dict[str, int]:
+    """
+    Writes a copy of checkpoint `src` whose adapters are SVD-truncated, with the per-layer ranks
+    stored under 'lora_ranks', and reports the rank per layer and the adapter-path speedup.
+    """
+    checkpoint = torch.load(src, map_location='cpu')
+    state_dict = checkpoint['model']
+    keys = [k for k in state_dict if 'lora_A' in k and k.replace('lora_A', 'lora_B') in state_dict]
+    before = [(state_dict[k], state_dict[k.replace('lora_A', 'lora_B')]) for k in keys]
+    state_dict, lora_ranks = compact_lora_state_dict(state_dict, threshold, criterion)
+    after = [(state_dict[k], state_dict[k.replace('lora_A', 'lora_B')]) for k in keys]
+
+    print(f'LoRA compaction of {src} ({criterion} threshold {threshold}):')
+    for k, (A, B) in zip(keys, before):
+        print(f'  {k}: rank {A.shape[0]} -> {lora_ranks[k]}')
+    flops_before = sum(A.shape[0] * (A.shape[1] + B.shape[0]) for A, B in before)
+    flops_after = sum(A.shape[0] * (A.shape[1] + B.shape[0]) for A, B in after)
+    time_before = time_lora_factors(before)
+    time_after = time_lora_factors(after)
+    print(f'  adapter FLOPs/params: {flops_before} -> {flops_after} ({flops_before / max(flops_after, 1):.2f}x)')
+    print(f'  adapter path time: {time_before * 1e3:.2f}ms -> {time_after * 1e3:.2f}ms '
+          f'({time_before / max(time_after, 1e-12):.2f}x)')
+
+    checkpoint['lora_ranks'] = lora_ranks
+    torch.save(checkpoint, dst)
+    return lora_ranks
+
+
+@updates_weights
+def resize_lora_(model: nn.Module, lora_ranks: Dict[str, int]) -> None:
+    # gives the adapters of `model` the (compacted) ranks of a checkpoint before loading it
+    for key_A, rank in lora_ranks.items():
+        for key in (key_A, key_A.replace('lora_A', 'lora_B')):
+            module_name, _, name = key.rpartition('.')
+            try:
+                owner = model.get_submodule(module_name)
+            except AttributeError:
+                continue
+            old = getattr(owner, name, None)
+            if old is None:
+                continue
+            shape = (rank, old.shape[1]) if key == key_A else (old.shape[0], rank)
+            if tuple(old.shape) != shape:
+                setattr(owner, name, nn.Parameter(old.new_zeros(shape), requires_grad=old.requires_grad))
+
+
+@updates_weights
+def quantize_base_weights_(model: nn.Module) -> None:
+    # weight-only int8 for the frozen base weights of every loralib Linear/Embedding in `model`
+    bytes_before, bytes_after = 0, 0
+    for m in model.modules():
+        if isinstance(m, (Linear, Embedding)) and not hasattr(m, 'weight_int8'):
+            bytes_before += m.weight.numel() * m.weight.element_size()
+            m.quantize_weight_()
+            bytes_after += m.weight_int8.numel() + m.weight_scale.numel() * m.weight_scale.element_size()
+    print(f'int8 base weights: {bytes_before / 2 ** 20:.1f}MB -> {bytes_after / 2 ** 20:.1f}MB')
@@ -17,6 +17,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import math
+import time
 
 import os
 from urllib.parse import urlparse
@@ -26,20 +27,30 @@ from functools import partial
 from models.vit import Block as SA_Block
 from timm.models.layers import trunc_normal_
 
-def init_tokenizer(multi_lingual=False):
-    if multi_lingual:
-        tokenizer = BertTokenizer.from_pretrained('bert-base-multilingual-uncased')
-    else:
-        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    tokenizer.add_special_tokens({'bos_token':'[DEC]'})
-    tokenizer.add_special_tokens({'additional_special_tokens':['[ENC]']})       
-    tokenizer.enc_token_id = tokenizer.additional_special_tokens_ids[0]  
-    return tokenizer
+# process-level tokenizer singletons, the tokenizers are only read after construction
+_tokenizers = {}
+
+def init_tokenizer(multi_lingual=False, name=None):
+    # name: HF model id or a local directory with a vocab.txt
+    name = name or ('bert-base-multilingual-uncased' if multi_lingual else 'bert-base-uncased')
+    if name not in _tokenizers:
+        start_time = time.time()
+        try:
+            # the local HF cache first, no network round trip when the files are there
+            tokenizer = BertTokenizer.from_pretrained(name, local_files_only=True)
+        except (OSError, ValueError):
+            tokenizer = BertTokenizer.from_pretrained(name)
+        tokenizer.add_special_tokens({'bos_token':'[DEC]'})
+        tokenizer.add_special_tokens({'additional_special_tokens':['[ENC]']})       
+        tokenizer.enc_token_id = tokenizer.additional_special_tokens_ids[0]  
+        _tokenizers[name] = tokenizer
+        print(f'Tokenizer {name} loaded in {time.time() - start_time:.2f}s')
+    return _tokenizers[name]
 
 
 def create_vit(vit, image_size, use_grad_checkpointing=False, ckpt_layer=0, drop_path_rate=0, agent=None):
         
-    assert vit in ['base', 'large'], "vit parameter must be base or large"
+    assert vit in ['base', 'large', 'tiny'], "vit parameter must be base, large or tiny"
     if vit=='base':
         vision_width = 768
         visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=12, 
@@ -54,6 +65,14 @@ def create_vit(vit, image_size, use_grad_checkpointing=False, ckpt_layer=0, drop
                                            drop_path_rate=0.1 or drop_path_rate,
                                            agent=agent
                                           )   
+    elif vit=='tiny':
+        # synthetic end-to-end runs on CPU only, see benchmarks/synthetic_e2e.py
+        vision_width = 192
+        visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=2,
+                                           num_heads=3, use_grad_checkpointing=use_grad_checkpointing, ckpt_layer=ckpt_layer,
+                                           drop_path_rate=0 or drop_path_rate,
+                                           agent=agent
+                                          )
     return visual_encoder, vision_width
 
 def is_url(url_or_filename):
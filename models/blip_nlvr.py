@@ -13,6 +13,7 @@ from models.vit import interpolate_pos_embed
 from models.blip import create_vit, init_tokenizer, is_url
 
 from timm.models.hub import download_cached_file
+from timm.models.layers import trunc_normal_
 
 import torch
 from torch import nn
@@ -20,6 +21,13 @@ import torch.nn.functional as F
 from transformers import BertTokenizer
 import numpy as np
 import os
+import math
+import time
+import copy
+from contextlib import contextmanager
+
+import loralib as lora
+import utils
 
 class BLIP_NLVR(nn.Module):
     def __init__(self,                 
@@ -29,18 +37,20 @@ class BLIP_NLVR(nn.Module):
                  vit_grad_ckpt = False,
                  vit_ckpt_layer = 0,  
                  agent = None,
-                 single_image_model = False
+                 single_image_model = False,
+                 tokenizer = None
                  ):
         """
         Args:
             med_config (str): path for the mixture of encoder-decoder model's configuration file
             image_size (int): input image size
             vit (str): model size of vision transformer
+            tokenizer (str): HF model id or local vocab directory, None for bert-base-uncased
         """               
         super().__init__()
         
         self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer, drop_path_rate=0.1, agent=agent)
-        self.tokenizer = init_tokenizer()
+        self.tokenizer = init_tokenizer(name=tokenizer)
 
         med_config = BertConfig.from_json_file(med_config)
         med_config.encoder_width = vision_width
@@ -56,50 +66,64 @@ class BLIP_NLVR(nn.Module):
                   nn.Linear(self.text_encoder.config.hidden_size, 2)
                 )  
 
+        # optional models.embed_cache.ImageEmbedCache, used by inference forwards only
+        self.embed_cache = None
+
+    def encode_image(self, image, agent=None):
+        if self.embed_cache is not None and self.training:
+            # optimizer steps are not tracked by lora.weights_generation
+            self.embed_cache.clear()
+        if self.embed_cache is None or self.training or torch.is_grad_enabled():
+            return self.visual_encoder(image)
+        return self.embed_cache.encode(self.visual_encoder, image, agent)
+
     def forward(self, image, text, targets, train=True, agent=None, feature_forward=False, train_zsl = False):
 
         origin_text = text
 
-        image_embeds = self.visual_encoder(image) 
+        with utils.profile_region('vit'):
+            image_embeds = self.encode_image(image, agent)
         image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
         if not self.single_image_model:
             image0_embeds, image1_embeds = torch.split(image_embeds,targets.size(0))
 
         blip_enc_token_id = None # currently the sequence of tokenizers is required to have blip as one of them, otherwise a new token needs to be found
-        if not isinstance(self.tokenizer, list):
-            text = self.tokenizer(text, padding='longest', return_tensors="pt").to(image.device)
-            text_input_ids = text.input_ids
-            text_attention_mask = text.attention_mask
-            blip_enc_token_id = self.tokenizer.enc_token_id
-        else:
-            text_ = []
-            for tok in self.tokenizer:
-                text_.append(tok[0](text, padding='longest', return_tensors="pt").to(image.device))
-                text_[-1].input_ids[text_[-1].input_ids != 0] += tok[2]
-                if tok[-1] == 'blip':
-                    blip_enc_token_id = tok[0].enc_token_id + tok[2]
-            text_input_ids = torch.cat([x.input_ids for x in text_], dim=1)
-            text_attention_mask = torch.cat([x.attention_mask for x in text_], dim=1)
+        with utils.profile_region('tokenize'):
+            if not isinstance(self.tokenizer, list):
+                text = self.tokenizer(text, padding='longest', return_tensors="pt").to(image.device)
+                text_input_ids = text.input_ids
+                text_attention_mask = text.attention_mask
+                blip_enc_token_id = self.tokenizer.enc_token_id
+            else:
+                text_ = []
+                for tok in self.tokenizer:
+                    text_.append(tok[0](text, padding='longest', return_tensors="pt").to(image.device))
+                    text_[-1].input_ids[text_[-1].input_ids != 0] += tok[2]
+                    if tok[-1] == 'blip':
+                        blip_enc_token_id = tok[0].enc_token_id + tok[2]
+                text_input_ids = torch.cat([x.input_ids for x in text_], dim=1)
+                text_attention_mask = torch.cat([x.attention_mask for x in text_], dim=1)
 
         assert blip_enc_token_id is not None
         text_input_ids[:,0] = blip_enc_token_id
         # print(text.input_ids[:,0:10])   
 
-        if self.single_image_model:
-            output = self.text_encoder(text_input_ids,
-                                       attention_mask=text_attention_mask,
-                                       encoder_hidden_states=image_embeds,
-                                       encoder_attention_mask=image_atts,
-                                       return_dict=True,
-                                       )
-        else:
-            output = self.text_encoder(text_input_ids,
-                                       attention_mask = text_attention_mask,
-                                       encoder_hidden_states = [image0_embeds,image1_embeds],
-                                       encoder_attention_mask = [image_atts[:image0_embeds.size(0)],
-                                                                 image_atts[image0_embeds.size(0):]],
-                                       return_dict = True,
-                                      )
+        with utils.profile_region('text_encoder'):
+            if self.single_image_model:
+                output = self.text_encoder(text_input_ids,
+                                           attention_mask=text_attention_mask,
+                                           encoder_hidden_states=image_embeds,
+                                           encoder_attention_mask=image_atts,
+                                           return_dict=True,
+                                           )
+            else:
+                output = self.text_encoder(text_input_ids,
+                                           attention_mask = text_attention_mask,
+                                           encoder_hidden_states = [image0_embeds,image1_embeds],
+                                           encoder_attention_mask = [image_atts[:image0_embeds.size(0)],
+                                                                     image_atts[image0_embeds.size(0):]],
+                                           return_dict = True,
+                                          )
         #current lora feature
 
         hidden_state = output.last_hidden_state[:,0,:]        
@@ -164,7 +188,7 @@ class BLIP_NLVR(nn.Module):
 
                         fuse_type = agent.fuse_type
                         agent.fuse_type = 'ema'
-                        with torch.no_grad():
+                        with torch.no_grad(), utils.profile_region('teacher'):
                             image_embeds = self.visual_encoder(image)
                             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
                             if not self.single_image_model:
@@ -224,7 +248,7 @@ class BLIP_NLVR(nn.Module):
 
                         fuse_type = agent.fuse_type
                         agent.fuse_type = 'ema'
-                        with torch.no_grad():
+                        with torch.no_grad(), utils.profile_region('teacher'):
                             image_embeds = self.visual_encoder(image)
                             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
                             if not self.single_image_model:
@@ -301,7 +325,7 @@ class BLIP_NLVR(nn.Module):
                         #     alpha /= agent.task_id
 
                         agent.prep_model4task(agent.task_id - 1, force=True)
-                        with torch.no_grad():
+                        with torch.no_grad(), utils.profile_region('teacher'):
                             image_embeds = self.visual_encoder(image)
                             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
                             if not self.single_image_model:
@@ -363,7 +387,7 @@ class BLIP_NLVR(nn.Module):
                             alpha /= agent.task_id
                         fuse_type = agent.fuse_type
                         agent.fuse_type = 'ema'
-                        with torch.no_grad():
+                        with torch.no_grad(), utils.profile_region('teacher'):
                             image_embeds = self.visual_encoder(image)
                             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
                             if not self.single_image_model:
@@ -429,7 +453,7 @@ class BLIP_NLVR(nn.Module):
                             base_text_emb = self.text_encoder._embed_only(text_input_ids).detach()
                         for task_id in range(agent.task_id):
                             agent.prep_model4task(task_id, force=True)
-                            with torch.no_grad():
+                            with torch.no_grad(), utils.profile_region('teacher'):
                                 image_embeds = self.visual_encoder(image)
                                 image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
                                 if not self.single_image_model:
@@ -523,20 +547,151 @@ class BLIP_NLVR(nn.Module):
         agent.prep_model4task(-1)
         return image_embeds_q, text_embeds_q
     
-def blip_nlvr(pretrained='',**kwargs):
-    model = BLIP_NLVR(**kwargs)
+# meta-device module trees keyed by everything that shapes them, reused by every skip_init build of the process
+_skeletons = {}
+
+def skeleton_key(kwargs):
+    agent = kwargs.get('agent')
+    agent_key = None
+    if agent is not None:
+        agent_key = (type(agent).__name__, agent.lora, agent.r, agent.multi, agent.ema, agent.type, agent.ada_weights,
+                     agent.get_num_tasks(), getattr(agent.args, 'freeze_text_emb', None))
+    return repr(sorted((k, v) for k, v in kwargs.items() if k != 'agent')), agent_key
+
+def build_from_skeleton(kwargs):
+    # deep copy of the cached meta skeleton, the agent and the tokenizer are shared instead of copied
+    key = skeleton_key(kwargs)
+    if key not in _skeletons:
+        with init_empty_weights():
+            _skeletons[key] = (BLIP_NLVR(**kwargs), kwargs.get('agent'))
+    skeleton, skeleton_agent = _skeletons[key]
+    memo = {id(skeleton.tokenizer): skeleton.tokenizer, id(skeleton_agent): kwargs.get('agent')}
+    return copy.deepcopy(skeleton, memo)
+
+def blip_nlvr(pretrained='', skip_init=False, **kwargs):
+    start_time = time.time()
+    skip_init = skip_init and bool(pretrained)
+    if skip_init:
+        # the checkpoint chain overwrites almost every tensor, so only allocate them here
+        model = build_from_skeleton(kwargs)
+        materialize_empty_weights(model)
+    else:
+        model = BLIP_NLVR(**kwargs)
+    print(f'Model construction time: {time.time() - start_time:.2f}s (skip_init={skip_init})')
     head_not_loaded = True
     if pretrained:
-        model,msg = load_checkpoint(model,pretrained)
+        loaded_keys = set()
+        model,msg = load_checkpoint(model,pretrained,loaded_keys=loaded_keys)
+        if skip_init:
+            init_unloaded_parameters(model, loaded_keys)
         print("missing keys:")
         print(msg.missing_keys)
         head_not_loaded = False
         for k in msg.missing_keys:
             if 'cls_head' in k:
                 head_not_loaded = True
+    print(f'Model ready time: {time.time() - start_time:.2f}s (skip_init={skip_init})')
     return model, head_not_loaded
 
-def load_checkpoint(model, url_or_filename_list):
+
+@contextmanager
+def init_empty_weights():
+    """
+    Registers every parameter created inside the context on the meta device, so that the
+    random initialisation of ViT, BERT and loralib layers costs nothing. Buffers (e.g. the
+    BERT position_ids) are kept as they are.
+    """
+    old_register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        old_register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = nn.Parameter(param.to(torch.device('meta')),
+                                                    requires_grad=param.requires_grad)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = old_register_parameter
+
+
+def materialize_empty_weights(model, device='cpu'):
+    # allocate (but do not initialise) storage for the meta parameters, keeping shared parameters shared
+    materialized = {}
+    for module in model.modules():
+        for name, param in module._parameters.items():
+            if param is None or not param.is_meta:
+                continue
+            if id(param) not in materialized:
+                materialized[id(param)] = nn.Parameter(torch.empty_like(param, device=device),
+                                                       requires_grad=param.requires_grad)
+            module._parameters[name] = materialized[id(param)]
+    return model
+
+
+@torch.no_grad()
+def init_unloaded_parameters(model, loaded_keys):
+    """
+    Initialises the parameters that no checkpoint of the chain provided (LoRA adapters, new heads)
+    the same way a fully initialised BLIP_NLVR would have.
+    """
+    initialised = set()
+    for name, param in model.named_parameters():
+        if name in loaded_keys:
+            continue
+        module_name = name.rpartition('.')[0]
+        if 'lora_ada_weights' in name:
+            param.fill_(1.0)
+        elif 'lora_' in name:
+            if name.startswith('visual_encoder.'):
+                trunc_normal_(param, std=math.sqrt(.02))
+            else:
+                param.normal_(mean=0.0, std=model.text_encoder.config.initializer_range)
+        elif module_name not in initialised:
+            initialised.add(module_name)
+            owner = model.get_submodule(module_name)
+            if isinstance(owner, lora.LoRALayer):
+                raise RuntimeError(f'{name} is a frozen base weight and must be provided by the checkpoint when using skip_init')
+            if module_name.startswith('visual_encoder.'):
+                model.visual_encoder._init_weights(owner)
+            elif module_name.startswith('text_encoder.'):
+                model.text_encoder._init_weights(owner)
+            elif hasattr(owner, 'reset_parameters'):
+                owner.reset_parameters()
+            else:
+                trunc_normal_(param, std=.02)
+
+def remap_crossattention_keys(state_dict, single_image_model):
+    # in place: the single-image model reads the first cross-attention branch, the NLVR model two copies of it
+    if single_image_model:
+        for key in list(state_dict.keys()):
+            if 'crossattention.self' in key:
+                new_key0 = key.replace('self0', 'self')
+                # new_key1 = key.replace('self','self1')
+                state_dict[new_key0] = state_dict[key]
+                # state_dict[new_key1] = state_dict[key]
+            elif 'crossattention.output.dense' in key:
+                new_key0 = key.replace('dense0', 'dense')
+                # new_key1 = key.replace('dense','dense1')
+                state_dict[new_key0] = state_dict[key]
+                # state_dict[new_key1] = state_dict[key]
+        # pass
+    else:
+        for key in list(state_dict.keys()):
+            if 'crossattention.self.' in key:
+                new_key0 = key.replace('self','self0')
+                new_key1 = key.replace('self','self1')
+                state_dict[new_key0] = state_dict[key]
+                state_dict[new_key1] = state_dict[key]
+            elif 'crossattention.output.dense.' in key:
+                new_key0 = key.replace('dense','dense0')
+                new_key1 = key.replace('dense','dense1')
+                state_dict[new_key0] = state_dict[key]
+                state_dict[new_key1] = state_dict[key]
+
+
+def load_checkpoint(model, url_or_filename_list, loaded_keys=None):
 
     if not isinstance(url_or_filename_list, list):
         url_or_filename_list = [url_or_filename_list]
@@ -551,34 +706,15 @@ def load_checkpoint(model, url_or_filename_list):
             else:
                 raise RuntimeError('checkpoint url or path is invalid')
             state_dict = checkpoint['model']
-            
+
+            for key in [k for k in state_dict.keys() if k.endswith('.weight_int8')]:
+                # int8 base weight saved by an --int8_backbone run, dequantized for the float model
+                prefix = key[:-len('weight_int8')]
+                state_dict[prefix + 'weight'] = state_dict.pop(key).float() * state_dict.pop(prefix + 'weight_scale')[:, None]
+
             state_dict['visual_encoder.pos_embed'] = interpolate_pos_embed(state_dict['visual_encoder.pos_embed'],model.visual_encoder) 
 
-            if hasattr(model, 'single_image_model') and model.single_image_model:
-                for key in list(state_dict.keys()):
-                    if 'crossattention.self' in key:
-                        new_key0 = key.replace('self0', 'self')
-                        # new_key1 = key.replace('self','self1')
-                        state_dict[new_key0] = state_dict[key]
-                        # state_dict[new_key1] = state_dict[key]
-                    elif 'crossattention.output.dense' in key:
-                        new_key0 = key.replace('dense0', 'dense')
-                        # new_key1 = key.replace('dense','dense1')
-                        state_dict[new_key0] = state_dict[key]
-                        # state_dict[new_key1] = state_dict[key]
-                # pass
-            else:
-                for key in list(state_dict.keys()):
-                    if 'crossattention.self.' in key:
-                        new_key0 = key.replace('self','self0')
-                        new_key1 = key.replace('self','self1')
-                        state_dict[new_key0] = state_dict[key]
-                        state_dict[new_key1] = state_dict[key]
-                    elif 'crossattention.output.dense.' in key:
-                        new_key0 = key.replace('dense','dense0')
-                        new_key1 = key.replace('dense','dense1')
-                        state_dict[new_key0] = state_dict[key]
-                        state_dict[new_key1] = state_dict[key]
+            remap_crossattention_keys(state_dict, getattr(model, 'single_image_model', False))
                  
             if isinstance(model.tokenizer, list):
                 blip_w = state_dict['text_encoder.embeddings.word_embeddings.weight']
@@ -587,6 +723,10 @@ def load_checkpoint(model, url_or_filename_list):
                     new_weights = torch.cat(toks_w, dim=0).detach()
                     state_dict['text_encoder.embeddings.word_embeddings.weight'] = new_weights
 
+            if 'lora_ranks' in checkpoint:
+                # rank-compacted checkpoint, the adapters take its per-layer ranks
+                lora.resize_lora_(model, checkpoint['lora_ranks'])
+
             mdsd = model.state_dict()
             sdk = state_dict.keys()
             for key in mdsd.keys():
@@ -601,6 +741,9 @@ def load_checkpoint(model, url_or_filename_list):
                         state_dict[key] = state_dict[key_]
                         del state_dict[key_]
 
+            if loaded_keys is not None:
+                loaded_keys.update(key for key in state_dict.keys() if key in mdsd)
+
             if False:
                 if url_or_filename != url_or_filename_list[0]:
                     diff_w = []
@@ -617,6 +760,7 @@ def load_checkpoint(model, url_or_filename_list):
 
             msg = model.load_state_dict(state_dict,strict=False)
             print('load checkpoint from %s'%url_or_filename)  
+    lora.mark_weights_updated()
     return model,msg
             
 
@@ -627,50 +771,43 @@ def _KD_loss(pred, soft, T):
 
 
 def grassmann_distance_torch(A, B):
-
+    # A, B: (..., r, d), leading dims are batched
     Q_A, _ = torch.linalg.qr(A)
     Q_B, _ = torch.linalg.qr(B)
 
-    M = torch.matmul(Q_A.T, Q_B)
+    M = torch.matmul(Q_A.transpose(-2, -1), Q_B)
 
     # 步骤3: 计算M的奇异值分解，得到奇异值
-    _, S, _ = torch.linalg.svd(M)
+    S = torch.linalg.svdvals(M)
 
     epsilon = 1e-10
     sin_theta_squared = 1.0 - (S + epsilon) ** 2
 
-    distance = torch.sqrt(torch.sum(sin_theta_squared))
-
-    print("Q_A:", torch.isnan(Q_A).any())
-    print("Q_B:", torch.isnan(Q_B).any())
-    print("M:", torch.isnan(M).any())
-    print("S:", torch.isnan(S).any())
-    print("sin_theta_squared:", torch.isnan(sin_theta_squared).any())
+    distance = torch.sqrt(torch.sum(sin_theta_squared, dim=-1))
 
     return distance
 
 def count_encoder_lora_distance(lora_model,image):
-    count = 0
-    lora1_params = {}
-    with torch.no_grad():
-        for name, param in lora_model.named_parameters():
-            if 'lora_A.1' in name:
-                # 以新的键存储参数，将'.1'替换为'.0'以便后续匹配lora0
-                lora1_params[name.replace('lora_A.1', 'lora_A.0')] = param.clone()
-
-    total_distance = torch.zeros((1,), requires_grad=True).to(image.device)
-
-    for name, param in lora_model.named_parameters():
-        if name in lora1_params:
-            count += 1
-            # 计算该lora的距离，不进行原地操作
-            current_distance = grassmann_distance_torch(param, lora1_params[name])
-            # 累加到total_distance中，不使用原地加法
-            total_distance = torch.add(total_distance, current_distance, alpha=1)
-
-    # 计算平均距离，这里不需要梯度
-    avg_distance = total_distance / count
-    # print(avg_distance)
+    # pair every trained lora_A.0 with its EMA lora_A.1 and group the pairs by shape,
+    # each group is one batched QR/SVD instead of a python loop over layers
+    params = dict(lora_model.named_parameters())
+    groups = {}
+    for name, param in params.items():
+        name_ema = name.replace('lora_A.0', 'lora_A.1')
+        if 'lora_A.0' in name and name_ema in params:
+            current, ema = groups.setdefault(tuple(param.shape), ([], []))
+            current.append(param)
+            ema.append(params[name_ema].detach())
+
+    count = sum(len(current) for current, _ in groups.values())
+    if count == 0:
+        return torch.zeros((1,), device=image.device)
+
+    total_distance = sum(grassmann_distance_torch(torch.stack(current), torch.stack(ema)).sum()
+                         for current, ema in groups.values())
+
+    # 计算平均距离
+    avg_distance = (total_distance / count).reshape(1)
 
     return avg_distance
 
@@ -0,0 +1,103 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+import loralib as lora
+
+
+def content_hash(image):
+    # the preprocessed tensor, so the transform (size, normalization) is part of the content
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{tuple(image.shape)}{image.dtype}'.encode())
+    h.update(image.contiguous().numpy().tobytes())
+    return h.digest()
+
+
+def adapter_selection(agent):
+    # the agent state the LoRA layers read, i.e. what AdapterRegistry.activate switches
+    if agent is None:
+        return None
+    return (agent.fuse_type, agent.model_task_id, agent.ada_weights, agent.get_num_tasks())
+
+
+def weights_version(module):
+    # loralib bumps the generation on EMA updates, adapter (re)initialization, quantization and checkpoint loads
+    return id(module), lora.weights_generation()
+
+
+class ImageEmbedCache:
+    """
+    LRU cache of visual_encoder outputs for inference, bounded by bytes. Entries are keyed by (adapter selection,
+    content hash of the preprocessed image); every entry is dropped when lora.weights_generation moves on or the model
+    runs in training mode. Other weight edits (a manual load_state_dict, optimizer steps outside model.train()) need
+    an explicit clear(). Rows repeated inside one batch (POS and NEG captions of one vl_checklist image) are encoded
+    once as well.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def put(self, key, embeds):
+        size = embeds.numel() * embeds.element_size()
+        if size > self.max_bytes:
+            return
+        self.entries[key] = embeds
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
+            self.evictions += 1
+
+    def encode(self, visual_encoder, image, agent=None):
+        version = weights_version(visual_encoder)
+        if version != self.version:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.clear()
+            self.version = version
+
+        selection = adapter_selection(agent)
+        keys = [(selection, content_hash(x)) for x in image.detach().cpu()]
+        rows = [None] * len(keys)
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                rows[i] = self.entries[key]
+            else:
+                missing.setdefault(key, []).append(i)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            image_embeds = visual_encoder(image[[indices[0] for indices in missing.values()]])
+            for (key, indices), embeds in zip(missing.items(), image_embeds):
+                # own storage, a view would keep the whole batch alive
+                embeds = embeds.clone()
+                self.put(key, embeds)
+                for i in indices:
+                    rows[i] = embeds
+        return torch.stack(rows)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'mb': round(self.bytes / 2 ** 20, 1),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -1,14 +1,19 @@
+import time
+STARTUP_TIME = time.time()
+
 import os
 import sys
 import argparse
 import numpy as np
 import yaml
 import random
+import copy
 import agents
 import task_trainers
 import utils
+import loralib as lora
+from telemetry import telemetry
 from pathlib import Path
-import time
 import datetime
 
 import torch
@@ -17,14 +22,43 @@ import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 from torch.utils.data import DataLoader
+IMPORT_TIME = time.time() - STARTUP_TIME
 
 SEED = 0
 REVALUATE_FLAG = False
 
 
+# one cl_matrix column through the single-session engine, for every seen task without a cached result
+def evaluate_round(agent, eval_args, task_list):
+    pending = []
+    for t in range(agent.task_id + 1):
+        task = str(t) + '_' + task_list[t]['name']
+        out_dir = os.path.join(agent.task_dir_dict[task], '_eval-only_' + str(agent.task_id))
+        if utils.is_main_process(): Path(out_dir).mkdir(parents=True, exist_ok=True)
+        result_file = os.path.join(out_dir, 'final_result.yaml')
+        if not REVALUATE_FLAG and os.path.exists(result_file):
+            try:
+                if yaml.safe_load(open(result_file, 'r'))['result'] > 0:
+                    continue
+            except:
+                pass
+        pending.append((t, task, out_dir))
+    trainers = set(task_list[t]['trainer'] for t, _, _ in pending)
+    if len(pending) == 0 or len(trainers) > 1:
+        return {}
+
+    round_args = dict(eval_args, pretrained=agent.get_eval_ckpt_list())
+    results = getattr(task_trainers, trainers.pop()).evaluate_round(args=round_args,
+                                                                  configs=[agent.task_config_dict[task] for _, task, _ in pending],
+                                                                  out_dirs=[out_dir for _, _, out_dir in pending])
+    return {t: result for (t, _, _), result in zip(pending, results)}
+
+
 # evaluate on all tasks seen
 def evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, oracle_results, lb_exists, lb_results,
                    eval_ema):
+    # adapter selection on the resident model, see loralib.AdapterRegistry
+    eval_args['adapter'] = 'ema' if eval_ema else 'current'
     # Oracle/LB only evaluates on current task
     if agent.oracle:
 
@@ -36,7 +70,7 @@ def evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, orac
         if eval_args['lb']:
             eval_args['pretrained'] = agent.model_ckpt_history['pretrained']
         else:
-            eval_args['pretrained'] = agent.model_ckpt_history[task]
+            eval_args['pretrained'] = agent.model_ckpt_compact.get(task, agent.model_ckpt_history[task])
 
         # evaluate the task
         result_file = os.path.join(out_dir, 'final_result.yaml')
@@ -52,7 +86,7 @@ def evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, orac
                 except:
                     will_proceed = True
         if will_proceed:
-            result = task_trainers.__dict__[task_list[agent.task_id]['trainer']].main(args=eval_args,
+            result = getattr(task_trainers, task_list[agent.task_id]['trainer']).main(args=eval_args,
                                                                                       config=agent.task_config_dict[
                                                                                           task], eval=True,
                                                                                       test_ema=eval_ema)
@@ -67,13 +101,16 @@ def evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, orac
     # evaluate on all seen tasks
     else:
         acc_norm = []
+        engine_results = {}
+        if eval_args['eval_engine'] or eval_args['task_parallel_eval']:
+            engine_results = evaluate_round(agent, eval_args, task_list)
         for t in range(agent.task_id + 1):
             # prepare task files
             task = str(t) + '_' + task_list[t]['name']
             out_dir = os.path.join(agent.task_dir_dict[task], '_eval-only_' + str(agent.task_id))
             if utils.is_main_process(): Path(out_dir).mkdir(parents=True, exist_ok=True)
             eval_args['out_dir'] = out_dir
-            eval_args['pretrained'] = agent.model_ckpt_list
+            eval_args['pretrained'] = agent.get_eval_ckpt_list()
 
             # evaluate the task
             result_file = os.path.join(out_dir, 'final_result.yaml')
@@ -90,9 +127,12 @@ def evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, orac
                         will_proceed = True
             if will_proceed:
 
-                result = task_trainers.__dict__[task_list[t]['trainer']].main(args=eval_args,
-                                                                              config=agent.task_config_dict[task],
-                                                                              eval=True, test_ema=eval_ema)
+                if t in engine_results:
+                    result = engine_results[t]
+                else:
+                    result = getattr(task_trainers, task_list[t]['trainer']).main(args=eval_args,
+                                                                                  config=agent.task_config_dict[task],
+                                                                                  eval=True, test_ema=eval_ema)
 
                 # process the task results
                 if utils.is_main_process():
@@ -127,6 +167,36 @@ def evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, orac
     return result_dict
 
 
+# background evaluator for --async_eval: a single-process group on a snapshot of the agent and its checkpoint list,
+# it leaves the final_result.yaml files behind, evaluate_tasks picks them up when the round is assembled. Its
+# eval_round event is appended to the telemetry file of the run, in the round's task context
+def async_evaluate_round(agent, eval_args, task_list, init_file, telemetry_file, run):
+    dist.init_process_group(backend='gloo', init_method='file://' + init_file, world_size=1, rank=0)
+    if eval_args['device'].type == 'cuda' and eval_args.get('gpu') is not None:
+        torch.cuda.set_device(eval_args['gpu'])
+    telemetry.open(telemetry_file)
+    eval_args = dict(eval_args, distributed=False, task_parallel_eval=False, agent=agent)
+    result_dict = {'cl_matrix': [[] for _ in task_list]}
+    with telemetry.timed('eval_round', task=agent.task_id, tasks=agent.task_id + 1,
+                         adapter='ema' if agent.ema else 'current', engine=eval_args['eval_engine'], run=run,
+                         async_eval=True):
+        evaluate_tasks(agent, result_dict, eval_args, task_list, False, None, False, None, agent.ema)
+    dist.destroy_process_group()
+
+
+def save_results(args, result_dict, result_keys, t):
+    if utils.is_main_process():
+        save_dir = args.result_dir
+        for rkey in result_keys:
+            with open(os.path.join(save_dir, rkey + ".yaml"), 'w') as yaml_file:
+                yaml.dump(result_dict[rkey], yaml_file, default_flow_style=False)
+        save_dir = os.path.join(args.result_dir, f'task_{t:02d}')
+        os.makedirs(save_dir, exist_ok=True)
+        for rkey in result_keys:
+            with open(os.path.join(save_dir, rkey + ".yaml"), 'w') as yaml_file:
+                yaml.dump(result_dict[rkey], yaml_file, default_flow_style=False)
+
+
 # train on task sequence
 def trainer(args, configs, zs_config):
     # fix the seed for reproducibility
@@ -139,8 +209,72 @@ def trainer(args, configs, zs_config):
 
     # init world
     utils.init_distributed_mode(args)
+    utils.step_profiler.configure(args.profile_steps, args.profile_trace_task,
+                                  tuple(int(x) for x in args.profile_trace_steps.split(':')))
+    telemetry.open(os.path.join(args.output_dir, 'telemetry.jsonl'), every=args.telemetry_every,
+                   world_size=utils.get_world_size(), is_main=utils.is_main_process())
     device = torch.device(args.device)
 
+    for request in task_sequence(args, configs, zs_config, device):
+        if request is not None:
+            trainer_name, task_args, task_config = request
+            getattr(task_trainers, trainer_name).main(args=task_args, config=task_config, eval=False, test_ema=False)
+
+
+# train several agent configurations on one data pipeline, each member of args.cotrain_config overrides args and
+# writes to <output_dir>/<name>
+def cotrainer(args, configs, zs_config):
+    # fix the seed for reproducibility
+    torch.backends.cudnn.deterministic = True
+    seed = SEED + utils.get_rank()
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+    cudnn.benchmark = True
+
+    # init world
+    utils.init_distributed_mode(args)
+    utils.step_profiler.configure(args.profile_steps, args.profile_trace_task,
+                                  tuple(int(x) for x in args.profile_trace_steps.split(':')))
+    telemetry.open(os.path.join(args.output_dir, 'telemetry.jsonl'), every=args.telemetry_every,
+                   world_size=utils.get_world_size(), is_main=utils.is_main_process())
+    device = torch.device(args.device)
+
+    members = yaml.safe_load(open(args.cotrain_config, 'r'))['members']
+    sequences = []
+    for member in members:
+        member_args = copy.deepcopy(args)
+        for k, v in member.items():
+            if k != 'name':
+                assert hasattr(member_args, k), f'Unknown argument in co-training member {member["name"]}: {k}'
+                setattr(member_args, k, v)
+        member_args.output_dir = os.path.join(args.output_dir, member['name'])
+        member_args.result_dir = os.path.join(member_args.output_dir, 'final_results')
+        Path(member_args.result_dir).mkdir(parents=True, exist_ok=True)
+        yaml.dump(member_args, open(os.path.join(member_args.output_dir, 'args.yaml'), 'w'))
+        sequences.append(task_sequence(member_args, configs, zs_config, device))
+
+    # the sequences advance in lockstep, one task at a time; every generator is advanced each round (zip would stop
+    # at the first exhausted one and leave the others suspended before the evaluation of their last task)
+    while True:
+        requests = [next(sequence, _DONE) for sequence in sequences]
+        if any(request is _DONE for request in requests):
+            assert all(request is _DONE for request in requests), 'Co-training members finished on different tasks'
+            break
+        pending = [request for request in requests if request is not None]
+        if len(pending) > 0:
+            trainer_names = set(request[0] for request in pending)
+            assert len(trainer_names) == 1
+            getattr(task_trainers, trainer_names.pop()).cotrain(members=[request[1:] for request in pending])
+
+
+# end of a task sequence in cotrainer
+_DONE = object()
+
+
+# one run over the task sequence, a generator: for every task it yields (trainer, task_args, task_config) when the task
+# still has to be trained (None otherwise) and continues with evaluation once the caller has trained it
+def task_sequence(args, configs, zs_config, device):
     # create agent
     agent_config = {
         'output_dir': args.output_dir,
@@ -154,6 +288,8 @@ def trainer(args, configs, zs_config):
         'type': args.ema
     }
     agent = agents.__dict__[args.agent_type].__dict__[args.agent_name](agent_config)
+    if utils.is_main_process():
+        print(f'Startup: imports {IMPORT_TIME:.2f}s, agent ready {time.time() - STARTUP_TIME:.2f}s after start')
 
     # get tasks
     task_list = configs['task_list']
@@ -197,6 +333,32 @@ def trainer(args, configs, zs_config):
     result_dict['avg_acc_norm'] = [-1 for t in range(n_tasks)]
     result_dict['avg_forgetting'] = [-1 for t in range(n_tasks)]
 
+    # --async_eval rounds still to be assembled, in task order
+    async_rounds = []
+
+    def assemble_async_rounds(block):
+        # rank 0 owns the evaluator processes and decides how many leading rounds are done, so all ranks agree
+        n_done = 0
+        if utils.is_main_process():
+            for r in async_rounds:
+                if block:
+                    r['process'].join()
+                if r['process'].is_alive():
+                    break
+                n_done += 1
+        n_done = [n_done]
+        dist.broadcast_object_list(n_done, src=0)
+        for r in async_rounds[:n_done[0]]:
+            if utils.is_main_process():
+                r['process'].join()
+                if r['process'].exitcode != 0:
+                    print(f"Async evaluation of task {r['t']} failed, missing results are evaluated now")
+            # results come from the evaluator's final_result.yaml files
+            evaluate_tasks(r['agent'], result_dict, r['eval_args'], task_list, oracle_exists, oracle_results,
+                           lb_exists, lb_results, r['agent'].ema)
+            save_results(args, result_dict, result_keys, r['t'])
+        del async_rounds[:n_done[0]]
+
     # increment over tasks
     for t in range(n_tasks):
 
@@ -207,6 +369,9 @@ def trainer(args, configs, zs_config):
         if args.external_lr >= 0:
             print('Overriding external LR')
             task_config['init_lr'] = args.external_lr
+        if args.early_stop_patience >= 0:
+            task_config['early_stop'] = {'patience': args.early_stop_patience, 'min_delta': args.early_stop_min_delta,
+                                         'min_epochs': args.early_stop_min_epochs}
 
         with open(os.path.join(args.output_dir, 'config_task-' + task + '.yaml'), 'w') as tcf:
             yaml.dump(task_config, tcf)
@@ -232,7 +397,16 @@ def trainer(args, configs, zs_config):
             'ema_alpha': args.ema_alpha,
             'ema_lora': args.ema_lora,
             'ema_frequency': args.epoch_frequency,
-            'save_frequency':args.save_frequency
+            'save_frequency':args.save_frequency,
+            'skip_init': args.skip_init,
+            'int8_backbone': args.int8_backbone,
+            'int8_parity': args.int8_parity,
+            'lora_ddp': args.lora_ddp,
+            'grad_compress': args.grad_compress,
+            'grad_sync_every': args.grad_sync_every,
+            'bucket_cap_mb': args.bucket_cap_mb,
+            'comm_stats': args.comm_stats,
+            'step_ckpt_every': args.step_ckpt_every
         }
 
         # train task
@@ -246,18 +420,30 @@ def trainer(args, configs, zs_config):
         if not os.path.exists(training_complete_file) and not args.lb_flag:
             if utils.is_main_process(): print("Start training task + " + str())
             start_time = time.time()
-            task_trainers.__dict__[task_list[t]['trainer']].main(args=task_args, config=cur_task_config, eval=False,
-                                                                 test_ema=False)
+            yield task_list[t]['trainer'], task_args, cur_task_config
             total_time = time.time() - start_time
             total_time_str = str(datetime.timedelta(seconds=int(total_time)))
             if utils.is_main_process(): print('Training time {}'.format(total_time_str))
+            telemetry.emit('task_end', task=t, name=task_list[t]['name'], seconds=round(total_time, 3), run=args.output_dir)
             with open(training_complete_file, 'w') as f:
                 f.write(total_time_str)
+        else:
+            yield None
+
+        # rank compaction of the task adapters for cheaper evaluation
+        if args.lora_compact_threshold > 0 and not args.lb_flag:
+            compact_file = agent.model_ckpt_history[task].replace('.pth', '_compact.pth')
+            if utils.is_main_process() and not os.path.exists(compact_file):
+                lora.compact_lora_checkpoint(agent.model_ckpt_history[task], compact_file,
+                                             args.lora_compact_threshold, args.lora_compact_criterion)
+            if utils.is_dist_avail_and_initialized():
+                dist.barrier()
+            agent.model_ckpt_compact[task] = compact_file
 
         # rehearsal
         if args.memory > 0:
             agent.coreset.extend(
-                task_trainers.__dict__[task_list[t]['trainer']].sample_memory(memory=args.memory, args=task_args,
+                getattr(task_trainers, task_list[t]['trainer']).sample_memory(memory=args.memory, args=task_args,
                                                                               config=cur_task_config, eval=False))
 
         # evaluate
@@ -276,24 +462,43 @@ def trainer(args, configs, zs_config):
                 'ema_alpha': args.ema_alpha,
                 'ema_lora': args.ema_lora,
                 'ema_frequency': args.epoch_frequency,
-                'save_frequency':args.save_frequency
+                'save_frequency':args.save_frequency,
+                'skip_init': args.skip_init,
+                'int8_backbone': args.int8_backbone,
+                'int8_parity': args.int8_parity,
+                'eval_engine': args.eval_engine,
+                'task_parallel_eval': args.task_parallel_eval,
+                'eval_cache_dir': args.eval_cache_dir,
+                'image_embed_cache_mb': args.image_embed_cache_mb
             }
 
-            result_dict = evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, oracle_results,
-                                         lb_exists, lb_results, agent.ema)
+            if args.async_eval:
+                # snapshot of this round, task t+1 trains while it is evaluated
+                snapshot = copy.deepcopy(agent)
+                eval_args['agent'] = snapshot
+                process = None
+                if utils.is_main_process():
+                    init_file = os.path.abspath(os.path.join(args.output_dir, f'.async_eval_{t:02d}'))
+                    if os.path.exists(init_file):
+                        os.remove(init_file)
+                    process = torch.multiprocessing.get_context('spawn').Process(
+                        target=async_evaluate_round,
+                        args=(snapshot, eval_args, task_list, init_file,
+                              os.path.join(args.output_dir, 'telemetry.jsonl'), args.output_dir))
+                    process.start()
+                async_rounds.append({'t': t, 'agent': snapshot, 'eval_args': eval_args, 'process': process})
+                assemble_async_rounds(block=False)
+            else:
+                with telemetry.timed('eval_round', task=t, tasks=t + 1, adapter='ema' if agent.ema else 'current',
+                                     engine=args.eval_engine or args.task_parallel_eval, run=args.output_dir):
+                    result_dict = evaluate_tasks(agent, result_dict, eval_args, task_list, oracle_exists, oracle_results,
+                                                 lb_exists, lb_results, agent.ema)
 
-            # save results
-            if utils.is_main_process():
-                save_dir = args.result_dir
-                for rkey in result_keys:
-                    with open(os.path.join(save_dir, rkey + ".yaml"), 'w') as yaml_file:
-                        yaml.dump(result_dict[rkey], yaml_file, default_flow_style=False)
-                save_dir = os.path.join(args.result_dir, f'task_{t:02d}')
-                os.makedirs(save_dir, exist_ok=True)
-                for rkey in result_keys:
-                    with open(os.path.join(save_dir, rkey + ".yaml"), 'w') as yaml_file:
-                        yaml.dump(result_dict[rkey], yaml_file, default_flow_style=False)
+                # save results
+                save_results(args, result_dict, result_keys, t)
         else:
+            if len(async_rounds) > 0:
+                assemble_async_rounds(block=True)
             prev_task_dir = os.path.join(args.result_dir, f'task_{t:02d}')
             for rkey in result_keys:
                 with open(os.path.join(prev_task_dir, rkey + ".yaml"), 'r') as f:
@@ -302,6 +507,10 @@ def trainer(args, configs, zs_config):
         # finish task
         agent.finish_task()
 
+    # ordering barrier of the async pipeline
+    if len(async_rounds) > 0:
+        assemble_async_rounds(block=True)
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -312,7 +521,10 @@ def get_args():
     parser.add_argument('--repeat', type=int, default=1, help="Repeat the experiment N times")
     parser.add_argument('--overwrite', type=int, default=0, metavar='N',
                         help='Train regardless of whether saved model exists')
-    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--device', default='cuda', help='cuda, or cpu for gloo multi-process runs on CPU cores')
+    parser.add_argument('--cpu_threads', type=int, default=0, help='intra-op threads per process, 0 keeps the torch default')
+    parser.add_argument('--pin_cores', default=False, action='store_true',
+                        help='with --cpu_threads, pin each local rank to its own slice of cores')
     parser.add_argument('--eval_every', type=int, default=1, help="Reduce validation data evals")
 
     # distributed training
@@ -339,6 +551,10 @@ def get_args():
     parser.add_argument('--debug_flag', default=False, action='store_true', help='Debug mode to run faster')
     parser.add_argument('--mu', type=float, default=1.0, help="regularization strength")
     parser.add_argument('--external_lr', type=float, default=-1.0, help="regularization strength")
+    # early stopping, overrides the early_stop section of every task config
+    parser.add_argument('--early_stop_patience', type=int, default=-1, help='validations without improvement before a task stops, -1 keeps the task configs')
+    parser.add_argument('--early_stop_min_delta', type=float, default=0.0, help='smallest val acc gain that resets the patience')
+    parser.add_argument('--early_stop_min_epochs', type=int, default=0, help='epochs every task trains before it may stop')
     parser.add_argument('--beta', type=float, default=0.0, help="regularization strength")
     parser.add_argument('--text_only_flag', default=False, action='store_true', help='only regulalarize text models')
     parser.add_argument('--vision_only_flag', default=False, action='store_true', help='only regularize vision models')
@@ -361,6 +577,39 @@ def get_args():
     # other
     parser.add_argument('--freeze_text_emb', default=False, action='store_true', help="for lora")
     parser.add_argument('--flush_queue', default=False, action='store_true', help='empty the queue before each task')
+    parser.add_argument('--skip_init', default=False, action='store_true',
+                        help='build models on the meta device and only initialize tensors the checkpoints do not provide')
+    parser.add_argument('--int8_backbone', default=False, action='store_true',
+                        help='store the frozen base weights of lora layers as int8 with per-channel scales')
+    parser.add_argument('--int8_parity', default=False, action='store_true',
+                        help='with --int8_backbone, also evaluate the float backbone and log the accuracy delta')
+    parser.add_argument('--lora_ddp', default=False, action='store_true',
+                        help='data parallel over the trainable adapter tensors only instead of DDP over the whole model')
+    parser.add_argument('--grad_compress', default='none', choices=['none', 'fp16', 'bf16'],
+                        help='dtype of the gradient all-reduce during training')
+    parser.add_argument('--grad_sync_every', type=int, default=1,
+                        help='all-reduce gradients every k steps and accumulate locally in between, needs --lora_ddp')
+    parser.add_argument('--bucket_cap_mb', type=float, default=25, help='gradient all-reduce bucket size')
+    parser.add_argument('--comm_stats', default=False, action='store_true',
+                        help='log gradient communication time and volume of native DDP (adds a Python comm hook)')
+    parser.add_argument('--step_ckpt_every', type=int, default=0,
+                        help='adapter-only resumable snapshot every k training steps, 0 resumes at epoch granularity only')
+    parser.add_argument('--profile_steps', default=False, action='store_true',
+                        help='time the phases of every training step, reported in the log line and log.txt')
+    parser.add_argument('--profile_trace_task', type=int, default=-1, help='task id of the torch.profiler trace, -1 for none')
+    parser.add_argument('--profile_trace_steps', type=str, default='10:15', help='step window start:end of the trace')
+    parser.add_argument('--telemetry_every', type=int, default=10,
+                        help='step event in <output_dir>/telemetry.jsonl every k training steps, 0 keeps only task and eval events')
+    parser.add_argument('--eval_engine', default=False, action='store_true',
+                        help='evaluate all seen tasks of a round with one model build, test split only')
+    parser.add_argument('--task_parallel_eval', default=False, action='store_true',
+                        help='with the eval engine, assign whole tasks to ranks (balanced by test size) instead of sharding each task')
+    parser.add_argument('--async_eval', default=False, action='store_true',
+                        help='evaluate each round in a background process while the next task trains')
+    parser.add_argument('--eval_cache_dir', type=str, default=None,
+                        help='content-addressed evaluation result cache, can be shared by runs and sweeps')
+    parser.add_argument('--image_embed_cache_mb', type=float, default=0,
+                        help='LRU cache of ViT outputs during evaluation, in MB; repeated images only run the text encoder')
 
     # EMA setting
     parser.add_argument('--ema', type=str, default='task', help='for ema updating')  # task/epoch/mix
@@ -370,6 +619,16 @@ def get_args():
 
     parser.add_argument('--ema_lora', type=str, default='continual', help='for lora initial')  # continual/zero/ema
 
+    # LoRA rank compaction
+    parser.add_argument('--lora_compact_threshold', type=float, default=0.0,
+                        help='SVD-truncate adapters after each task for evaluation, 0 disables')
+    parser.add_argument('--lora_compact_criterion', type=str, default='energy',
+                        help='energy: kept spectral energy >= threshold, error: relative error <= threshold')  # energy/error
+
+    # co-training of several configurations on one data pipeline
+    parser.add_argument('--cotrain_config', type=str, default=None,
+                        help='yaml with a list of members (name plus argument overrides) trained side by side')
+
     # zsl config
     parser.add_argument('--zsl_config', default='./configs/continual/zero_shot.yaml')
 
@@ -398,4 +657,7 @@ if __name__ == '__main__':
     yaml.dump(args, open(os.path.join(args.output_dir, 'args.yaml'), 'w'))
 
     # let's gooooooo
-    trainer(args, configs, zs_config)
\ No newline at end of file
+    if args.cotrain_config is not None:
+        cotrainer(args, configs, zs_config)
+    else:
+        trainer(args, configs, zs_config)
\ No newline at end of file
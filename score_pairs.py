@@ -0,0 +1,258 @@
+"""
+Scores image-caption pairs with a trained model outside the training harness: the checkpoint chain of a run is
+composed into one model once, an adapter is selected and pairs are streamed through it.
+
+    python score_pairs.py --run_dir 7vg_zaf --adapter ema --pairs pairs.jsonl --out scores.jsonl --image_root /data/visgenome
+    python score_pairs.py --run_dir 7vg_zaf --task 3 --adapter current --pairs datasets/vl-checklist/data/Attribute/vg/color.json ...
+
+Inputs:
+    JSONL        one {"image": ..., "caption": ...} object per line, any other fields are copied to the output
+    vl_checklist the annotation format, [[image, {"POS": [...], "NEG": [...]}], ...], every caption is a pair with
+                 label 1 (POS) or 0 (NEG)
+Image paths are relative to --image_root.
+
+The model comes from --run_dir (args.yaml, config_sequence.yaml, config_task-*.yaml and task_models/ of a run_me
+output dir): task_models/_pre.pth plus the task checkpoints up to --task (default the last trained one), the chain
+the evaluation after that task loads. --checkpoints, --config and the agent flags replace any of these.
+
+Adapters: 'current' (the trained adapters), 'ema' (EMA agents) or 'task<k>' (adapters 0..k of multi-lora agents).
+
+Pairs are bucketed by caption length inside windows of --window pairs, so captions of similar length share a batch,
+and batches are capped by --max_batch pairs and --max_tokens padded caption tokens. Output lines carry the index of
+the pair in the input stream and are flushed per batch; rerunning with the same --out skips the pairs already scored.
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+import yaml
+from PIL import Image
+
+from agents.stub import AgentStub
+from data import build_eval_transform
+from data.utils import pre_caption
+from models.embed_cache import ImageEmbedCache
+
+EMA_AGENTS = ['ZAF', 'EMALoRa']
+MULTI_AGENTS = ['MultiLoRa', 'AdvTextMultiLoRa']
+
+
+def scoring_agent(agent_type, agent_name, mu, n_task_ckpts, ema_type='task', freeze_text_emb=False):
+    # agent stub of a run from its agent flags, adapters as the training agent of the last checkpoint has them
+    ema = agent_name in EMA_AGENTS
+    multi = agent_name in MULTI_AGENTS
+    lora_layers = agent_type == 'lora'
+    n_adapters = (2 if ema_type != 'mix' else 3) if ema else n_task_ckpts
+    return AgentStub(n_adapters=n_adapters, ema=ema, multi=multi, r=int(mu) if lora_layers else None,
+                     lora_layers=lora_layers, ema_type=ema_type, task_id=max(n_task_ckpts - 1, 0),
+                     freeze_text_emb=freeze_text_emb)
+
+
+def resolve_run(args):
+    # checkpoint chain, task config and agent flags of a run_me output dir, explicit arguments take precedence
+    run_args = {}
+    if args.run_dir is not None:
+        run_args = vars(yaml.load(open(os.path.join(args.run_dir, 'args.yaml'), 'r'), Loader=yaml.Loader))
+        sequence = yaml.load(open(os.path.join(args.run_dir, 'config_sequence.yaml'), 'r'), Loader=yaml.Loader)
+        tasks = [f"{t}_{task['name']}" for t, task in enumerate(sequence['task_list'])]
+        task_model_dir = os.path.join(args.run_dir, 'task_models')
+        trained = [t for t, task in enumerate(tasks) if os.path.exists(os.path.join(task_model_dir, task + '.pth'))]
+        assert len(trained) > 0, f'No task checkpoints in {task_model_dir}'
+        k = args.task if args.task is not None else trained[-1]
+        assert k in trained, f'Task {k} has no checkpoint in {task_model_dir}'
+        if args.checkpoints is None:
+            pre = os.path.join(task_model_dir, '_pre.pth')
+            args.checkpoints = ([pre] if os.path.exists(pre) else []) + \
+                               [os.path.join(task_model_dir, task + '.pth') for task in tasks[:k + 1]]
+        if args.config is None:
+            args.config = os.path.join(args.run_dir, 'config_task-' + tasks[k] + '.yaml')
+    assert args.checkpoints and args.config, 'Pass --run_dir, or --checkpoints and --config'
+    for key, default in [('agent_type', 'lora'), ('agent_name', 'ZAF'), ('mu', 16), ('ema', 'task'),
+                         ('freeze_text_emb', False)]:
+        if getattr(args, key) is None:
+            setattr(args, key, run_args.get(key, default))
+    n_task_ckpts = len([c for c in args.checkpoints if not c.endswith('_pre.pth')])
+    agent = scoring_agent(args.agent_type, args.agent_name, args.mu, n_task_ckpts, args.ema, args.freeze_text_emb)
+    config = yaml.load(open(args.config, 'r'), Loader=yaml.Loader)
+    return agent, config
+
+
+def add_model_args(parser, adapter='current'):
+    # model selection flags shared with serve.py
+    parser.add_argument('--run_dir', type=str, default=None, help='run_me output dir of the model')
+    parser.add_argument('--task', type=int, default=None, help='compose the checkpoints up to this task')
+    parser.add_argument('--checkpoints', type=str, nargs='+', default=None, help='checkpoint chain, loaded in order')
+    parser.add_argument('--config', type=str, default=None, help='task config with the model architecture')
+    parser.add_argument('--adapter', type=str, default=adapter, help="current, ema or task<k>")
+    parser.add_argument('--agent_type', type=str, default=None)
+    parser.add_argument('--agent_name', type=str, default=None)
+    parser.add_argument('--mu', type=float, default=None, help='LoRA rank')
+    parser.add_argument('--ema', type=str, default=None, help='EMA type of the run (task/epoch/mix)')
+    parser.add_argument('--freeze_text_emb', default=None, action='store_true')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--image_embed_cache_mb', type=float, default=0,
+                        help='LRU cache of ViT outputs, in MB; captions of an already seen image only run the text encoder')
+
+
+def check_adapter(agent, adapter):
+    # KeyError / ValueError for selections the composed model does not have
+    agent.adapters.resolve(adapter)
+    if adapter == 'ema' and not agent.ema:
+        raise ValueError('adapter ema needs an EMA agent (ZAF, EMALoRa)')
+
+
+def load_model(args):
+    """ The composed model in eval mode on args.device, its agent and task config. """
+    from models.blip_nlvr import blip_nlvr
+    from task_trainers.train_nlvr import model_kwargs
+
+    agent, config = resolve_run(args)
+    check_adapter(agent, args.adapter)
+    start_time = time.time()
+    print(f'Composing {len(args.checkpoints)} checkpoints: {args.checkpoints}')
+    model, _ = blip_nlvr(pretrained=args.checkpoints, agent=agent, skip_init=True, **model_kwargs(config))
+    model = model.to(torch.device(args.device))
+    model.eval()
+    if args.image_embed_cache_mb > 0:
+        model.embed_cache = ImageEmbedCache(args.image_embed_cache_mb * 2 ** 20)
+    print(f'Model ready in {time.time() - start_time:.2f}s')
+    return model, agent, config
+
+
+def score(model, agent, images, captions, adapter):
+    """ cls_head probabilities (no match, match) of a batch, as train_nlvr.evaluate computes its predictions. """
+    targets = torch.zeros(len(captions), dtype=torch.long, device=images.device)
+    with torch.no_grad(), agent.adapters.activate(adapter):
+        return model(images, captions, targets=targets, train=False, agent=agent).softmax(dim=-1)
+
+
+def read_pairs(path):
+    # (index, record) in input order, JSONL is read lazily
+    with open(path, 'r') as f:
+        first = f.read(1)
+        f.seek(0)
+        if first == '[':
+            index = 0
+            for image, captions in json.load(f):
+                for label, key in [(1, 'POS'), (0, 'NEG')]:
+                    for caption in captions.get(key, []):
+                        yield index, {'image': image, 'caption': caption, 'label': label}
+                        index += 1
+        else:
+            for index, line in enumerate(line for line in f if line.strip()):
+                yield index, json.loads(line)
+
+
+class PairStream(torch.utils.data.IterableDataset):
+    """
+    Batches of (indices, records, images, captions), bucketed by caption length within each window. Windows are
+    dealt round-robin to the DataLoader workers.
+    """
+    def __init__(self, path, image_root, transform, skip, window, max_batch, max_tokens):
+        self.path, self.image_root, self.transform = path, image_root, transform
+        self.skip, self.window, self.max_batch, self.max_tokens = skip, window, max_batch, max_tokens
+
+    def batches(self, window):
+        window.sort(key=lambda item: len(item[2].split()))
+        batch = []
+        for item in window:
+            # sorted, so the new caption is the longest; words approximate tokens, +2 for [ENC] and [SEP]
+            longest = len(item[2].split()) + 2
+            if len(batch) > 0 and (len(batch) >= self.max_batch or (len(batch) + 1) * longest > self.max_tokens):
+                yield batch
+                batch = []
+            batch.append(item)
+        if len(batch) > 0:
+            yield batch
+
+    def load(self, batch):
+        indices = [index for index, _, _ in batch]
+        records = [record for _, record, _ in batch]
+        images = torch.stack([self.transform(Image.open(os.path.join(self.image_root, r['image'])).convert('RGB'))
+                              for r in records])
+        return indices, records, images, [caption for _, _, caption in batch]
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker, n_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        window, n_windows = [], 0
+        for index, record in read_pairs(self.path):
+            if index in self.skip:
+                continue
+            window.append((index, record, pre_caption(record['caption'], 40)))
+            if len(window) == self.window:
+                if n_windows % n_workers == worker:
+                    for batch in self.batches(window):
+                        yield self.load(batch)
+                window, n_windows = [], n_windows + 1
+        if len(window) > 0 and n_windows % n_workers == worker:
+            for batch in self.batches(window):
+                yield self.load(batch)
+
+
+def scored_indices(path):
+    # indices already in the output; a line cut off by an interruption is dropped
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].decode().splitlines():
+        if line.strip():
+            done.add(json.loads(line)['index'])
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Match probabilities of image-caption pairs under one adapter')
+    parser.add_argument('--pairs', type=str, required=True, help='JSONL of {"image", "caption"} or a vl_checklist json')
+    parser.add_argument('--out', type=str, required=True, help='JSONL of scored pairs, appended to when resuming')
+    parser.add_argument('--image_root', type=str, default='')
+    add_model_args(parser)
+    parser.add_argument('--window', type=int, default=2048, help='pairs sorted by caption length together')
+    parser.add_argument('--max_batch', type=int, default=128)
+    parser.add_argument('--max_tokens', type=int, default=4096, help='cap on pairs x padded caption length per batch')
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--log_every', type=int, default=50, help='batches between throughput lines')
+    args = parser.parse_args()
+
+    try:
+        model, agent, config = load_model(args)
+    except (KeyError, ValueError) as e:
+        parser.error(str(e))
+    device = torch.device(args.device)
+
+    done = scored_indices(args.out)
+    if len(done) > 0:
+        print(f'Resuming: {len(done)} pairs already scored in {args.out}')
+    stream = PairStream(args.pairs, args.image_root, build_eval_transform(config['image_size']), done, args.window,
+                        args.max_batch, args.max_tokens)
+    loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=args.num_workers,
+                                         pin_memory=device.type == 'cuda')
+
+    start_time = time.time()
+    n_pairs = 0
+    with open(args.out, 'a') as out:
+        for i, (indices, records, images, captions) in enumerate(loader):
+            images = images.to(device, non_blocking=True)
+            probs = score(model, agent, images, captions, args.adapter)[:, 1].tolist()
+            for index, record, prob in zip(indices, records, probs):
+                out.write(json.dumps({'index': index, **record, 'prob': prob, 'adapter': args.adapter}) + '\n')
+            out.flush()
+            n_pairs += len(indices)
+            if (i + 1) % args.log_every == 0:
+                print(f'{n_pairs} pairs, {n_pairs / (time.time() - start_time):.1f} pairs/s')
+    seconds = time.time() - start_time
+    print(f'Scored {n_pairs} pairs in {seconds:.1f}s ({n_pairs / max(seconds, 1e-9):.1f} pairs/s), '
+          f'{len(done) + n_pairs} in {args.out}')
+    if model.embed_cache is not None:
+        print('Image embedding cache:', model.embed_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
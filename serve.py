@@ -0,0 +1,292 @@
+"""
+Local scoring service: one composed model stays loaded and concurrent requests are gathered into micro-batches.
+
+    python serve.py --run_dir 7vg_zaf --image_root /data/visgenome --port 8080
+    curl -s localhost:8080/score -d '{"image": "VG_100K/1.jpg", "caption": "a red car"}'
+    curl -s localhost:8080/score -d '{"pairs": [{"image": ..., "caption": ...}, ...], "adapter": "current"}'
+    curl -s localhost:8080/metrics
+
+The model is selected as in score_pairs.py (--run_dir/--task or --checkpoints/--config and the agent flags), the
+default adapter is 'ema'; a request may pick another one with "adapter". Responses carry the cls_head probabilities
+[no match, match] of train_nlvr.evaluate and "prob", the match probability. Image paths are relative to --image_root,
+only local files are read.
+
+Requests are decoded and their images preprocessed on a thread pool, then queued. A single worker thread takes a
+batch once --max_batch pairs are queued or the oldest pair has waited --max_wait_ms, and runs one forward per adapter
+in it. Outputs of the ViT are kept in an LRU cache of --image_embed_cache_mb, so further captions of an image only
+run the text encoder. /metrics reports the queue depth, the batch size distribution, p50/p99 of the request latency
+and the cache hit rate.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from data import build_eval_transform
+from data.utils import pre_caption
+from score_pairs import add_model_args, check_adapter, load_model, score
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+          500: 'Internal Server Error'}
+
+
+class Metrics:
+    def __init__(self, embed_cache=None, window=10000):
+        self.embed_cache = embed_cache
+        self.start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.pairs = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self.max_queue_depth = 0
+        # latencies of the last `window` requests and forwards
+        self.latency_ms = deque(maxlen=window)
+        self.forward_ms = deque(maxlen=window)
+
+    def batch(self, size, seconds):
+        self.batches += 1
+        self.pairs += size
+        self.batch_sizes[size] += 1
+        self.forward_ms.append(seconds * 1e3)
+
+    def snapshot(self, queue_depth):
+        def percentiles(values):
+            if len(values) == 0:
+                return {'p50': None, 'p99': None}
+            p50, p99 = np.percentile(list(values), [50, 99])
+            return {'p50': round(float(p50), 3), 'p99': round(float(p99), 3)}
+        uptime = time.time() - self.start_time
+        return {
+            'uptime_s': round(uptime, 3),
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'requests': self.requests,
+            'errors': self.errors,
+            'pairs': self.pairs,
+            'pairs_per_sec': round(self.pairs / max(uptime, 1e-9), 3),
+            'batches': self.batches,
+            'mean_batch_size': round(self.pairs / self.batches, 3) if self.batches > 0 else None,
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'latency_ms': percentiles(self.latency_ms),
+            'forward_ms': percentiles(self.forward_ms),
+            'image_embed_cache': self.embed_cache.stats() if self.embed_cache is not None else None,
+        }
+
+
+class Batcher:
+    """
+    Pairs are queued as (image, caption, adapter, future, arrival time); one forward thread scores a micro-batch at a
+    time, so the adapter selection of the shared agent never races.
+    """
+    def __init__(self, model, agent, device, max_batch, max_wait_ms, metrics):
+        self.model, self.agent, self.device = model, agent, device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1e3
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.forward_pool = ThreadPoolExecutor(max_workers=1)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    async def submit(self, image, caption, adapter):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, caption, adapter, future, time.time()))
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.depth())
+        return await future
+
+    async def collect(self):
+        # the first pair opens the batch, the budget runs from its arrival
+        batch = [await self.queue.get()]
+        deadline = batch[0][4] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while len(batch) < self.max_batch and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    def forward(self, batch):
+        groups = {}
+        for i, (_, _, adapter, _, _) in enumerate(batch):
+            groups.setdefault(adapter, []).append(i)
+        probs = [None] * len(batch)
+        for adapter, indices in groups.items():
+            images = torch.stack([batch[i][0] for i in indices]).to(self.device)
+            captions = [batch[i][1] for i in indices]
+            for i, p in zip(indices, score(self.model, self.agent, images, captions, adapter).tolist()):
+                probs[i] = p
+        return probs
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            start_time = time.time()
+            try:
+                probs = await loop.run_in_executor(self.forward_pool, self.forward, batch)
+            except Exception as e:
+                for item in batch:
+                    if not item[3].done():
+                        item[3].set_exception(e)
+                continue
+            self.metrics.batch(len(batch), time.time() - start_time)
+            for item, p in zip(batch, probs):
+                if not item[3].done():
+                    item[3].set_result(p)
+
+
+class Server:
+    def __init__(self, batcher, agent, transform, image_root, default_adapter, metrics, preprocess_threads,
+                 max_body=1 << 20):
+        self.batcher, self.agent, self.transform = batcher, agent, transform
+        self.image_root = os.path.abspath(image_root)
+        self.default_adapter = default_adapter
+        self.metrics = metrics
+        self.preprocess_pool = ThreadPoolExecutor(max_workers=preprocess_threads)
+        self.max_body = max_body
+
+    def load_pair(self, pair):
+        path = os.path.abspath(os.path.join(self.image_root, pair['image']))
+        if os.path.commonpath([self.image_root, path]) != self.image_root:
+            raise ValueError(f"image outside of the image root: {pair['image']}")
+        image = self.transform(Image.open(path).convert('RGB'))
+        return image, pre_caption(pair['caption'], 40)
+
+    async def score(self, request):
+        pairs = request['pairs'] if 'pairs' in request else [request]
+        if not isinstance(pairs, list) or len(pairs) == 0:
+            raise ValueError('pairs must be a non-empty list')
+        adapter = request.get('adapter', self.default_adapter)
+        check_adapter(self.agent, adapter)
+        loop = asyncio.get_running_loop()
+        try:
+            loaded = await asyncio.gather(*[loop.run_in_executor(self.preprocess_pool, self.load_pair, p)
+                                            for p in pairs])
+        except (KeyError, TypeError, OSError) as e:
+            raise ValueError(f'bad pair: {e!r}')
+        probs = await asyncio.gather(*[self.batcher.submit(image, caption, adapter) for image, caption in loaded])
+        results = [{'prob': p[1], 'cls_probs': p} for p in probs]
+        if 'pairs' in request:
+            return {'adapter': adapter, 'results': results}
+        return {'adapter': adapter, **results[0]}
+
+    async def route(self, method, path, body):
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path == '/metrics':
+            return 200, self.metrics.snapshot(self.batcher.depth())
+        if path != '/score':
+            return 404, {'error': f'no route {path}'}
+        if method != 'POST':
+            return 405, {'error': 'POST a json body to /score'}
+        start_time = time.time()
+        try:
+            response = await self.score(json.loads(body))
+        except (ValueError, KeyError, AttributeError) as e:
+            # json.JSONDecodeError is a ValueError
+            return 400, {'error': str(e)}
+        self.metrics.latency_ms.append((time.time() - start_time) * 1e3)
+        return 200, response
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    status, response = 413, {'error': f'body over {self.max_body} bytes'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    self.metrics.requests += 1
+                    try:
+                        status, response = await self.route(method, target.split('?')[0], body)
+                    except Exception as e:
+                        status, response = 500, {'error': repr(e)}
+                    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                if status != 200:
+                    self.metrics.errors += 1
+                payload = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args, model, agent, config):
+    metrics = Metrics(model.embed_cache)
+    batcher = Batcher(model, agent, torch.device(args.device), args.max_batch, args.max_wait_ms, metrics)
+    server = Server(batcher, agent, build_eval_transform(config['image_size']), args.image_root, args.adapter, metrics,
+                    args.preprocess_threads)
+    worker = asyncio.ensure_future(batcher.run())
+    http = await asyncio.start_server(server.handle, args.host, args.port)
+    print(f'Serving on http://{args.host}:{args.port} (adapter {args.adapter}, max_batch {args.max_batch}, '
+          f'max_wait_ms {args.max_wait_ms})')
+    try:
+        async with http:
+            await http.serve_forever()
+    finally:
+        worker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local micro-batching scoring service')
+    add_model_args(parser, adapter='ema')
+    parser.set_defaults(device='cpu', image_embed_cache_mb=256)
+    parser.add_argument('--image_root', type=str, default='')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='latency budget of the oldest queued pair')
+    parser.add_argument('--preprocess_threads', type=int, default=4)
+    parser.add_argument('--cpu_threads', type=int, default=None, help='torch intra-op threads of the forward')
+    args = parser.parse_args()
+
+    if args.cpu_threads is not None:
+        torch.set_num_threads(args.cpu_threads)
+    try:
+        model, agent, config = load_model(args)
+    except (KeyError, ValueError) as e:
+        parser.error(str(e))
+    try:
+        asyncio.run(serve(args, model, agent, config))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
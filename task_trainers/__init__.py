@@ -1 +1,15 @@
-from . import train_nlvr
\ No newline at end of file
+import importlib
+
+
+# trainers are imported on first use, importing the package does not pull in the models (transformers, timm)
+def __getattr__(name):
+    if name.startswith('_'):
+        raise AttributeError(name)
+    try:
+        module = importlib.import_module('.' + name, __name__)
+    except ModuleNotFoundError as e:
+        if e.name != __name__ + '.' + name:
+            raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from e
+    globals()[name] = module
+    return module
@@ -28,57 +28,106 @@ import torch.distributed as dist
 from itertools import zip_longest
 
 from models.blip_nlvr import blip_nlvr
+from models.embed_cache import ImageEmbedCache
 
 import utils
-from utils import cosine_lr_schedule, warmup_lr_schedule, count_parameters
+from utils import cosine_lr_schedule, warmup_lr_schedule, count_parameters, create_optimizer
 from data import create_dataset, create_sampler, create_loader, create_zsl_dataset
+from eval_cache import EvalCache
+from telemetry import telemetry
 
 import loralib as lora
 
-def train(model, data_loader, optimizer, epoch, device, config, agent):
+def task_batch(batch_data, device):
+    if not isinstance(batch_data[1], list):
+        image0, image1, text, targets = batch_data
+    else:
+        image0, pos, neg, idx = batch_data
+        text = pos + neg
+        image0 = image0.repeat(2, 1, 1, 1)
+        targets = torch.zeros((len(text,)), dtype=torch.int64)
+        targets[:len(pos)] = 1
+        image1 = None
+
+    if image1 is not None:
+        images = torch.cat([image0, image1], dim=0)
+    else:
+        images = image0
+    return images.to(device), text, targets.to(device)
+
+def shuffle_zsl_batch(zsl_batch_data):
+    # the random setting shuffles the texts and makes them unpaired
+    image0, pos, neg, idx = zsl_batch_data
+    pos, neg = list(pos), list(neg)
+    random.shuffle(pos)
+    random.shuffle(neg)
+    return image0, pos, neg, idx
+
+def zsl_batch(zsl_batch_data, agent, device):
+    # targets do not take part in the zero-shot losses, only the text pairing matters
+    image0, pos, neg, idx = zsl_batch_data
+    if agent.train_distill_type == 'zsl-single' or  agent.train_distill_type == 'ema-zsl-single' or  agent.train_distill_type == 'adv_text_zsl' :
+        if agent.random ==True:
+            text = pos + neg
+            image0 = image0.repeat(2, 1, 1, 1)
+        else:
+            text = pos
+        targets = torch.ones((len(text, )), dtype=torch.int64)
+    elif agent.train_distill_type == 'zsl-cons'or  agent.train_distill_type == 'ema-zsl-cons' or  agent.train_distill_type == 'adv_text_cons':
+        text = pos + neg
+        image0 = image0.repeat(2, 1, 1, 1)
+        targets = torch.zeros((len(text, )), dtype=torch.int64)
+        targets[:len(pos)] = 1
+    else:
+        raise NotImplementedError(f'Unsupported train distill type: {agent.train_distill_type}')
+    return image0.to(device), text, targets.to(device)
+
+def optimizer_step(model, loss, optimizer):
+    # with reduced-frequency gradient sync (LoRADataParallel sync_every) gradients accumulate over the local steps and
+    # the optimizer only steps on synchronized ones
+    if getattr(model, 'synced', True):
+        optimizer.zero_grad(set_to_none=False)
+    with utils.profile_region('backward'):
+        loss.backward()
+    if getattr(model, 'synced', True):
+        with utils.profile_region('optimizer'):
+            optimizer.step()
+
+def train(model, data_loader, optimizer, epoch, device, config, agent, step_ckpt=None):
     # train
     model.train()  
     
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=50, fmt='{value:.6f}'))
     metric_logger.add_meter('loss', utils.SmoothedValue(window_size=50, fmt='{value:.4f}'))
+    start_step = 0
+    if step_ckpt is not None:
+        start_step = step_ckpt.restore_meters(metric_logger)
 
     header = 'Train Epoch: [{}]'.format(epoch)
     print_freq = 50   
     step_size = 10
  
-    for i, batch_data in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
-        if not isinstance(batch_data[1], list):
-            image0, image1, text, targets = batch_data
-        else:
-            image0, pos, neg, idx = batch_data
-            text = pos + neg
-            image0 = image0.repeat(2, 1, 1, 1)
-            targets = torch.zeros((len(text,)), dtype=torch.int64)
-            targets[:len(pos)] = 1
-            image1 = None
-
-        if image1 is not None:
-            images = torch.cat([image0, image1], dim=0)
-        else:
-            images = image0
-        images, targets = images.to(device), targets.to(device)   
+    telemetry.start_window()
+    for i, batch_data in enumerate(metric_logger.log_every(data_loader, print_freq, header, profiler=utils.step_profiler), start=start_step):
+        images, text, targets = task_batch(batch_data, device)
 
         loss = model(images, text, targets=targets, train=True, agent=agent)   
         
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()    
+        optimizer_step(model, loss, optimizer)
                
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(loss=loss.item())  
+        telemetry.step(epoch, i, targets.size(0), metric_logger)
+        if step_ckpt is not None:
+            step_ckpt.step(epoch, i, metric_logger)
         
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger.global_avg())     
     return {k: "{:.4f}".format(meter.global_avg) for k, meter in metric_logger.meters.items()}
 
-def train_zsl(model, data_loader,zsl_data_loader,zsl_datasets,samplers,num_workers,optimizer, epoch, device, config, agent):
+def train_zsl(model, data_loader,zsl_data_loader,zsl_datasets,samplers,num_workers,optimizer, epoch, device, config, agent, step_ckpt=None):
     # train
     model.train()
 
@@ -86,77 +135,41 @@ def train_zsl(model, data_loader,zsl_data_loader,zsl_datasets,samplers,num_worke
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=50, fmt='{value:.6f}'))
     metric_logger.add_meter('loss', utils.SmoothedValue(window_size=50, fmt='{value:.4f}'))
     metric_logger.add_meter('zero_shot_loss', utils.SmoothedValue(window_size=50, fmt='{value:.4f}'))
+    start_step = 0
+    if step_ckpt is not None:
+        start_step = step_ckpt.restore_meters(metric_logger)
 
     header = 'Train Epoch: [{}]'.format(epoch)
     print_freq = 50
     step_size = 10
+    batches = zip_longest(data_loader, zsl_data_loader, fillvalue=(None, None, None, None))
+    telemetry.start_window()
     for i, (batch_data, zsl_batch_data) in enumerate(
-            zip_longest(data_loader, zsl_data_loader, fillvalue=(None, None, None, None))):
+            metric_logger.log_every(batches, print_freq, header, total=len(data_loader), profiler=utils.step_profiler), start=start_step):
         if all(item is None for item in batch_data) :
             break
         if all(item is None for item in zsl_batch_data):
             break
 
         #task data loss cal
-        image0, pos, neg, idx = batch_data
-        text = pos + neg
-        image0 = image0.repeat(2, 1, 1, 1)
-        targets = torch.zeros((len(text, )), dtype=torch.int64)
-        targets[:len(pos)] = 1
-        images = image0
-        images, targets = images.to(device), targets.to(device)
+        images, text, targets = task_batch(batch_data, device)
         loss1 = model(images, text, targets=targets, train=True, agent=agent)
 
-        if agent.train_distill_type == 'zsl-single' or  agent.train_distill_type == 'ema-zsl-single' or  agent.train_distill_type == 'adv_text_zsl' :
-            # zsl data loss cal
-            if agent.random ==True:
-                image0, pos, neg, idx = zsl_batch_data
-                random.shuffle(pos)
-                random.shuffle(neg)
-                text = pos + neg
-                image0 = image0.repeat(2, 1, 1, 1)
-                targets = torch.ones((len(text, )), dtype=torch.int64)#do not invlove in calculation
-                images = image0
-                images, targets = images.to(device), targets.to(device)
-                loss2, losses_log = model(images, text, targets=targets, train=True, agent=agent, train_zsl=True)
-            else:
-                image0, pos, neg, idx = zsl_batch_data
-                text = pos
-                targets = torch.ones((len(text, )), dtype=torch.int64)#do not invlove in calculation
-                images = image0
-                images, targets = images.to(device), targets.to(device)
-                loss2,losses_log = model(images, text, targets=targets, train=True, agent=agent,train_zsl = True)
-        elif agent.train_distill_type == 'zsl-cons'or  agent.train_distill_type == 'ema-zsl-cons' or  agent.train_distill_type == 'adv_text_cons':
-            if agent.random ==True:
-                image0, pos, neg, idx = zsl_batch_data
-                random.shuffle(pos)
-                random.shuffle(neg)
-                text = pos + neg
-                image0 = image0.repeat(2, 1, 1, 1)
-
-                targets = torch.zeros((len(text, )), dtype=torch.int64)#do not invlove in calculation
-                targets[:len(pos)] = 1
-                images = image0
-                images, targets = images.to(device), targets.to(device)
-                loss2, losses_log = model(images, text, targets=targets, train=True, agent=agent, train_zsl=True)
-            else:
-                image0, pos, neg, idx = zsl_batch_data
-                text = pos + neg
-                image0 = image0.repeat(2, 1, 1, 1)
-                targets = torch.zeros((len(text, )), dtype=torch.int64)
-                targets[:len(pos)] = 1
-                images = image0
-                images, targets = images.to(device), targets.to(device)
-                loss2,losses_log = model(images, text, targets=targets, train=True, agent=agent,train_zsl = True)
+        # zsl data loss cal
+        if agent.random ==True:
+            zsl_batch_data = shuffle_zsl_batch(zsl_batch_data)
+        images, text, targets = zsl_batch(zsl_batch_data, agent, device)
+        loss2, losses_log = model(images, text, targets=targets, train=True, agent=agent, train_zsl=True)
 
         loss = loss1 + loss2
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer_step(model, loss, optimizer)
 
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(loss=loss.item())
         metric_logger.update(zero_shot_loss=loss2.item())
+        telemetry.step(epoch, i, targets.size(0), metric_logger)
+        if step_ckpt is not None:
+            step_ckpt.step(epoch, i, metric_logger)
 
         if i % print_freq == 0 and i != 0:
             print(f"Step: {i}, Loss: {loss.item():.4f}, ce-Loss: {loss1.item():.4f}, zero-shot-Loss: {loss2.item():.4f}, task-Loss: {losses_log}")
@@ -165,8 +178,14 @@ def train_zsl(model, data_loader,zsl_data_loader,zsl_datasets,samplers,num_worke
     print("Averaged stats:", metric_logger.global_avg())
     return {k: "{:.4f}".format(meter.global_avg) for k, meter in metric_logger.meters.items()}
 
+def print_embed_cache_stats(model):
+    embed_cache = getattr(getattr(model, 'module', model), 'embed_cache', None)
+    if embed_cache is not None:
+        print("Image embedding cache:", embed_cache.stats())
+
+
 @torch.no_grad()
-def evaluate(model, data_loader, device, config, agent):
+def evaluate(model, data_loader, device, config, agent, sync=True):
     # test
     model.eval()
             
@@ -198,15 +217,17 @@ def evaluate(model, data_loader, device, config, agent):
         
         metric_logger.meters['acc'].update(accuracy.item(), n=image0.size(0))
 
-    # gather the stats from all processes
-    metric_logger.synchronize_between_processes()
+    # gather the stats from all processes, unless each process evaluates its own tasks
+    if sync:
+        metric_logger.synchronize_between_processes()
 
     print("Averaged stats:", metric_logger.global_avg())   
+    print_embed_cache_stats(model)
     return {k: "{:.4f}".format(meter.global_avg) for k, meter in metric_logger.meters.items()}
 
 
 @torch.no_grad()
-def multi_task_evaluate(model, data_loader, device, config, agent):
+def multi_task_evaluate(model, data_loader, device, config, agent, sync=True):
     # test
     model.eval()
 
@@ -233,13 +254,12 @@ def multi_task_evaluate(model, data_loader, device, config, agent):
 
         predictions = []
         for iT in range(agent.get_num_tasks()):
-            agent.prep_model4task(iT)
-            prediction = model(images, text, targets=targets, train=False, agent=agent)
+            with agent.adapters.activate('task%d' % iT):
+                prediction = model(images, text, targets=targets, train=False, agent=agent)
             if isinstance(prediction, tuple):
                 fuse_weights = prediction[1].detach().cpu()
                 prediction = prediction[0]
             predictions.append(prediction.detach().cpu())
-        agent.prep_model4task(-1)
 
 
         if agent.fuse_type in ['last']:
@@ -257,10 +277,12 @@ def multi_task_evaluate(model, data_loader, device, config, agent):
 
         metric_logger.meters['acc'].update(accuracy.item(), n=image0.size(0))
 
-    # gather the stats from all processes
-    metric_logger.synchronize_between_processes()
+    # gather the stats from all processes, unless each process evaluates its own tasks
+    if sync:
+        metric_logger.synchronize_between_processes()
 
     print("Averaged stats:", metric_logger.global_avg())
+    print_embed_cache_stats(model)
     return {k: "{:.4f}".format(meter.global_avg) for k, meter in metric_logger.meters.items()}
 
         
@@ -274,12 +296,29 @@ def main(args, config, eval=False,test_ema=False):
     if utils.is_main_process(): Path(args['result_dir']).mkdir(parents=True, exist_ok=True)
     device = args['device']
 
+    if not eval:
+        telemetry.set_context(task=agent.task_id)
+
     #### Dataset #### 
     print("Creating dataset")
     dataset_pass_dict = {'training_data_sample':args['training_data_sample']}
-    datasets = create_dataset(config['dataset'], config, dataset_pass_dict)
+    with telemetry.timed('task_setup', part='dataset', eval=eval):
+        datasets = create_dataset(config['dataset'], config, dataset_pass_dict)
+
+    # content-addressed result cache shared across runs, see eval_cache.EvalCache
+    eval_cache, cache_key = None, None
+    if eval and args.get('eval_cache_dir'):
+        eval_cache = EvalCache(args['eval_cache_dir'])
+        cache_key, cached_stats = eval_cache.get(args, config, datasets[2], args.get('adapter', 'ema' if test_ema else 'current'))
+        if cached_stats is not None:
+            print(f'Evaluation cache hit: {cached_stats}')
+            if utils.is_main_process():
+                return cached_stats['acc']
+            else:
+                return -0.1
 
-    if args['distributed']:
+    # step-level resumption needs the resumable samplers also without distribution
+    if args['distributed'] or (args.get('step_ckpt_every', 0) > 0 and not eval):
         num_tasks = utils.get_world_size()
         global_rank = utils.get_rank()            
         samplers = create_sampler(datasets, [True,False,False], num_tasks, global_rank)
@@ -291,20 +330,139 @@ def main(args, config, eval=False,test_ema=False):
                                                           num_workers=[args['num_workers'], args['num_workers'], args['num_workers']],is_trains=[True,False,False],
                                                           collate_fns=[None,None,None])
 
-    # agent
+    #### Model #### 
+    if not eval:
+        utils.step_profiler.begin_task(agent.task_id, args['out_dir'])
+    with telemetry.timed('task_setup', part='model', eval=eval):
+        run = setup_model(args, config, device, eval=eval)
+    model, model_without_ddp, optimizer = run['model'], run['model_without_ddp'], run['optimizer']
+    int8_parity = run['int8_parity']
+
+    print("Start training")
+    start_time = time.time()
+
+    # flag for no training
+    if not eval and args['eval_every'] < 0:
+        if utils.is_main_process():  
+            torch.save({'model':model_without_ddp.state_dict()}, args['model_save_path'])
+        return
+
+    if test_ema:
+        # the resident model already carries every adapter, only the selection changes
+        print('evaluate ema')
+        with agent.adapters.activate(args.get('adapter', 'ema')):
+            test_stats = evaluate(model, test_loader, device, config, agent)
+        if eval_cache is not None:
+            eval_cache.put(cache_key, test_stats)
+
+        if utils.is_main_process():
+            return test_stats['acc']
+        else:
+            return -0.1
+
+    else:
+        zsl_train_loader = None
+        if agent.task_id != 0:
+            zsl_train_loader = create_zsl_loader(args, config, agent)
+
+        run['best'] = 0
+        step_ckpt = None
+        if not eval and args.get('step_ckpt_every', 0) > 0:
+            step_ckpt = StepCheckpointer(run, args['step_ckpt_every'])
+        for epoch in range(run['start_epoch'], config['max_epoch']):
+            if not eval and run['early_stop']['stopped_epoch'] is not None:
+                break
+            if not eval:
+                if samplers[0] is not None:
+                    train_loader.sampler.set_epoch(epoch)
+                if step_ckpt is not None:
+                    step_ckpt.begin_epoch(epoch, [train_loader, zsl_train_loader])
+
+                cosine_lr_schedule(optimizer, epoch, config['max_epoch'], config['init_lr'], config['min_lr'])
+
+                if agent.task_id != 0:
+                    train_stats = train_zsl(model, train_loader,zsl_train_loader,None,None,args['num_workers'], optimizer, epoch, device, config, agent, step_ckpt=step_ckpt)
+                else:
+                    train_stats = train(model, train_loader, optimizer, epoch,  device, config, agent, step_ckpt=step_ckpt)
+
+                ema_epoch_end(run, val_loader, epoch)
+
+                # a stopping epoch is always closed with a checkpoint, so the decision survives a restart
+                if (epoch + 1) % args['eval_every'] == 0 or run['early_stop']['stopped_epoch'] == epoch:
+                    epoch_end(run, train_stats, val_loader, test_loader, epoch)
+
+            else:
+                eval_func = evaluate
+                if agent.multi:
+                    eval_func = multi_task_evaluate
+
+                if int8_parity:
+                    # reference accuracy with the float backbone, then the same model switches to int8
+                    test_stats_float = eval_func(model_without_ddp, test_loader, device, config, agent)
+                    lora.quantize_base_weights_(model_without_ddp)
+                    model = model_without_ddp
+
+                with agent.adapters.activate(args.get('adapter', 'current')):
+                    val_stats = eval_func(model, val_loader, device, config, agent)
+                    test_stats = eval_func(model, test_loader, device, config, agent)
+                if eval_cache is not None:
+                    eval_cache.put(cache_key, test_stats)
+
+                if utils.is_main_process():
+                    log_stats = {**{f'val_{k}': v for k, v in val_stats.items()},
+                                 **{f'test_{k}': v for k, v in test_stats.items()},
+                                 }
+                    if int8_parity:
+                        log_stats['test_acc_float'] = test_stats_float['acc']
+                        log_stats['test_acc_int8'] = test_stats['acc']
+                        log_stats['int8_acc_delta'] = '{:.4f}'.format(float(test_stats['acc']) - float(test_stats_float['acc']))
+                        print(f"int8 parity: float {test_stats_float['acc']} int8 {test_stats['acc']}")
+                    with open(os.path.join(args['out_dir'], "log.txt"), "a") as f:
+                        f.write(json.dumps(log_stats) + "\n")
+
+            dist.barrier()
+            torch.cuda.empty_cache()
+            if eval:
+                if utils.is_main_process():
+                    return test_stats['acc']
+                else:
+                    return -0.1
+
+        if step_ckpt is not None:
+            step_ckpt.clear()
+        early_stop_report(run)
+
+
+def model_kwargs(config):
+    # BLIP_NLVR architecture of a task config; med_config and tokenizer are only set by the tiny synthetic configs
+    kwargs = dict(image_size=config['image_size'], vit=config['vit'], vit_grad_ckpt=config['vit_grad_ckpt'],
+                  vit_ckpt_layer=config['vit_ckpt_layer'], single_image_model=('vl-checklist' in config['dataset']))
+    for k in ['med_config', 'tokenizer']:
+        if config.get(k) is not None:
+            kwargs[k] = config[k]
+    return kwargs
+
+
+def setup_model(args, config, device, eval=False):
+    """
+    Model, optimizer and resume state of one agent, shared by main() and cotrain(). Returns a dict that the epoch
+    helpers below (ema_epoch_end, epoch_end) read and update.
+    """
     agent = args['agent']
 
-    #### Model #### 
     print("Creating model")
-    model, head_not_loaded = blip_nlvr(pretrained=args['pretrained'], image_size=config['image_size'],
-                         vit=config['vit'], vit_grad_ckpt=config['vit_grad_ckpt'], vit_ckpt_layer=config['vit_ckpt_layer'], agent=agent, single_image_model=('vl-checklist' in config['dataset']))
+    with telemetry.timed('model_load', checkpoints=len(args['pretrained']) if isinstance(args['pretrained'], list) else 1):
+        model, head_not_loaded = blip_nlvr(pretrained=args['pretrained'], agent=agent, skip_init=args['skip_init'],
+                                           **model_kwargs(config))
+    int8_parity = eval and args['int8_backbone'] and args['int8_parity']
+    if args['int8_backbone'] and not int8_parity:
+        lora.quantize_base_weights_(model)
 
     model = model.to(device)   
+    if eval and args.get('image_embed_cache_mb'):
+        model.embed_cache = ImageEmbedCache(args['image_embed_cache_mb'] * 2 ** 20)
     
     model_without_ddp = model
-    if args['distributed']:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args['gpu']], find_unused_parameters=True)
-        model_without_ddp = model.module
 
     if not eval and agent.ema:
         if  args['ema_lora'] == 'continual':
@@ -334,183 +492,535 @@ def main(args, config, eval=False,test_ema=False):
                 p.requires_grad = False
 
         if agent.lora:
-            param_to_optim += list(model_without_ddp.text_encoder.parameters())
-            param_to_optim += list(model_without_ddp.visual_encoder.parameters())
             lora.mark_only_lora_as_trainable(model_without_ddp.text_encoder)
             lora.mark_only_lora_as_trainable(model_without_ddp.visual_encoder)
-        
-        # optimizer
-        optimizer = torch.optim.AdamW(params=param_to_optim, lr=config['init_lr'], weight_decay=config['weight_decay'])
+            param_to_optim += list(model_without_ddp.text_encoder.parameters())
+            param_to_optim += list(model_without_ddp.visual_encoder.parameters())
+
+        # optimizer only holds the trainable tensors, packed into flat buffers
+        param_to_optim = [p for p in param_to_optim if p.requires_grad]
+        flat_buffers = lora.flatten_parameters(param_to_optim)
+        optimizer = create_optimizer([flat_data for flat_data, _ in flat_buffers], lr=config['init_lr'],
+                                     weight_decay=config['weight_decay'])
         nparam = count_parameters(param_to_optim)
     else:
+        flat_buffers = None
         optimizer = torch.optim.AdamW(params=model.parameters(), lr=config['init_lr'], weight_decay=config['weight_decay'])
         nparam = count_parameters(model.parameters())
 
     # print num trainable params    
     print(f'trainable_parameters = {nparam}')
 
+    # wrapped after freezing so only the trainable tensors are registered, evaluation runs unwrapped
+    comm_stats = None
+    if args['distributed'] and not eval:
+        compress_dtype = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[args['grad_compress']]
+        if args['lora_ddp']:
+            model = lora.LoRADataParallel(model, flat_buffers=flat_buffers, bucket_cap_mb=args['bucket_cap_mb'],
+                                          compress_dtype=compress_dtype, sync_every=args['grad_sync_every'])
+            comm_stats = model.comm_stats
+        else:
+            assert args['grad_sync_every'] == 1, 'reduced-frequency gradient sync needs --lora_ddp'
+            device_ids = [args['gpu']] if device.type == 'cuda' else None
+            # int8 base weights are frozen buffers, identical on every rank; DDP would broadcast them every forward
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True,
+                                                              bucket_cap_mb=args['bucket_cap_mb'],
+                                                              broadcast_buffers=not args['int8_backbone'])
+            # the Python hook replaces DDP's built-in allreduce, only when it is needed
+            if compress_dtype is not None or args.get('comm_stats', False):
+                comm_stats = lora.CommStats()
+                model.register_comm_hook(state=None, hook=lora.allreduce_hook(compress_dtype, comm_stats))
+
     # init agent
     if not eval: agent.update_model(model_without_ddp)
 
-    print("Start training")
-    start_time = time.time()
-    best = 0
-    best_epoch = 0
-
-    # flag for no training
-    if not eval and args['eval_every'] < 0:
-        if utils.is_main_process():  
-            torch.save({'model':model_without_ddp.state_dict()}, args['model_save_path'])
-        return
-
-    start_epoch = 0
+    run = {'args': args, 'config': config, 'model': model, 'model_without_ddp': model_without_ddp,
+           'optimizer': optimizer, 'int8_parity': int8_parity, 'comm_stats': comm_stats, 'start_epoch': 0, 'best': 0, 'best_epoch': 0,
+           'early_stop': {'best': None, 'best_epoch': None, 'bad_evals': 0, 'stopped_epoch': None}}
 
     #load checkpint of current task
-    for epoch in range(start_epoch, config['max_epoch']):
+    for epoch in range(0, config['max_epoch']):
         load_file = os.path.join(args['out_dir'], 'checkpoint_%02d.pth'%epoch)
         if os.path.exists(load_file):
             checkpoint = torch.load(load_file)
             model_without_ddp.load_state_dict(checkpoint['model'])
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            start_epoch = checkpoint['epoch'] + 1
-            best = checkpoint['best']
-            best_epoch = checkpoint['best_epoch']
+            try:
+                optimizer.load_state_dict(checkpoint['optimizer'])
+            except ValueError:
+                print(f'Optimizer state in {load_file} does not match the trainable parameters, starting it fresh')
+            run['start_epoch'] = checkpoint['epoch'] + 1
+            run['best'] = checkpoint['best']
+            run['best_epoch'] = checkpoint['best_epoch']
+            if 'early_stop' in checkpoint:
+                run['early_stop'] = checkpoint['early_stop']
+    return run
+
+
+def early_stop_policy(config):
+    """
+    Per-task stopping policy from the task config, None when the task trains the full schedule:
+        early_stop:
+          patience: 3       # validations without improvement before stopping
+          min_delta: 0.0    # smallest val acc gain that counts as an improvement
+          min_epochs: 4     # never stop before this many epochs
+    """
+    policy = config.get('early_stop')
+    if not policy or policy.get('patience', -1) < 0:
+        return None
+    return {'patience': policy['patience'], 'min_delta': policy.get('min_delta', 0.0), 'min_epochs': policy.get('min_epochs', 0)}
+
+
+def early_stop_update(run, val_acc, epoch):
+    # val_acc is synchronized over ranks by evaluate(), so every rank takes the same decision
+    policy = early_stop_policy(run['config'])
+    state = run['early_stop']
+    if policy is None or state['stopped_epoch'] is not None:
+        return
+    val_acc = float(val_acc)
+    if state['best'] is None or val_acc > state['best'] + policy['min_delta']:
+        state['best'], state['best_epoch'], state['bad_evals'] = val_acc, epoch, 0
+    else:
+        state['bad_evals'] += 1
+    if state['bad_evals'] >= policy['patience'] and epoch + 1 >= policy['min_epochs']:
+        state['stopped_epoch'] = epoch
+        print(f"Early stopping at epoch {epoch}: no val acc gain above {policy['min_delta']} for {state['bad_evals']} "
+              f"validations, best {state['best']} at epoch {state['best_epoch']}")
+
+
+def early_stop_report(run):
+    # epochs trained against the fixed schedule of the task, written next to log.txt
+    args, config = run['args'], run['config']
+    state = run['early_stop']
+    if early_stop_policy(config) is None or not utils.is_main_process():
+        return
+    epochs_run = config['max_epoch'] if state['stopped_epoch'] is None else state['stopped_epoch'] + 1
+    report = {'max_epoch': config['max_epoch'], 'epochs_run': epochs_run, 'epochs_saved': config['max_epoch'] - epochs_run,
+              'stopped_epoch': state['stopped_epoch'], 'best_val_acc': state['best'], 'best_epoch': state['best_epoch'],
+              'policy': early_stop_policy(config)}
+    print(f"Early stop report: {epochs_run}/{config['max_epoch']} epochs, {report['epochs_saved']} saved")
+    with open(os.path.join(args['out_dir'], 'early_stop.json'), 'w') as f:
+        json.dump(report, f)
+
+
+class StepCheckpointer:
+    """
+    Step-level resumable state of a training epoch, written every `every` optimizer steps (--step_ckpt_every):
+        step_checkpoint.pth          rank 0: trainable and EMA adapter tensors, optimizer, best/early-stop state
+        step_checkpoint_rank<r>.pth  every rank: RNG states and MetricLogger accumulators
+    Both carry (epoch, step). The task and wild loaders restart from the batch after `step` through the
+    ResumableDistributedSampler positions. A snapshot older than the latest epoch checkpoint is ignored.
+    """
+    def __init__(self, run, every):
+        self.run = run
+        self.every = every
+        out_dir = run['args']['out_dir']
+        self.file = os.path.join(out_dir, 'step_checkpoint.pth')
+        self.rank_file = os.path.join(out_dir, 'step_checkpoint_rank%d.pth' % utils.get_rank())
+        self.resume = None
+        self.start_step = 0
+        self.meters = None
+        self.last_saved = -1
+        if os.path.exists(self.file):
+            state = torch.load(self.file, map_location='cpu')
+            if state['epoch'] >= run['start_epoch']:
+                self.load(state)
+
+    def adapter_state(self):
+        # adapter-only snapshot: the frozen backbone is reloaded from the task checkpoints on restart
+        model = self.run['model_without_ddp']
+        trainable = {n for n, p in model.named_parameters() if p.requires_grad}
+        return {k: v for k, v in model.state_dict().items() if k in trainable or 'lora_' in k}
+
+    def load(self, state):
+        run = self.run
+        run['model_without_ddp'].load_state_dict(state['model'], strict=False)
+        run['optimizer'].load_state_dict(state['optimizer'])
+        run['start_epoch'] = state['epoch']
+        run['best'], run['best_epoch'], run['early_stop'] = state['best'], state['best_epoch'], state['early_stop']
+        self.resume = {'epoch': state['epoch'], 'step': state['step'], 'rank': None}
+        if os.path.exists(self.rank_file):
+            rank_state = torch.load(self.rank_file, map_location='cpu')
+            # rank files are written before the shared one, a newer one belongs to an unfinished snapshot
+            if (rank_state['epoch'], rank_state['step']) == (state['epoch'], state['step']):
+                self.resume['rank'] = rank_state
+        print(f"Resuming epoch {state['epoch']} after step {state['step']} from {self.file}")
+
+    def begin_epoch(self, epoch, loaders):
+        self.start_step, self.meters, self.last_saved = 0, None, -1
+        if self.resume is not None and self.resume['epoch'] == epoch:
+            self.start_step = self.last_saved = self.resume['step'] + 1
+            if self.resume['rank'] is not None:
+                utils.set_rng_state(self.resume['rank']['rng'])
+                self.meters = self.resume['rank']['meters']
+            self.resume = None
+        for loader in loaders:
+            if loader is not None:
+                loader.sampler.start_index = self.start_step * loader.batch_size
+
+    def restore_meters(self, metric_logger):
+        # returns the first step of the epoch
+        if self.meters is not None:
+            metric_logger.load_state_dict(self.meters)
+            self.meters = None
+        return self.start_step
+
+    def step(self, epoch, i, metric_logger):
+        # only between optimizer steps: gradients of a reduced-frequency sync window are not part of the snapshot
+        if i + 1 - self.last_saved < self.every or not getattr(self.run['model'], 'synced', True):
+            return
+        self.last_saved = i + 1
+        save_checkpoint({'epoch': epoch, 'step': i, 'rng': utils.get_rng_state(), 'meters': metric_logger.state_dict()},
+                        self.rank_file, atomic=True)
+        if utils.is_dist_avail_and_initialized():
+            dist.barrier()
+        if utils.is_main_process():
+            run = self.run
+            save_checkpoint({'epoch': epoch, 'step': i, 'model': self.adapter_state(), 'optimizer': run['optimizer'].state_dict(),
+                             'best': run['best'], 'best_epoch': run['best_epoch'], 'early_stop': run['early_stop']}, self.file, atomic=True)
 
-    if test_ema:
-        fuse_type = agent.fuse_type
-        print('evaluate ema')
-        agent = args['agent']
-        agent.fuse_type = 'ema'
-        print("Creating model")
-        model, head_not_loaded = blip_nlvr(pretrained=args['pretrained'], image_size=config['image_size'],
-                                           vit=config['vit'], vit_grad_ckpt=config['vit_grad_ckpt'],
-                                           vit_ckpt_layer=config['vit_ckpt_layer'], agent=agent,
-                                           single_image_model=('vl-checklist' in config['dataset']))
-        model = model.to(device)
-        if args['distributed']:
-            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args['gpu']],
-                                                              find_unused_parameters=True)
+    def clear(self):
+        if utils.is_dist_avail_and_initialized():
+            dist.barrier()
+        for f in [self.rank_file] + ([self.file] if utils.is_main_process() else []):
+            if os.path.isfile(f):
+                os.remove(f)
 
-        eval_func = evaluate
 
-        test_stats = eval_func(model, test_loader, device, config, agent)
+def save_checkpoint(obj, path, atomic=False):
+    # every checkpoint write of the training loop, timed as the 'checkpoint' phase
+    with utils.profile_region('checkpoint', force=True), telemetry.timed('save', file=os.path.basename(path)):
+        if atomic:
+            torch.save(obj, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        else:
+            torch.save(obj, path)
 
-        agent.fuse_type = fuse_type
 
-        if utils.is_main_process():
-            return test_stats['acc']
+def create_zsl_loader(args, config, agent):
+    print("Creating zsl dataset")
+    dataset_pass_dict = {'training_data_sample': args['training_data_sample']}
+    zsl_datasets = create_zsl_dataset(config['dataset'], config, dataset_pass_dict)
+
+    if args['distributed'] or args.get('step_ckpt_every', 0) > 0:
+        num_tasks = utils.get_world_size()
+        global_rank = utils.get_rank()
+        samplers = create_sampler(zsl_datasets, [True, False, False], num_tasks, global_rank)
+    else:
+        samplers = [None, None, None]
+
+    batch_size = [config['batch_size_train'][agent.task_id], config['batch_size_test'], config['batch_size_test']]
+    zsl_train_loader, _, _ = create_loader(zsl_datasets, samplers, batch_size=batch_size,
+                                           num_workers=[args['num_workers'], args['num_workers'],
+                                                        args['num_workers']], is_trains=[True, False, False],
+                                           collate_fns=[None, None, None])
+    return zsl_train_loader
+
+
+def ema_epoch_end(run, val_loader, epoch):
+    # epoch-level EMA update of the adapters, the EMA adapter is validated and saved
+    args, config = run['args'], run['config']
+    agent, device = args['agent'], args['device']
+    model, model_without_ddp = run['model'], run['model_without_ddp']
+    if agent.ema and (epoch + 1) % args['ema_frequency'] == 0:
+        frequency = args['ema_frequency']
+        if args['ema'] == 'epoch':
+            ema_alpha = args['ema_alpha']
+            print(f'epoch EMA begins,current_alpha = {ema_alpha},task_id = {agent.task_id},ema_frequency = {frequency}')
+            with utils.profile_region('ema_update', force=True):
+                lora.update_ema_epoch_lora(model_without_ddp.text_encoder, args['ema_alpha'], agent.task_id,agent.update_both)
+                lora.update_ema_epoch_lora(model_without_ddp.visual_encoder, args['ema_alpha'], agent.task_id,agent.update_both)
+
+            # the LoRA layers only read the EMA adapter under fuse_type 'ema'
+            with agent.adapters.activate('ema'), telemetry.timed('eval', split='val', adapter='ema', epoch=epoch):
+                val_stats = evaluate(model, val_loader, device, config, agent)
+            early_stop_update(run, val_stats['acc'], epoch)
+            if args['save_frequency'] == 'best':
+                if float(val_stats['acc']) > run['best']:
+                    run['best'] = float(val_stats['acc'])
+                    save_checkpoint({'model': model_without_ddp.state_dict()}, args['model_save_path'])
+            elif args['save_frequency'] == 'every':
+                save_checkpoint({'model': model_without_ddp.state_dict()}, args['model_save_path'])
         else:
-            return -0.1
+            pass
+
 
+def epoch_end(run, train_stats, val_loader, test_loader, epoch):
+    # val/test of a training epoch, log.txt and the resumable epoch checkpoint
+    args, config = run['args'], run['config']
+    agent, device = args['agent'], args['device']
+    model, model_without_ddp, optimizer = run['model'], run['model_without_ddp'], run['optimizer']
+
+    eval_func = evaluate
+    if agent.multi:
+        eval_func = multi_task_evaluate
+
+    with agent.adapters.activate('current'):
+        with telemetry.timed('eval', split='val', adapter='current', epoch=epoch):
+            val_stats = eval_func(model, val_loader, device, config, agent)
+        with telemetry.timed('eval', split='test', adapter='current', epoch=epoch):
+            test_stats = eval_func(model, test_loader, device, config, agent)
+    # EMA agents stop on the EMA adapter validated in ema_epoch_end
+    if not (agent.ema and args['ema'] == 'epoch'):
+        early_stop_update(run, val_stats['acc'], epoch)
+
+    if utils.is_main_process():
+        log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                     **{f'val_{k}': v for k, v in val_stats.items()},
+                     **{f'test_{k}': v for k, v in test_stats.items()},
+                     'epoch': epoch,
+                     }
+        if utils.step_profiler.enabled:
+            # phase timings since the last logged epoch
+            log_stats['phases'] = utils.step_profiler.summary()
+            utils.step_profiler.reset()
+        if run['comm_stats'] is not None:
+            # gradient communication since the last logged epoch
+            log_stats.update(run['comm_stats'].summary())
+            print(f"Gradient communication: {run['comm_stats'].summary()}")
+            run['comm_stats'].reset()
+
+
+        if float(val_stats['acc']) > run['best'] :
+            run['best'] = float(val_stats['acc'])
+            run['best_epoch'] = epoch
+            if not agent.ema:
+                if args['save_frequency'] == 'best':
+                    save_checkpoint({'model': model_without_ddp.state_dict()}, args['model_save_path'])
+
+        if not agent.ema and args['save_frequency'] == 'every':
+            save_checkpoint({'model': model_without_ddp.state_dict()}, args['model_save_path'])
+
+
+        with open(os.path.join(args['out_dir'], "log.txt"), "a") as f:
+            f.write(json.dumps(log_stats) + "\n")
+
+        save_obj = {
+            'model': model_without_ddp.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'config': config,
+            'epoch': epoch,
+            'best': run['best'],
+            'best_epoch': run['best_epoch'],
+            'early_stop': run['early_stop'],
+        }
+        save_checkpoint(save_obj, os.path.join(args['out_dir'], 'checkpoint_%02d.pth' % epoch))
+        epoch_old = epoch - 1
+        old_file = os.path.join(args['out_dir'], 'checkpoint_%02d.pth' % epoch_old)
+        if os.path.isfile(old_file):
+            os.remove(old_file)
+
+        print(f"Finished epoch {epoch} best epoch is {run['best_epoch']} with acc {run['best']}")
+
+
+def train_cotrain(runs, data_loader, zsl_data_loader, epoch, device):
+    # one pass over the shared loader, every batch goes through the model and optimizer of each run
+    metric_loggers = []
+    for run in runs:
+        run['model'].train()
+        metric_logger = utils.MetricLogger(delimiter="  ")
+        metric_logger.add_meter('lr', utils.SmoothedValue(window_size=50, fmt='{value:.6f}'))
+        metric_logger.add_meter('loss', utils.SmoothedValue(window_size=50, fmt='{value:.4f}'))
+        if zsl_data_loader is not None:
+            metric_logger.add_meter('zero_shot_loss', utils.SmoothedValue(window_size=50, fmt='{value:.4f}'))
+        metric_loggers.append(metric_logger)
+
+    header = 'Train Epoch: [{}] x{}'.format(epoch, len(runs))
+    print_freq = 50
+    if zsl_data_loader is None:
+        batches = ((batch_data, None) for batch_data in data_loader)
     else:
-        if agent.task_id != 0:
-            print("Creating zsl dataset")
-            dataset_pass_dict = {'training_data_sample': args['training_data_sample']}
-            zsl_datasets = create_zsl_dataset(config['dataset'], config, dataset_pass_dict)
-
-            if args['distributed']:
-                num_tasks = utils.get_world_size()
-                global_rank = utils.get_rank()
-                samplers = create_sampler(zsl_datasets, [True, False, False], num_tasks, global_rank)
-            else:
-                samplers = [None, None, None]
+        batches = zip(data_loader, zsl_data_loader)
+    telemetry.start_window()
+    for i, (batch_data, zsl_batch_data) in enumerate(metric_loggers[0].log_every(batches, print_freq, header, total=len(data_loader), profiler=utils.step_profiler)):
+        images, text, targets = task_batch(batch_data, device)
+        if zsl_batch_data is not None:
+            # shuffled once per batch, shared by every run with the random setting
+            shuffled_zsl_batch_data = shuffle_zsl_batch(zsl_batch_data)
+
+        for run, metric_logger in zip(runs, metric_loggers):
+            agent, model, optimizer = run['args']['agent'], run['model'], run['optimizer']
+            loss = model(images, text, targets=targets, train=True, agent=agent)
+            if zsl_batch_data is not None:
+                zsl_images, zsl_text, zsl_targets = zsl_batch(shuffled_zsl_batch_data if agent.random else zsl_batch_data, agent, device)
+                loss2, losses_log = model(zsl_images, zsl_text, targets=zsl_targets, train=True, agent=agent, train_zsl=True)
+                loss = loss + loss2
+                metric_logger.update(zero_shot_loss=loss2.item())
+
+            optimizer_step(model, loss, optimizer)
+
+            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+            metric_logger.update(loss=loss.item())
+        telemetry.step(epoch, i, targets.size(0), metric_loggers[0], runs=len(runs))
+
+    train_stats = []
+    for run, metric_logger in zip(runs, metric_loggers):
+        metric_logger.synchronize_between_processes()
+        print(f"Averaged stats [{run['args']['out_dir']}]:", metric_logger.global_avg())
+        train_stats.append({k: "{:.4f}".format(meter.global_avg) for k, meter in metric_logger.meters.items()})
+    return train_stats
+
+
+def cotrain(members):
+    """
+    Trains several agent configurations of the same task side by side on one data pipeline. `members` is a list of
+    (args, config) pairs as main() takes them: every decoded and augmented batch is fed to each member, and each member
+    keeps its own model, adapters, optimizer, checkpoints and out_dir. Mirrors the training path of main().
+    """
+    args, config = members[0]
+    agent = args['agent']
+    device = args['device']
+    for m_args, m_config in members[1:]:
+        assert m_args['agent'].task_id == agent.task_id
+        assert all(m_config[k] == config[k] for k in ['dataset', 'json_files', 'zsl_json_files', 'image_size', 'batch_size_train',
+                                                      'batch_size_test', 'max_epoch']), 'co-trained members must share the data pipeline'
 
-            batch_size = [config['batch_size_train'][agent.task_id], config['batch_size_test'], config['batch_size_test']]
-            zsl_train_loader, _, _ = create_loader(zsl_datasets, samplers, batch_size=batch_size,
-                                                   num_workers=[args['num_workers'], args['num_workers'],
-                                                                args['num_workers']], is_trains=[True, False, False],
-                                                   collate_fns=[None, None, None])
+    #### Dataset ####
+    print("Creating dataset")
+    dataset_pass_dict = {'training_data_sample':args['training_data_sample']}
+    datasets = create_dataset(config['dataset'], config, dataset_pass_dict)
+    if args['distributed']:
+        samplers = create_sampler(datasets, [True,False,False], utils.get_world_size(), utils.get_rank())
+    else:
+        samplers = [None, None, None]
+    batch_size=[config['batch_size_train'][agent.task_id],config['batch_size_test'],config['batch_size_test']]
+    train_loader, val_loader, test_loader = create_loader(datasets,samplers,batch_size=batch_size,
+                                                          num_workers=[args['num_workers'], args['num_workers'], args['num_workers']],is_trains=[True,False,False],
+                                                          collate_fns=[None,None,None])
+    zsl_train_loader = None
+    if agent.task_id != 0:
+        zsl_train_loader = create_zsl_loader(args, config, agent)
+
+    #### Models ####
+    utils.step_profiler.begin_task(agent.task_id, args['out_dir'])
+    telemetry.set_context(task=agent.task_id)
+    runs = []
+    for m_args, m_config in members:
+        m_args['result_dir'] = os.path.join(m_args['out_dir'], 'result')
+        if utils.is_main_process(): Path(m_args['result_dir']).mkdir(parents=True, exist_ok=True)
+        run = setup_model(m_args, m_config, device)
+        if m_args['eval_every'] < 0:
+            if utils.is_main_process():
+                torch.save({'model': run['model_without_ddp'].state_dict()}, m_args['model_save_path'])
+            continue
+        run['best'] = 0
+        runs.append(run)
+
+    print(f"Start co-training {len(runs)} configurations")
+    for epoch in range(min([run['start_epoch'] for run in runs], default=config['max_epoch']), config['max_epoch']):
+        if all(run['early_stop']['stopped_epoch'] is not None for run in runs):
+            break
+        active = [run for run in runs if epoch >= run['start_epoch'] and run['early_stop']['stopped_epoch'] is None]
+        if args['distributed']:
+            train_loader.sampler.set_epoch(epoch)
+        for run in active:
+            m_config = run['config']
+            cosine_lr_schedule(run['optimizer'], epoch, m_config['max_epoch'], m_config['init_lr'], m_config['min_lr'])
 
-        best = 0
-        for epoch in range(start_epoch, config['max_epoch']):
-            if not eval:
-                if args['distributed']:
-                    train_loader.sampler.set_epoch(epoch)
+        train_stats = train_cotrain(active, train_loader, zsl_train_loader, epoch, device)
 
-                cosine_lr_schedule(optimizer, epoch, config['max_epoch'], config['init_lr'], config['min_lr'])
+        for run, run_train_stats in zip(active, train_stats):
+            ema_epoch_end(run, val_loader, epoch)
+            if (epoch + 1) % run['args']['eval_every'] == 0 or run['early_stop']['stopped_epoch'] == epoch:
+                epoch_end(run, run_train_stats, val_loader, test_loader, epoch)
 
-                if agent.task_id != 0:
-                    train_stats = train_zsl(model, train_loader,zsl_train_loader,zsl_datasets,samplers,args['num_workers'], optimizer, epoch, device, config, agent)
-                else:
-                    train_stats = train(model, train_loader, optimizer, epoch,  device, config, agent)
-
-                if agent.ema and (epoch + 1) % args['ema_frequency'] == 0:
-                    frequency = args['ema_frequency']
-                    if args['ema'] == 'epoch':
-                        ema_alpha = args['ema_alpha']
-                        print(f'epoch EMA begins,current_alpha = {ema_alpha},task_id = {agent.task_id},ema_frequency = {frequency}')
-                        lora.update_ema_epoch_lora(model_without_ddp.text_encoder, args['ema_alpha'], agent.task_id,agent.update_both)
-                        lora.update_ema_epoch_lora(model_without_ddp.visual_encoder, args['ema_alpha'], agent.task_id,agent.update_both)
-
-                        val_stats = evaluate(model, val_loader, device, config, agent)
-                        if args['save_frequency'] == 'best':
-                            if float(val_stats['acc']) > best:
-                                best = float(val_stats['acc'])
-                                torch.save({'model': model_without_ddp.state_dict()}, args['model_save_path'])
-                        elif args['save_frequency'] == 'every':
-                            torch.save({'model': model_without_ddp.state_dict()}, args['model_save_path'])
-                    else:
-                        pass
-
-
-            if eval or (epoch + 1) % args['eval_every'] == 0:
-                eval_func = evaluate
-                if agent.multi:
-                    eval_func = multi_task_evaluate
+        dist.barrier()
+        torch.cuda.empty_cache()
 
-                val_stats = eval_func(model, val_loader, device, config, agent)
-                test_stats = eval_func(model, test_loader, device, config, agent)
+    for run in runs:
+        early_stop_report(run)
 
-                if utils.is_main_process():
-                    if eval:
-                        log_stats = {**{f'val_{k}': v for k, v in val_stats.items()},
-                                     **{f'test_{k}': v for k, v in test_stats.items()},
-                                     }
-                        with open(os.path.join(args['out_dir'], "log.txt"), "a") as f:
-                            f.write(json.dumps(log_stats) + "\n")
-
-                    else:
-                        log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                                     **{f'val_{k}': v for k, v in val_stats.items()},
-                                     **{f'test_{k}': v for k, v in test_stats.items()},
-                                     'epoch': epoch,
-                                     }
-
-
-                        if float(val_stats['acc']) > best :
-                            best = float(val_stats['acc'])
-                            best_epoch = epoch
-                            if not agent.ema:
-                                if args['save_frequency'] == 'best':
-                                    torch.save({'model': model_without_ddp.state_dict()}, args['model_save_path'])
-
-                        if not agent.ema and args['save_frequency'] == 'every':
-                            torch.save({'model': model_without_ddp.state_dict()}, args['model_save_path'])
-
-
-                        with open(os.path.join(args['out_dir'], "log.txt"), "a") as f:
-                            f.write(json.dumps(log_stats) + "\n")
-
-                        save_obj = {
-                            'model': model_without_ddp.state_dict(),
-                            'optimizer': optimizer.state_dict(),
-                            'config': config,
-                            'epoch': epoch,
-                            'best': best,
-                            'best_epoch': best_epoch,
-                        }
-                        torch.save(save_obj, os.path.join(args['out_dir'], 'checkpoint_%02d.pth' % epoch))
-                        epoch_old = epoch - 1
-                        old_file = os.path.join(args['out_dir'], 'checkpoint_%02d.pth' % epoch_old)
-                        if os.path.isfile(old_file):
-                            os.remove(old_file)
-
-                        print(f'Finished epoch {epoch} best epoch is {best_epoch} with acc {best}')
 
-            dist.barrier()
-            torch.cuda.empty_cache()
-            if eval:
-                if utils.is_main_process():
-                    return test_stats['acc']
-                else:
-                    return -0.1
+def evaluate_round(args, configs, out_dirs):
+    """
+    One cl_matrix column in a single session: the model is built once from args['pretrained'] and the test split of
+    every task config in `configs` is streamed through it with the adapter args['adapter']. No optimizer, no DDP wrapper
+    (nothing is trained) and no val split. Returns the test accuracy per task, -0.1 on non-main ranks as main(eval=True).
+
+    With args['task_parallel_eval'] each rank evaluates whole tasks on its own (balanced by test-set size, see
+    utils.schedule_tasks) instead of sharding every task over all ranks, and the stats are merged by task index.
+    With args['eval_cache_dir'] tasks found in the evaluation cache are not evaluated, and the model is not even built
+    when all of them are.
+    """
+    agent = args['agent']
+    device = args['device']
+    test_ema = args['adapter'] == 'ema'
+    task_parallel = args['task_parallel_eval'] and args['distributed']
+
+    config = configs[0]
+    for c in configs[1:]:
+        assert all(c[k] == config[k] for k in ['dataset', 'image_size', 'vit']), 'tasks of one round must share the model'
+
+    start_time = time.time()
+    # every rank builds every test set, split generation synchronizes all ranks
+    dataset_pass_dict = {'training_data_sample': args['training_data_sample']}
+    test_datasets = [create_dataset(c['dataset'], c, dataset_pass_dict, splits=['test'])[2] for c in configs]
+
+    task_stats = {}
+    cache_keys = {}
+    eval_cache = EvalCache(args['eval_cache_dir']) if args.get('eval_cache_dir') else None
+    if eval_cache is not None:
+        for i, (c, test_dataset) in enumerate(zip(configs, test_datasets)):
+            cache_keys[i], cached_stats = eval_cache.get(args, c, test_dataset, args['adapter'], task_parallel)
+            if cached_stats is not None:
+                task_stats[i] = cached_stats
+        print(f'Evaluation cache: {len(task_stats)}/{len(configs)} tasks hit')
+    pending = [i for i in range(len(configs)) if i not in task_stats]
+
+    if len(pending) > 0:
+        print("Creating model")
+        model, _ = blip_nlvr(pretrained=args['pretrained'], agent=agent, skip_init=args['skip_init'], **model_kwargs(config))
+        if args['int8_backbone']:
+            lora.quantize_base_weights_(model)
+        model = model.to(device)
+        if args.get('image_embed_cache_mb'):
+            # shared by the tasks of the round, their test splits draw on the same images
+            model.embed_cache = ImageEmbedCache(args['image_embed_cache_mb'] * 2 ** 20)
+    setup_time = time.time() - start_time
+
+    if task_parallel:
+        owners = dict(zip(pending, utils.schedule_tasks([len(test_datasets[i]) for i in pending], utils.get_world_size())))
+        print(f'Task schedule (task -> rank): {owners}')
+    else:
+        owners = {i: utils.get_rank() for i in pending}
+
+    eval_func = multi_task_evaluate if (agent.multi and not test_ema) else evaluate
+
+    new_stats = {}
+    for i in pending:
+        if owners[i] != utils.get_rank():
+            continue
+        if args['distributed'] and not task_parallel:
+            samplers = create_sampler([test_datasets[i]], [False], utils.get_world_size(), utils.get_rank())
+        else:
+            samplers = [None]
+        test_loader, = create_loader([test_datasets[i]], samplers, batch_size=[configs[i]['batch_size_test']],
+                                     num_workers=[args['num_workers']], is_trains=[False], collate_fns=[None])
+
+        with agent.adapters.activate(args['adapter']):
+            new_stats[i] = eval_func(model, test_loader, device, configs[i], agent, sync=not task_parallel)
+
+    if task_parallel:
+        gathered = [None] * utils.get_world_size()
+        dist.all_gather_object(gathered, new_stats)
+        new_stats = {i: gathered[owners[i]][i] for i in pending}
+
+    if eval_cache is not None:
+        for i in pending:
+            eval_cache.put(cache_keys[i], new_stats[i])
+    task_stats.update(new_stats)
+
+    total_time = time.time() - start_time
+    print(f'Evaluation round: {len(pending)} of {len(configs)} tasks evaluated in {total_time:.1f}s (setup {setup_time:.1f}s)')
+
+    results = []
+    for i, out_dir in enumerate(out_dirs):
+        if utils.is_main_process():
+            with open(os.path.join(out_dir, "log.txt"), "a") as f:
+                f.write(json.dumps({f'test_{k}': v for k, v in task_stats[i].items()}) + "\n")
+            results.append(task_stats[i]['acc'])
+        else:
+            results.append(-0.1)
+
+    dist.barrier()
+    torch.cuda.empty_cache()
+    return results
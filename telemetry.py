@@ -0,0 +1,175 @@
+"""
+Structured telemetry of a run: one JSON object per line in <output_dir>/telemetry.jsonl, written by rank 0 only.
+
+Events:
+    step         every --telemetry_every training steps: samples/s (all ranks), meter values (losses, lr), peak memory
+    eval         one evaluation pass inside training: split, adapter, seconds
+    task_setup   dataset/model/optimizer setup of a task, model_load, save (checkpoint writes): seconds
+    task_end     training wall time of a task
+    eval_round   evaluation of all seen tasks after a task: seconds, tasks (written by the evaluator process with
+                 --async_eval, async_eval=true)
+
+Summarize one or more runs (several runs are compared task by task against the first):
+    python telemetry.py out_dir_a/telemetry.jsonl [out_dir_b/telemetry.jsonl ...]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def peak_memory_mb():
+    # device memory on CUDA, resident set of the process otherwise
+    try:
+        import torch
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            return torch.cuda.max_memory_allocated() / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return None
+
+
+class Telemetry:
+    def __init__(self):
+        self.file = None
+        self.every = 10
+        self.world_size = 1
+        self.context = {}
+        self.window_start = time.time()
+        self.window_samples = 0
+        self.window_steps = 0
+
+    def open(self, path, every=10, world_size=1, is_main=True):
+        # every rank calls open, only the main one writes
+        self.every = every
+        self.world_size = world_size
+        if is_main:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'a', buffering=1)
+
+    def set_context(self, **fields):
+        # fields added to every following event, e.g. the task id
+        self.context.update(fields)
+
+    def emit(self, event, **fields):
+        if self.file is None:
+            return
+        record = {'time': round(time.time(), 3), 'event': event, **self.context, **fields}
+        self.file.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def timed(self, event, **fields):
+        start = time.time()
+        yield
+        self.emit(event, seconds=round(time.time() - start, 3), **fields)
+
+    def start_window(self):
+        # start of a training loop, eval and setup time between loops does not count as step time
+        self.window_start = time.time()
+        self.window_samples = 0
+        self.window_steps = 0
+
+    def step(self, epoch, step, samples, metric_logger, **fields):
+        if self.file is None or self.every <= 0:
+            return
+        self.window_samples += samples
+        self.window_steps += 1
+        if self.window_steps < self.every:
+            return
+        now = time.time()
+        meters = {k: m.value for k, m in metric_logger.meters.items() if len(m.deque) > 0}
+        self.emit('step', epoch=epoch, step=step, steps=self.window_steps,
+                  samples_per_sec=round(self.window_samples * self.world_size / max(now - self.window_start, 1e-9), 3),
+                  peak_mem_mb=peak_memory_mb(), **meters, **fields)
+        self.window_start, self.window_samples, self.window_steps = now, 0, 0
+
+
+telemetry = Telemetry()
+
+
+def load_events(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(events):
+    # per task: throughput, time split and peak memory
+    tasks = defaultdict(lambda: defaultdict(float))
+    throughput = defaultdict(list)
+    for e in events:
+        task = e.get('task')
+        if task is None:
+            continue
+        t = tasks[task]
+        if e['event'] == 'step':
+            throughput[task].append(e['samples_per_sec'])
+            t['steps'] += e['steps']
+            if e.get('peak_mem_mb') is not None:
+                t['peak_mem_mb'] = max(t['peak_mem_mb'], e['peak_mem_mb'])
+        elif e['event'] == 'eval':
+            t['eval_s'] += e['seconds']
+        elif e['event'] in ('task_setup', 'model_load', 'save'):
+            t[e['event'] + '_s'] += e['seconds']
+        elif e['event'] == 'task_end':
+            t['train_s'] += e['seconds']
+        elif e['event'] == 'eval_round':
+            t['eval_round_s'] += e['seconds']
+    for task, values in throughput.items():
+        tasks[task]['samples_per_sec'] = float(np.median(values))
+    return {task: dict(values) for task, values in sorted(tasks.items())}
+
+
+COLUMNS = ['steps', 'samples_per_sec', 'train_s', 'task_setup_s', 'model_load_s', 'save_s', 'eval_s', 'eval_round_s',
+           'peak_mem_mb']
+
+
+def print_table(name, summary):
+    print(name)
+    print(f"{'task':>5}" + ''.join(f'{c:>16}' for c in COLUMNS))
+    for task, values in summary.items():
+        print(f'{task:>5}' + ''.join(f'{values.get(c, 0):>16.1f}' for c in COLUMNS))
+
+
+def print_comparison(names, summaries, column='samples_per_sec'):
+    # each run relative to the first one
+    print(f'{column} relative to {names[0]}')
+    print(f"{'task':>5}" + ''.join(f'{os.path.basename(os.path.dirname(os.path.abspath(n))) or n:>20}' for n in names))
+    for task in summaries[0]:
+        base = summaries[0][task].get(column)
+        row = f'{task:>5}'
+        for s in summaries:
+            value = s.get(task, {}).get(column)
+            row += f'{"-":>20}' if value is None or not base else f'{value:>12.1f} ({value / base:4.2f})'
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-task throughput tables from telemetry.jsonl files')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--json', default=False, action='store_true', help='print the summaries as json')
+    args = parser.parse_args()
+
+    summaries = [summarize(load_events(f)) for f in args.files]
+    if args.json:
+        json.dump({f: s for f, s in zip(args.files, summaries)}, sys.stdout, indent=2)
+        return
+    for f, s in zip(args.files, summaries):
+        print_table(f, s)
+        print()
+    if len(args.files) > 1:
+        print_comparison(args.files, summaries)
+        print()
+        print_comparison(args.files, summaries, column='train_s')
+
+
+if __name__ == '__main__':
+    main()
@@ -23,14 +23,29 @@ def step_lr_schedule(optimizer, epoch, init_lr, min_lr, decay_rate):
 import numpy as np
 import io
 import os
+import random
 import time
 import sys
 from collections import defaultdict, deque
+from contextlib import contextmanager
 import datetime
+import inspect
 
 import torch
 import torch.distributed as dist
 
+def create_optimizer(params, lr, weight_decay):
+    """AdamW on the multi-tensor path: fused kernels when every tensor is on the GPU, foreach otherwise"""
+    params = list(params)
+    optim_args = inspect.signature(torch.optim.AdamW).parameters
+    kwargs = {}
+    if 'fused' in optim_args and len(params) > 0 and all(p.is_cuda for p in params):
+        kwargs['fused'] = True
+    elif 'foreach' in optim_args:
+        kwargs['foreach'] = True
+    return torch.optim.AdamW(params=params, lr=lr, weight_decay=weight_decay, **kwargs)
+
+
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
@@ -55,7 +70,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=backend_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -136,7 +151,25 @@ class MetricLogger(object):
     def add_meter(self, name, meter):
         self.meters[name] = meter
 
-    def log_every(self, iterable, print_freq, header=None):
+    def state_dict(self):
+        # local accumulators of every meter, for step-level resumption
+        return {name: {'deque': list(meter.deque), 'total': meter.total, 'count': meter.count}
+                for name, meter in self.meters.items()}
+
+    def load_state_dict(self, state):
+        for name, meter_state in state.items():
+            meter = self.meters[name]
+            meter.deque.clear()
+            meter.deque.extend(meter_state['deque'])
+            meter.total = meter_state['total']
+            meter.count = meter_state['count']
+
+    def log_every(self, iterable, print_freq, header=None, total=None, profiler=None):
+        # `total` for iterables without len(), e.g. generators over several loaders
+        # `profiler` (a training loop's StepProfiler) gets the data wait and the step boundaries
+        n_iters = len(iterable) if total is None else total
+        if profiler is not None:
+            profiler.active = True
         i = 0
         if not header:
             header = ''
@@ -144,7 +177,7 @@ class MetricLogger(object):
         end = time.time()
         iter_time = SmoothedValue(fmt='{avg:.4f}')
         data_time = SmoothedValue(fmt='{avg:.4f}')
-        space_fmt = ':' + str(len(str(len(iterable)))) + 'd'
+        space_fmt = ':' + str(len(str(n_iters))) + 'd'
         log_msg = [
             header,
             '[{0' + space_fmt + '}/{1}]',
@@ -157,32 +190,161 @@ class MetricLogger(object):
             log_msg.append('max mem: {memory:.0f}')
         log_msg = self.delimiter.join(log_msg)
         MB = 1024.0 * 1024.0
-        for obj in iterable:
-            data_time.update(time.time() - end)
-            yield obj
-            iter_time.update(time.time() - end)
-            if i % print_freq == 0 or i == len(iterable) - 1:
-                eta_seconds = iter_time.global_avg * (len(iterable) - i)
-                eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
-                if torch.cuda.is_available():
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time),
-                        memory=torch.cuda.max_memory_allocated() / MB))
-                else:
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time)))
-            i += 1
-            end = time.time()
+        # finally: training loops may leave the loop early
+        try:
+            for obj in iterable:
+                data_time.update(time.time() - end)
+                if profiler is not None:
+                    profiler.record('data', (time.time() - end) * 1000)
+                    profiler.begin_step()
+                yield obj
+                iter_time.update(time.time() - end)
+                if profiler is not None:
+                    profiler.end_step()
+                if i % print_freq == 0 or i == n_iters - 1:
+                    eta_seconds = iter_time.global_avg * (n_iters - i)
+                    eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
+                    if torch.cuda.is_available():
+                        line = log_msg.format(
+                            i, n_iters, eta=eta_string,
+                            meters=str(self),
+                            time=str(iter_time), data=str(data_time),
+                            memory=torch.cuda.max_memory_allocated() / MB)
+                    else:
+                        line = log_msg.format(
+                            i, n_iters, eta=eta_string,
+                            meters=str(self),
+                            time=str(iter_time), data=str(data_time))
+                    if profiler is not None and profiler.enabled:
+                        line += self.delimiter + profiler.format()
+                    print(line)
+                i += 1
+                end = time.time()
+        finally:
+            if profiler is not None:
+                profiler.active = False
+                profiler.close_trace()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('{} Total time: {} ({:.4f} s / it)'.format(
-            header, total_time_str, total_time / len(iterable)))
+            header, total_time_str, total_time / n_iters))
         
 
+class StepProfiler:
+    """
+    Named timing regions of a training step (--profile_steps): data, tokenize, vit, text_encoder, teacher, backward,
+    optimizer, ema_update, checkpoint. Regions synchronize the device only when profiling is on, otherwise they cost a
+    flag check. Regions count inside the training loops (log_every(profiler=...)), force=True regions also outside.
+    A torch.profiler trace of the steps [start, end) of one task is written with --profile_trace_task/--profile_trace_steps.
+    """
+    BINS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.enabled = False
+        self.active = False
+        self.trace_task = -1
+        self.trace_steps = (0, 0)
+        self.task_id = None
+        self.trace_dir = None
+        self.trace = None
+        self.step_index = 0
+        self.times = defaultdict(list)
+
+    def configure(self, enabled, trace_task=-1, trace_steps=(0, 0)):
+        self.enabled = enabled
+        self.trace_task = trace_task
+        self.trace_steps = trace_steps
+
+    def begin_task(self, task_id, out_dir):
+        self.task_id = task_id
+        self.trace_dir = os.path.join(out_dir, 'profile_trace')
+        self.step_index = 0
+        self.reset()
+
+    def reset(self):
+        self.times.clear()
+
+    def _sync(self):
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def record(self, name, ms):
+        if self.enabled and self.active:
+            self.times[name].append(ms)
+
+    @contextmanager
+    def region(self, name, force=False):
+        if self.trace is not None:
+            with torch.profiler.record_function(name):
+                yield
+            return
+        if not (self.enabled and (self.active or force)):
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self.times[name].append((time.perf_counter() - start) * 1000)
+
+    def begin_step(self):
+        start, end = self.trace_steps
+        if self.task_id != self.trace_task or self.trace is not None or not start <= self.step_index < end:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.trace.__enter__()
+        self.trace_start = self.step_index
+
+    def end_step(self):
+        self.step_index += 1
+        if self.trace is not None and self.step_index >= self.trace_steps[1]:
+            self.close_trace()
+
+    def close_trace(self):
+        # at the end of the window, or of the loop when the window is longer than the epoch
+        if self.trace is None:
+            return
+        self.trace.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        trace_file = os.path.join(self.trace_dir, 'trace_rank%d_steps%d-%d.json' % (get_rank(), self.trace_start, self.step_index))
+        self.trace.export_chrome_trace(trace_file)
+        print(f'Profiler trace written to {trace_file}')
+        self.trace = None
+
+    def format(self, window=50):
+        # p50/p90 in ms over the last `window` steps, for the log line
+        parts = []
+        for name, times in self.times.items():
+            recent = np.array(times[-window:])
+            parts.append('{}: {:.1f}/{:.1f}'.format(name, np.percentile(recent, 50), np.percentile(recent, 90)))
+        return 'phases ms p50/p90: ' + ' '.join(parts)
+
+    def summary(self):
+        # per phase since the last reset, with a histogram over BINS_MS, for log.txt
+        phases = {}
+        for name, times in self.times.items():
+            times = np.array(times)
+            counts = np.histogram(times, bins=[0] + self.BINS_MS + [np.inf])[0]
+            labels = ['<={}'.format(b) for b in self.BINS_MS] + ['>{}'.format(self.BINS_MS[-1])]
+            phases[name] = {'n': len(times), 'total_s': round(float(times.sum()) / 1000, 3),
+                            'mean_ms': round(float(times.mean()), 3), 'p50_ms': round(float(np.percentile(times, 50)), 3),
+                            'p90_ms': round(float(np.percentile(times, 90)), 3), 'max_ms': round(float(times.max()), 3),
+                            'hist_ms': {l: int(c) for l, c in zip(labels, counts) if c > 0}}
+        return phases
+
+
+step_profiler = StepProfiler()
+
+
+def profile_region(name, force=False):
+    return step_profiler.region(name, force=force)
+
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
@@ -234,12 +396,44 @@ def is_dist_avail_and_initialized():
     return True
 
 
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state(state['cuda'])
+
 def get_world_size():
     if not is_dist_avail_and_initialized():
         return 1
     return dist.get_world_size()
 
 
+def init_cpu_threads(args):
+    """
+    Intra-op thread budget of this process (--cpu_threads) and, with --pin_cores, a dedicated core set: local rank k
+    takes the k-th slice of cpu_threads cores out of the cores the process may run on. Data loader workers inherit it.
+    """
+    if args.cpu_threads <= 0:
+        return
+    torch.set_num_threads(args.cpu_threads)
+    if args.pin_cores and hasattr(os, 'sched_setaffinity'):
+        local_rank = args.gpu if args.distributed else 0
+        cores = sorted(os.sched_getaffinity(0))
+        cores = cores[local_rank * args.cpu_threads:(local_rank + 1) * args.cpu_threads]
+        if len(cores) < args.cpu_threads:
+            print(f'Not pinning local rank {local_rank}: fewer than {args.cpu_threads} free cores')
+        else:
+            os.sched_setaffinity(0, cores)
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else 'all'
+    print(f'| cpu threads (local rank {args.gpu if args.distributed else 0}): {torch.get_num_threads()} on cores {cores}', flush=True)
+
 def get_rank():
     if not is_dist_avail_and_initialized():
         return 0
@@ -250,6 +444,21 @@ def is_main_process():
     return get_rank() == 0
 
 
+def schedule_tasks(sizes, n_workers):
+    """
+    Longest-processing-time-first assignment of tasks to workers: tasks in decreasing size go to the currently
+    least loaded worker. Ties break on task/worker index so every rank computes the same schedule.
+    Returns the worker of each task.
+    """
+    owners = [0] * len(sizes)
+    loads = [0] * n_workers
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        w = min(range(n_workers), key=lambda w: (loads[w], w))
+        owners[i] = w
+        loads[w] += sizes[i]
+    return owners
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
@@ -271,23 +480,40 @@ def get_rank():
 def is_main_process():
     return get_rank() == 0
 
+def backend_device():
+    # collectives of small host values go through the device of the process group backend
+    if is_dist_avail_and_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+def use_cuda(args):
+    return torch.cuda.is_available() and torch.device(args.device).type == 'cuda'
+
 def init_distributed_mode(args):
+    # args.gpu is the local rank: the GPU index on CUDA, the slot of the core set on CPU (see init_cpu_threads)
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
         args.world_size = int(os.environ['WORLD_SIZE'])
         args.gpu = int(os.environ['LOCAL_RANK'])
     elif 'SLURM_PROCID' in os.environ:
         args.rank = int(os.environ['SLURM_PROCID'])
-        args.gpu = args.rank % torch.cuda.device_count()
+        args.gpu = int(os.environ.get('SLURM_LOCALID', 0))
+        if use_cuda(args):
+            args.gpu = args.rank % torch.cuda.device_count()
     else:
         print('Not using distributed mode')
         args.distributed = False
+        init_cpu_threads(args)
         return
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
+    if use_cuda(args):
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        args.dist_backend = 'gloo'
+    init_cpu_threads(args)
     print('| distributed init (rank {}): {}'.format(
         args.rank, args.dist_url), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,